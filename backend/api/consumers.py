@@ -0,0 +1,38 @@
+import json
+from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
+from utils import customStatus
+from utils.hlsProgress import PROGRESS_GROUP, get_progress
+
+class ConversionProgressConsumer(AsyncWebsocketConsumer):
+    """
+    Streams the progress of HLS conversions to staff users. Sends the current
+    progress of every conversion on connect, then every update as it is published.
+    """
+    async def connect(self):
+        self.user = self.scope["user"]
+        await self.accept()
+
+        if self.user.is_anonymous:
+            await self.close(code=customStatus.WS_4001_UNAUTHORISED)
+            return
+        if not self.user.is_staff:
+            await self.close(code=customStatus.WS_4003_FORBIDDEN)
+            return
+
+        await self.channel_layer.group_add(PROGRESS_GROUP, self.channel_name)
+
+        conversions = await sync_to_async(get_progress)()
+        await self.send(json.dumps({
+            "type": "conversion_snapshot",
+            "conversions": conversions
+        }))
+
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard(PROGRESS_GROUP, self.channel_name)
+
+    async def conversion_progress(self, event):
+        await self.send(json.dumps({
+            "type": "conversion_progress",
+            "progress": event["progress"]
+        }))
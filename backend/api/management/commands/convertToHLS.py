@@ -1,6 +1,8 @@
 import logging
-from django.core.management.base import BaseCommand
-from utils.convertToHLS import ConvertToHLS
+from django.core.management.base import BaseCommand, CommandError
+from utils.convertToHLS import ConvertToHLS, SEGMENT_FORMATS
+from utils.hlsProgress import RUNNING
+from utils.hlsThumbnails import THUMBNAIL_FORMATS, DEFAULT_THUMBNAIL_INTERVAL
 
 class Command(BaseCommand):
     help = "Converts movies to HLS format. If TMDB_ID is given, only converts that one."
@@ -21,10 +23,105 @@ class Command(BaseCommand):
             action="store_false",
             help="Mutes INFO logs, only shows WARNING and ERROR logs",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of concurrent libx264 re-encodes",
+        )
+        parser.add_argument(
+            "--io-workers",
+            type=int,
+            help="Number of concurrent remuxes (-c:v copy). Defaults to --workers",
+        )
+        parser.add_argument(
+            "--abr",
+            action="store_true",
+            help="Encode an adaptive bitrate ladder with a master playlist instead of a single rendition",
+        )
+        parser.add_argument(
+            "--ladder",
+            type=str,
+            help="Comma separated rendition heights for --abr, e.g. 1080,720,480",
+        )
+        parser.add_argument(
+            "--deep",
+            action="store_true",
+            help="Run ffprobe on existing HLS output whose playlist duration looks wrong",
+        )
+        parser.add_argument(
+            "--segment-format",
+            choices=SEGMENT_FORMATS,
+            default="ts",
+            help="Segment container: MPEG-TS or fragmented MP4 (CMAF). Movie.hls_segment_format overrides it per movie",
+        )
+        parser.add_argument(
+            "--thumbnails",
+            action="store_true",
+            help="Also generate seek preview sprite sheets and a WebVTT thumbnail track, for already converted movies too",
+        )
+        parser.add_argument(
+            "--thumbnail-interval",
+            type=int,
+            default=DEFAULT_THUMBNAIL_INTERVAL,
+            help="Seconds between two seek preview thumbnails",
+        )
+        parser.add_argument(
+            "--thumbnail-format",
+            choices=THUMBNAIL_FORMATS,
+            default="jpg",
+            help="Image format of the thumbnail sprite sheets",
+        )
 
     def handle(self, *args, **options):
         tmdb_id = options.get("tmdb_id")
         force = options.get("force")
         mute = options.get("mute")
-        converter = ConvertToHLS(tmdb_id=tmdb_id, force=force, verbose=mute)
+        workers = options.get("workers")
+        io_workers = options.get("io_workers")
+        abr = options.get("abr")
+        ladder = options.get("ladder")
+        deep = options.get("deep")
+        segment_format = options.get("segment_format")
+        thumbnails = options.get("thumbnails")
+        thumbnail_interval = options.get("thumbnail_interval")
+        thumbnail_format = options.get("thumbnail_format")
+        if thumbnail_interval < 1:
+            raise CommandError("--thumbnail-interval must be at least 1 second")
+        if ladder:
+            try:
+                ladder = [int(height.strip().rstrip("p")) for height in ladder.split(",") if height.strip()]
+            except ValueError:
+                raise CommandError("--ladder must be a comma separated list of heights, e.g. 1080,720,480")
+        logger = logging.getLogger("utils.convertToHLS")
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO if mute else logging.WARNING)
+        try:
+            converter = ConvertToHLS(
+                tmdb_id=tmdb_id,
+                force=force,
+                workers=workers,
+                io_workers=io_workers,
+                abr=abr,
+                ladder=ladder,
+                deep=deep,
+                segment_format=segment_format,
+                thumbnails=thumbnails,
+                thumbnail_interval=thumbnail_interval,
+                thumbnail_format=thumbnail_format,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        # Only a terminal can redraw the line, and concurrent jobs would overwrite each other's
+        if self.stdout.isatty() and converter.workers == 1 and converter.io_workers == 1:
+            converter.on_progress = self.print_progress
         converter.start()
+
+    def print_progress(self, progress):
+        if progress["state"] != RUNNING:
+            self.stdout.write(f"\rProgress: {progress['percent']:.1f}% - Conversion {progress['state']}")
+        elif progress["duration"]:
+            # Overwrite the same line
+            self.stdout.write(f"\rProgress: {progress['percent']:.1f}% ({progress['position']:.1f}s)", ending="")
+            self.stdout.flush()
@@ -1,7 +1,5 @@
 import os
-import json
 import asyncio
-import subprocess
 import requests
 import threading
 import logging
@@ -10,6 +8,8 @@ from django.core.management.base import BaseCommand
 from api.models import Movie
 from api.movieSearch import MovieSearch, TMDB
 from utils.convertToHLS import ConvertToHLS
+from utils.mediaProbe import probe_media
+from utils import mediaIndex
 from dotenv import load_dotenv
 
 DOWNLOAD_PATH  = os.environ.get("DOWNLOAD_PATH")
@@ -103,32 +103,16 @@ class Command(BaseCommand):
         except Exception as e:
             logger.warning("Image download failed for %s (%s): %s", movie["title"], tmdb_id, e)
         if created:
-            torrent_path = os.path.join(movie_obj.download_path, "torrent")
-            movie_path = self.get_movie_file(torrent_path)
-            movie_path = os.path.join(torrent_path, movie_path)
-            movie_info = self.get_movie_info(movie_path)
-            movie_obj.duration = movie_info["duration"]
-            movie_obj.save(update_fields=["duration"])
-
-            converter = ConvertToHLS(tmdb_id=tmdb_id) # TODO: redundant call of get_movie_info in here and above. Remove 1
+            movie_path = mediaIndex.get_source_file(movie_obj)
+            movie_info = self.get_movie_info(movie_path) if movie_path else None
+            if movie_info:
+                movie_obj.duration = movie_info["duration"]
+                movie_obj.save(update_fields=["duration"])
+
+            # The converter's probe of the same file is served from the MediaProbe store
+            converter = ConvertToHLS(tmdb_id=tmdb_id)
             converter.start()
 
-    def get_movie_file(self, torrent_path):
-        video_extensions = ['.mp4', '.mkv', '.avi', '.mov']
-        selected_file = None
-        largest_size = 0
-
-        for root, dirs, files in os.walk(torrent_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if any(file_path.lower().endswith(ext) for ext in video_extensions):
-                    file_size = os.path.getsize(file_path)
-                    if file_size > largest_size:
-                        largest_size = file_size
-                        selected_file = file_path
-
-        return selected_file
-
     def download_image(self, url, path):
         try:
             response = requests.get(url, stream=True)
@@ -174,46 +158,4 @@ class Command(BaseCommand):
         return None
 
     def get_movie_info(self, path):
-        cmd = [
-            "ffprobe",
-            "-v", "error",
-            "-show_entries",
-            "format=format_name,duration:stream=codec_type,codec_name,bit_rate",
-            "-of", "json",
-            path
-        ]
-
-        try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            data = json.loads(result.stdout)
-
-            # Format (container type)
-            container_format = data.get("format", {}).get("format_name", "Unknown")
-            duration = float(data.get("format", {}).get("duration", 0))
-
-            # Codecs and bitrates
-            video_codec = None
-            audio_codec = None
-            video_bitrate = None
-            audio_bitrate = None
-
-            for stream in data.get("streams", []):
-                if stream.get("codec_type") == "video" and not video_codec:
-                    video_codec = stream.get("codec_name")
-                    video_bitrate = int(stream.get("bit_rate", 0)) if stream.get("bit_rate") else None
-                elif stream.get("codec_type") == "audio" and not audio_codec:
-                    audio_codec = stream.get("codec_name")
-                    audio_bitrate = int(stream.get("bit_rate", 0)) if stream.get("bit_rate") else None
-
-            return {
-                "container": container_format,
-                "duration": duration,
-                "video_codec": video_codec or "None",
-                "video_bitrate": video_bitrate,
-                "audio_codec": audio_codec or "None",
-                "audio_bitrate": audio_bitrate
-            }
-
-        except subprocess.CalledProcessError as e:
-            print("Error running ffprobe:", e.stderr)
-            return None
+        return probe_media(path)
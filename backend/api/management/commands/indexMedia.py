@@ -0,0 +1,41 @@
+import os
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from utils import mediaIndex
+
+DOWNLOAD_PATH = os.environ.get("DOWNLOAD_PATH")
+
+logger = logging.getLogger("movies")
+
+class Command(BaseCommand):
+    help = "Builds or refreshes the media file index of every title in DOWNLOAD_PATH"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of title directories scanned concurrently",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rescan every title, even if its directory mtimes didn't change",
+        )
+
+    def handle(self, *args, **options):
+        workers = options.get("workers")
+        force = options.get("force")
+
+        if not DOWNLOAD_PATH or not os.path.isdir(DOWNLOAD_PATH):
+            raise CommandError(f"DOWNLOAD_PATH is not a directory: {DOWNLOAD_PATH}")
+
+        started = time.monotonic()
+        stats = mediaIndex.scan(DOWNLOAD_PATH, workers=workers, force=force)
+        logger.info(
+            "Indexed %s titles in %.1fs: %s created, %s updated, %s unchanged, %s removed",
+            stats["scanned"], time.monotonic() - started,
+            stats["created"], stats["updated"], stats["unchanged"], stats["removed"],
+        )
@@ -1,9 +1,9 @@
-import os
-import subprocess
 import logging
 
 from django.core.management.base import BaseCommand
 from api.models import Movie
+from utils.mediaProbe import probe_media
+from utils import mediaIndex
 
 logger = logging.getLogger("movies")
 
@@ -45,43 +45,19 @@ class Command(BaseCommand):
                 logger.info("Duration already available for %s (%s)", movie.title, movie.tmdb_id)
                 return
 
-        torrent_path = os.path.join(movie.download_path, "torrent")
-        movie_path = self.get_movie_file(torrent_path)
+        movie_path = mediaIndex.get_source_file(movie)
         if not movie_path:
             logger.warning("Couldn't locate movie file for %s (%s)", movie.title, movie.tmdb_id)
             return
 
-        try:
-            result = subprocess.run(
-                ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-                 "-of", "default=noprint_wrappers=1:nokey=1", movie_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
-            )
-            duration = float(result.stdout.strip())
-        except Exception as e:
-            logger.warning(f"Failed to get duration: {e}")
+        movie_info = probe_media(movie_path)
+        if movie_info:
+            duration = movie_info["duration"]
+        else:
+            logger.warning("Failed to get duration for %s (%s)", movie.title, movie.tmdb_id)
             duration = 1
 
         duration = int(duration)
         movie.duration = duration
         movie.save(update_fields=["duration"])
         logger.info("Set duration (%s) for %s (%s)", duration, movie.title, movie.tmdb_id)
-
-    def get_movie_file(self, torrent_path):
-        video_extensions = ['.mp4', '.mkv', '.avi', '.mov']
-        selected_file = None
-        largest_size = 0
-
-        for root, dirs, files in os.walk(torrent_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if any(file_path.lower().endswith(ext) for ext in video_extensions):
-                    file_size = os.path.getsize(file_path)
-                    if file_size > largest_size:
-                        largest_size = file_size
-                        selected_file = file_path
-
-        return selected_file
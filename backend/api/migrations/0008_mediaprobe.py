@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_auto_20251004_2018'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaProbe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('container', models.CharField(default='Unknown', max_length=100)),
+                ('duration', models.FloatField(default=0.0, help_text='seconds')),
+                ('bit_rate', models.BigIntegerField(blank=True, null=True)),
+                ('video_codec', models.CharField(default='None', max_length=50)),
+                ('video_bitrate', models.BigIntegerField(blank=True, null=True)),
+                ('audio_codec', models.CharField(default='None', max_length=50)),
+                ('audio_bitrate', models.BigIntegerField(blank=True, null=True)),
+                ('width', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.PositiveIntegerField(blank=True, null=True)),
+                ('streams', models.JSONField(blank=True, default=list)),
+                ('probed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_mediaprobe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='movie',
+            name='hls_segment_format',
+            field=models.CharField(blank=True, choices=[('', 'Conversion default'), ('ts', 'MPEG-TS'), ('fmp4', 'Fragmented MP4 (CMAF)')], default='', help_text='HLS segment container, overrides the convertToHLS --segment-format', max_length=4),
+        ),
+    ]
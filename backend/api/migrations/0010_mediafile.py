@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-18 17:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_movie_hls_segment_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('tmdb_id', models.IntegerField(blank=True, db_index=True, help_text='Parsed from the directory name', null=True)),
+                ('source_path', models.CharField(blank=True, default='', max_length=1024)),
+                ('source_size', models.BigIntegerField(blank=True, null=True)),
+                ('source_mtime', models.FloatField(blank=True, null=True)),
+                ('hls_path', models.CharField(blank=True, default='', max_length=1024)),
+                ('playlists', models.JSONField(blank=True, default=list)),
+                ('hls_segments', models.PositiveIntegerField(default=0)),
+                ('images', models.JSONField(blank=True, default=list)),
+                ('dir_mtimes', models.JSONField(blank=True, default=dict, help_text='mtime of every indexed directory, keyed by path relative to path')),
+                ('scanned_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
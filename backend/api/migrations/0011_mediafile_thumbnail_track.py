@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_mediafile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='thumbnail_track',
+            field=models.CharField(blank=True, default='', help_text='WebVTT seek preview track, see utils.hlsThumbnails', max_length=1024),
+        ),
+    ]
@@ -5,6 +5,12 @@ from django.conf import settings
 from django.utils import timezone
 
 class Movie(models.Model):
+    SEGMENT_FORMAT_CHOICES = [
+        ("", "Conversion default"),
+        ("ts", "MPEG-TS"),
+        ("fmp4", "Fragmented MP4 (CMAF)"),
+    ]
+
     tmdb_id = models.IntegerField(primary_key=True)
     imdb = models.CharField(max_length=50, default="", blank=True)
     title = models.CharField(max_length=300)
@@ -18,6 +24,11 @@ class Movie(models.Model):
     duration = models.PositiveIntegerField(default=1,
                                            help_text="seconds",
                                            validators=[MinValueValidator(0)])
+    hls_segment_format = models.CharField(max_length=4,
+                                          choices=SEGMENT_FORMAT_CHOICES,
+                                          default="",
+                                          blank=True,
+                                          help_text="HLS segment container, overrides the convertToHLS --segment-format")
 
     def __str__(self):
         return f"{self.title} {self.release_date} {self.tmdb_id}"
@@ -95,3 +106,64 @@ class PlaylistMovie(models.Model):
             return  # skip if duration unknown
         if self.time_stamp >= int(self.tmdb.duration * self.COMPLETION_THRESHOLD):
             self.mark_completed()
+
+class MediaProbe(models.Model):
+    """
+    Cached ffprobe result for a media file. A row is only valid while the file's
+    size and mtime match, so a replaced or re-downloaded file is probed again.
+    """
+    path = models.CharField(max_length=1024, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    container = models.CharField(max_length=100, default="Unknown")
+    duration = models.FloatField(default=0.0, help_text="seconds")
+    bit_rate = models.BigIntegerField(null=True, blank=True)
+    video_codec = models.CharField(max_length=50, default="None")
+    video_bitrate = models.BigIntegerField(null=True, blank=True)
+    audio_codec = models.CharField(max_length=50, default="None")
+    audio_bitrate = models.BigIntegerField(null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    streams = models.JSONField(default=list, blank=True)
+    probed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.path} ({self.container}, {self.duration}s)"
+
+    def to_video_info(self):
+        return {
+            "container": self.container,
+            "duration": self.duration,
+            "video_codec": self.video_codec,
+            "video_bitrate": self.video_bitrate,
+            "audio_codec": self.audio_codec,
+            "audio_bitrate": self.audio_bitrate,
+            "width": self.width,
+            "height": self.height,
+            "streams": self.streams,
+        }
+
+class MediaFile(models.Model):
+    """
+    Index entry for one title directory under DOWNLOAD_PATH (<tmdb_id>/torrent,
+    hls and images). Built by the indexMedia command and refreshed per title by
+    utils.mediaIndex, which only re-reads the parts whose directory mtimes changed.
+    """
+    path = models.CharField(max_length=1024, unique=True)
+    tmdb_id = models.IntegerField(null=True, blank=True, db_index=True,
+                                  help_text="Parsed from the directory name")
+    source_path = models.CharField(max_length=1024, default="", blank=True)
+    source_size = models.BigIntegerField(null=True, blank=True)
+    source_mtime = models.FloatField(null=True, blank=True)
+    hls_path = models.CharField(max_length=1024, default="", blank=True)
+    playlists = models.JSONField(default=list, blank=True)
+    hls_segments = models.PositiveIntegerField(default=0)
+    thumbnail_track = models.CharField(max_length=1024, default="", blank=True,
+                                       help_text="WebVTT seek preview track, see utils.hlsThumbnails")
+    images = models.JSONField(default=list, blank=True)
+    dir_mtimes = models.JSONField(default=dict, blank=True,
+                                  help_text="mtime of every indexed directory, keyed by path relative to path")
+    scanned_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.path} ({self.source_path or 'no source'}, {self.hls_segments} segments)"
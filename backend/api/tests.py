@@ -1,5 +1,11 @@
+import os
 import uuid
 import json
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+import subprocess
 from unittest.mock import patch
 from django.urls import reverse
 from rest_framework.test import APITestCase, APIClient, APIRequestFactory
@@ -7,9 +13,17 @@ from rest_framework import status
 from rest_framework.request import Request
 from django.contrib.auth import get_user_model
 from api.serializers import MovieSerializer
-from api.models import Movie, PlaylistMovie
+from api.models import Movie, PlaylistMovie, MediaProbe, MediaFile
+from utils.mediaProbe import probe_media
+from utils.hlsValidator import validate_playlist
 from unittest.mock import Mock
 from django.utils import timezone
+from django.test import override_settings
+from utils.redisClient import redis_client
+from utils import jitPackager, hlsProgress, mediaIndex
+from utils.hlsThumbnails import ThumbnailSprites
+from utils.convertToHLS import ConvertToHLS, get_playlist_path
+from utils.hlsCheckpoint import HLSCheckpoint
 
 class MoviePopularsTests(APITestCase):
     def setUp(self):
@@ -119,11 +133,19 @@ class StreamToClientTests(APITestCase):
         self.user = get_user_model().objects.create_user(
             email="user@example.com", password="password123"
         )
-        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1)
+        self.download_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_path)
+        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1, download_path=self.download_path)
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
         self.url = reverse("stream-to-client")
 
+    def write_hls_file(self, name):
+        path = os.path.join(self.download_path, "hls", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("#EXTM3U\n")
+
     def test_missing_tmdb_id(self):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -145,12 +167,348 @@ class StreamToClientTests(APITestCase):
         self.assertIn("hls not available", response.data["error"].lower())
 
     def test_stream_to_client_hls_available(self):
-        with patch("os.path.isfile", return_value=True):
-            response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
         safe_title = "".join(c if c.isalnum() or c in "-_" else "_" for c in self.movie.title)
+        self.write_hls_file(f"{safe_title}.m3u8")
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn(f"{safe_title}.m3u8", response.data["file_path"])
 
+    def test_stream_to_client_returns_thumbnail_track(self):
+        self.write_hls_file("Movie_1.m3u8")
+        self.write_hls_file(os.path.join("thumbnails", "thumbnails.vtt"))
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["thumbnails"].endswith(os.path.join("thumbnails", "thumbnails.vtt")))
+
+    def test_stream_to_client_prefers_master_playlist(self):
+        self.write_hls_file("Movie_1.m3u8")
+        self.write_hls_file("master.m3u8")
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["file_path"].endswith("master.m3u8"))
+
+@override_settings(HLS_JIT_ENABLED=True, HLS_JIT_MAX_JOBS=1)
+class StreamToClientJITTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email="user@example.com", password="password123"
+        )
+        self.download_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_path)
+        for tmdb_id in (1, 2):
+            torrent_path = os.path.join(self.download_path, str(tmdb_id), "torrent")
+            os.makedirs(torrent_path)
+            with open(os.path.join(torrent_path, "movie.mkv"), "wb") as f:
+                f.write(b"\0" * 1000)
+        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1, download_path=os.path.join(self.download_path, "1"))
+        self.other_movie = Movie.objects.create(title="Movie 2", tmdb_id=2, download_path=os.path.join(self.download_path, "2"))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("stream-to-client")
+        redis_client.delete(jitPackager.JOBS_KEY)
+
+        thread_patcher = patch("utils.jitPackager.threading.Thread")
+        self.mock_thread = thread_patcher.start()
+        self.addCleanup(thread_patcher.stop)
+
+    def tearDown(self):
+        redis_client.delete(jitPackager.JOBS_KEY)
+
+    def test_starts_packager(self):
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["playlist_type"], "event")
+        self.mock_thread.return_value.start.assert_called_once()
+
+    def test_packager_started_once(self):
+        self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.mock_thread.return_value.start.call_count, 1)
+
+    def test_packager_jobs_bounded(self):
+        self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        response = self.client.get(self.url, data={"tmdb_id": self.other_movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_missing_source(self):
+        os.remove(os.path.join(self.movie.download_path, "torrent", "movie.mkv"))
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.mock_thread.assert_not_called()
+
+    def test_event_playlist_while_packaging(self):
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        os.makedirs(os.path.dirname(response.data["file_path"]), exist_ok=True)
+        with open(response.data["file_path"], "w") as f:
+            f.write("#EXTM3U\n#EXT-X-PLAYLIST-TYPE:EVENT\n")
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["playlist_type"], "event")
+
+    def write_event_playlist(self):
+        m3u8_path = get_playlist_path(self.movie)
+        os.makedirs(os.path.dirname(m3u8_path), exist_ok=True)
+        with open(m3u8_path, "w") as f:
+            f.write("#EXTM3U\n#EXT-X-PLAYLIST-TYPE:EVENT\n#EXTINF:10.000000,\nMovie_1_0.ts\n")
+        return m3u8_path
+
+    def test_unfinished_event_playlist_packaged_again(self):
+        # Left behind by a packager whose process was killed
+        self.write_event_playlist()
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.mock_thread.return_value.start.assert_called_once()
+
+    def package(self, run_job):
+        m3u8_path = self.write_event_playlist()
+        with patch("utils.jitPackager.ConvertToHLS") as mock_converter, patch("utils.jitPackager.connection"):
+            mock_converter.return_value.prepare.return_value = {"m3u8_path": m3u8_path}
+            mock_converter.return_value.run_job.side_effect = run_job
+            jitPackager._package(self.movie)
+        return m3u8_path
+
+    def test_failed_packager_discards_playlist(self):
+        m3u8_path = self.package(lambda job: {"ok": False})
+        self.assertFalse(os.path.exists(m3u8_path))
+        self.assertFalse(jitPackager.is_packaging(self.movie))
+
+    def test_crashed_packager_discards_playlist(self):
+        def run_job(job):
+            raise OSError("disk full")
+        m3u8_path = self.package(run_job)
+        self.assertFalse(os.path.exists(m3u8_path))
+
+    def test_finished_packager_keeps_playlist(self):
+        m3u8_path = self.package(lambda job: {"ok": True})
+        with open(m3u8_path) as f:
+            self.assertIn("#EXT-X-PLAYLIST-TYPE:VOD", f.read())
+
+class ThumbnailSpritesTests(APITestCase):
+    def setUp(self):
+        self.hls_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hls_path)
+        self.sprites = ThumbnailSprites(self.hls_path, {"width": 1920, "height": 800}, interval=10)
+
+    def test_tile_size_follows_aspect_ratio(self):
+        self.assertEqual((self.sprites.width, self.sprites.height), (160, 66))
+        self.assertIn("scale=160:66,tile=5x5", self.sprites.filter)
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            ThumbnailSprites(self.hls_path, {}, image_format="gif")
+
+    def test_track_maps_intervals_to_tiles(self):
+        self.sprites.prepare()
+        for sheet in (1, 2):
+            with open(os.path.join(self.sprites.path, f"sprite_{sheet:03d}.jpg"), "wb") as f:
+                f.write(b"\xff\xd8")
+
+        self.assertEqual(self.sprites.write_track(265), 27)
+        with open(self.sprites.track_path) as f:
+            track = f.read()
+        self.assertTrue(track.startswith("WEBVTT"))
+        self.assertIn("00:00:10.000 --> 00:00:20.000\nsprite_001.jpg#xywh=160,0,160,66", track)
+        self.assertIn("00:01:00.000 --> 00:01:10.000\nsprite_001.jpg#xywh=160,66,160,66", track)
+        # 26th thumbnail starts the second sheet, the last cue ends with the movie
+        self.assertIn("00:04:10.000 --> 00:04:20.000\nsprite_002.jpg#xywh=0,0,160,66", track)
+        self.assertIn("00:04:20.000 --> 00:04:25.000\nsprite_002.jpg#xywh=160,0,160,66", track)
+
+    def test_no_track_without_sprites(self):
+        self.sprites.prepare()
+        self.assertEqual(self.sprites.write_track(120), 0)
+        self.assertFalse(self.sprites.exists())
+
+    def test_standalone_command_decodes_keyframes_only(self):
+        cmd = self.sprites.command("/downloads/1/torrent/movie.mkv")
+        self.assertEqual(cmd[1:3], ["-skip_frame", "nokey"])
+        self.assertEqual(cmd[-1], os.path.join(self.sprites.path, "sprite_%03d.jpg"))
+
+class MediaIndexTests(APITestCase):
+    def setUp(self):
+        self.download_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_path)
+        self.title_path = os.path.join(self.download_path, "1")
+        self.torrent_path = os.path.join(self.title_path, "torrent", "Movie.2020.1080p")
+        os.makedirs(self.torrent_path)
+        self.write_file(os.path.join(self.torrent_path, "movie.mkv"), 1000)
+        self.write_file(os.path.join(self.torrent_path, "sample.mp4"), 100)
+        self.write_file(os.path.join(self.torrent_path, "movie.nfo"), 5000)
+        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1, download_path=self.title_path)
+
+    def write_file(self, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"\0" * size)
+
+    def test_scan_indexes_titles(self):
+        os.makedirs(os.path.join(self.download_path, "2"))
+        stats = mediaIndex.scan(self.download_path, workers=2)
+        self.assertEqual(stats["scanned"], 2)
+        self.assertEqual(stats["created"], 2)
+
+        entry = MediaFile.objects.get(tmdb_id=1)
+        self.assertEqual(entry.source_path, os.path.join(self.torrent_path, "movie.mkv"))
+        self.assertEqual(entry.source_size, 1000)
+        self.assertEqual(MediaFile.objects.get(tmdb_id=2).source_path, "")
+
+    def test_scan_skips_unchanged_titles(self):
+        mediaIndex.scan(self.download_path)
+        stats = mediaIndex.scan(self.download_path)
+        self.assertEqual(stats["unchanged"], 1)
+        self.assertEqual(stats["updated"], 0)
+
+    def test_scan_removes_deleted_titles(self):
+        mediaIndex.scan(self.download_path)
+        shutil.rmtree(self.title_path)
+        stats = mediaIndex.scan(self.download_path)
+        self.assertEqual(stats["removed"], 1)
+        self.assertFalse(MediaFile.objects.exists())
+
+    def test_refresh_unchanged_doesnt_walk(self):
+        mediaIndex.refresh(self.title_path)
+        with patch("utils.mediaIndex.os.walk") as mock_walk:
+            entry = mediaIndex.refresh(self.title_path)
+        mock_walk.assert_not_called()
+        self.assertEqual(entry.source_size, 1000)
+
+    def test_refresh_picks_up_new_files(self):
+        mediaIndex.refresh(self.title_path)
+        self.write_file(os.path.join(self.torrent_path, "movie.remux.mkv"), 2000)
+        self.write_file(os.path.join(self.title_path, "hls", "Movie_1.m3u8"), 10)
+        self.write_file(os.path.join(self.title_path, "hls", "Movie_1_0.ts"), 188)
+        self.write_file(os.path.join(self.title_path, "images", "poster.jpg"), 10)
+        entry = mediaIndex.refresh(self.title_path)
+        self.assertEqual(entry.source_path, os.path.join(self.torrent_path, "movie.remux.mkv"))
+        self.assertEqual(entry.playlists, ["Movie_1.m3u8"])
+        self.assertEqual(entry.hls_segments, 1)
+        self.assertEqual(entry.images, ["poster.jpg"])
+        self.assertEqual(mediaIndex.get_playlist(entry, "Movie_1"), os.path.join(self.title_path, "hls", "Movie_1.m3u8"))
+
+    def test_refresh_tracks_growing_source(self):
+        mediaIndex.refresh(self.title_path)
+        with open(os.path.join(self.torrent_path, "movie.mkv"), "ab") as f:
+            f.write(b"\0" * 500)
+        self.assertEqual(mediaIndex.refresh(self.title_path).source_size, 1500)
+
+    def test_get_source_file(self):
+        self.assertEqual(mediaIndex.get_source_file(self.movie), os.path.join(self.torrent_path, "movie.mkv"))
+        shutil.rmtree(self.title_path)
+        self.assertIsNone(mediaIndex.get_source_file(self.movie))
+
+    def test_lookup_reads_index(self):
+        mediaIndex.refresh(self.title_path)
+        with patch("utils.mediaIndex.scan_directory") as mock_scan:
+            entry = mediaIndex.lookup(self.movie)
+        mock_scan.assert_not_called()
+        self.assertEqual(entry.source_path, os.path.join(self.torrent_path, "movie.mkv"))
+
+    @override_settings(MEDIA_INDEX_MAX_AGE=60)
+    def test_lookup_refreshes_old_entry(self):
+        mediaIndex.refresh(self.title_path)
+        self.write_file(os.path.join(self.title_path, "hls", "Movie_1.m3u8"), 10)
+        self.assertEqual(mediaIndex.lookup(self.movie).playlists, [])
+
+        MediaFile.objects.update(scanned_at=timezone.now() - timedelta(seconds=61))
+        entry = mediaIndex.lookup(self.movie)
+        self.assertEqual(entry.playlists, ["Movie_1.m3u8"])
+        # Rescanned without changes, trusted again for MEDIA_INDEX_MAX_AGE
+        with patch("utils.mediaIndex.scan_directory") as mock_scan:
+            mediaIndex.lookup(self.movie)
+        mock_scan.assert_not_called()
+
+    def test_lookup_refreshes_missing_playlist(self):
+        self.write_file(os.path.join(self.title_path, "hls", "Movie_1.m3u8"), 10)
+        self.assertEqual(mediaIndex.lookup(self.movie).playlists, ["Movie_1.m3u8"])
+        os.remove(os.path.join(self.title_path, "hls", "Movie_1.m3u8"))
+        entry = mediaIndex.lookup(self.movie)
+        self.assertEqual(entry.playlists, [])
+        self.assertIsNone(mediaIndex.get_playlist(entry, "Movie_1"))
+
+class ConversionProgressTests(APITestCase):
+    def setUp(self):
+        self.staff = get_user_model().objects.create_user(
+            email="staff@example.com", password="password123", is_staff=True
+        )
+        self.user = get_user_model().objects.create_user(
+            email="user@example.com", password="password123"
+        )
+        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1)
+        self.client = APIClient()
+        self.url = reverse("conversion-progress")
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.clear_progress()
+
+    def tearDown(self):
+        self.clear_progress()
+
+    def clear_progress(self):
+        redis_client.delete(hlsProgress.ACTIVE_KEY, hlsProgress.progress_key(self.movie.tmdb_id))
+
+    def feed_block(self, progress, **block):
+        for key, value in block.items():
+            progress.feed(f"{key}={value}")
+        return progress.feed("progress=continue")
+
+    def test_progress_parsed_from_ffmpeg_block(self):
+        progress = hlsProgress.ConversionProgress(self.movie, "encode", 100, self.output_dir)
+        completed = self.feed_block(progress, fps="48.5", total_size="N/A", out_time_us="25000000", speed="2.5x")
+        self.assertTrue(completed)
+        self.assertEqual(progress.position, 25.0)
+        self.assertEqual(progress.percent, 25.0)
+        self.assertEqual(progress.progress["fps"], 48.5)
+        self.assertEqual(progress.progress["speed"], 2.5)
+        self.assertEqual(progress.progress["eta"], 30.0)
+
+    def test_progress_out_time_ms_is_microseconds(self):
+        progress = hlsProgress.ConversionProgress(self.movie, "remux", 100, self.output_dir)
+        self.feed_block(progress, out_time_ms="50000000")
+        self.assertEqual(progress.position, 50.0)
+
+    def test_progress_counts_resumed_offset(self):
+        progress = hlsProgress.ConversionProgress(self.movie, "encode", 100, self.output_dir, offset=40)
+        self.feed_block(progress, out_time_us="10000000")
+        self.assertEqual(progress.percent, 50.0)
+
+    def test_progress_bytes_written_from_output_dir(self):
+        with open(os.path.join(self.output_dir, "Movie_1_0.ts"), "wb") as f:
+            f.write(b"\0" * 188)
+        progress = hlsProgress.ConversionProgress(self.movie, "encode", 100, self.output_dir)
+        self.feed_block(progress, total_size="N/A", out_time_us="1000000")
+        self.assertEqual(progress.progress["bytes_written"], 188)
+
+    def test_progress_published_to_redis(self):
+        progress = hlsProgress.ConversionProgress(self.movie, "encode", 100, self.output_dir)
+        self.feed_block(progress, out_time_us="10000000", speed="1x")
+        self.assertEqual(hlsProgress.get_progress(self.movie.tmdb_id)["percent"], 10.0)
+        progress.finish(True)
+        published = hlsProgress.get_progress()
+        self.assertEqual(len(published), 1)
+        self.assertEqual(published[0]["state"], hlsProgress.FINISHED)
+        self.assertEqual(published[0]["percent"], 100.0)
+
+    def test_endpoint_lists_progress(self):
+        hlsProgress.ConversionProgress(self.movie, "encode", 100, self.output_dir).publish(force=True)
+        self.client.force_authenticate(user=self.staff)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["conversions"][0]["tmdb_id"], self.movie.tmdb_id)
+
+        response = self.client.get(self.url, data={"tmdb_id": self.movie.tmdb_id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["state"], hlsProgress.RUNNING)
+
+    def test_endpoint_unknown_movie(self):
+        self.client.force_authenticate(user=self.staff)
+        response = self.client.get(self.url, data={"tmdb_id": 9999})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_endpoint_staff_only(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
 class MovieSearchTests(APITestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user(
@@ -497,3 +855,399 @@ class MovieSerializerTest(APITestCase):
 
         self.assertIsNone(data["tmdb"])
         mock_tmdb.getMovieByTMDBID.assert_not_called()
+
+class MediaProbeTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "movie.mkv")
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        self.ffprobe_output = json.dumps({
+            "format": {"format_name": "matroska,webm", "duration": "5400.5", "bit_rate": "4000000"},
+            "streams": [
+                {"index": 0, "codec_type": "video", "codec_name": "hevc", "width": 1920, "height": 1080},
+                {"index": 1, "codec_type": "audio", "codec_name": "ac3", "bit_rate": "384000", "channels": 6},
+            ],
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def probe(self):
+        completed = subprocess.CompletedProcess(args=[], returncode=0, stdout=self.ffprobe_output, stderr="")
+        with patch("utils.mediaProbe.subprocess.run", return_value=completed) as mock_run:
+            info = probe_media(self.path)
+        return info, mock_run
+
+    def test_probe_is_cached(self):
+        info, mock_run = self.probe()
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(info["video_codec"], "hevc")
+        self.assertEqual(info["audio_bitrate"], 384000)
+        self.assertEqual(info["height"], 1080)
+        self.assertEqual(len(info["streams"]), 2)
+
+        info, mock_run = self.probe()
+        mock_run.assert_not_called()
+        self.assertEqual(info["duration"], 5400.5)
+
+    def test_modified_file_is_probed_again(self):
+        self.probe()
+        with open(self.path, "ab") as f:
+            f.write(b"\0")
+        _, mock_run = self.probe()
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(MediaProbe.objects.filter(path=self.path).count(), 1)
+
+    def test_missing_file(self):
+        os.remove(self.path)
+        info, mock_run = self.probe()
+        self.assertIsNone(info)
+        mock_run.assert_not_called()
+
+class HLSValidatorTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_playlist(self, name, durations, endlist=True, empty_segment=None, missing_segment=None):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:10", "#EXT-X-PLAYLIST-TYPE:VOD"]
+        for i, duration in enumerate(durations):
+            segment = f"{name}_{i}.ts"
+            lines += [f"#EXTINF:{duration:.6f},", segment]
+            if i == missing_segment:
+                continue
+            with open(os.path.join(self.tmp_dir, segment), "wb") as f:
+                f.write(b"" if i == empty_segment else b"\0" * 188)
+        if endlist:
+            lines.append("#EXT-X-ENDLIST")
+        path = os.path.join(self.tmp_dir, f"{name}.m3u8")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_valid_playlist(self):
+        path = self.write_playlist("movie", [10.0] * 11 + [4.5])
+        result = validate_playlist(path, expected_duration=114)
+        self.assertTrue(result["valid"])
+        self.assertAlmostEqual(result["duration"], 114.5)
+        self.assertEqual(result["segments"], 12)
+
+    def test_missing_segment(self):
+        path = self.write_playlist("movie", [10.0] * 3, missing_segment=1)
+        result = validate_playlist(path)
+        self.assertFalse(result["valid"])
+        self.assertIn("missing segment", result["reason"])
+
+    def test_empty_segment(self):
+        path = self.write_playlist("movie", [10.0] * 3, empty_segment=2)
+        self.assertFalse(validate_playlist(path)["valid"])
+
+    def test_unfinished_playlist(self):
+        path = self.write_playlist("movie", [10.0] * 3, endlist=False)
+        self.assertFalse(validate_playlist(path)["valid"])
+
+    def test_duration_mismatch(self):
+        path = self.write_playlist("movie", [10.0] * 3)
+        with patch("utils.hlsValidator.run_ffprobe") as mock_ffprobe:
+            result = validate_playlist(path, expected_duration=5400)
+        self.assertFalse(result["valid"])
+        mock_ffprobe.assert_not_called()
+
+    def test_deep_validation_only_for_suspicious_playlists(self):
+        path = self.write_playlist("movie", [10.0] * 3)
+        with patch("utils.hlsValidator.run_ffprobe", return_value={"duration": 30.0}) as mock_ffprobe:
+            self.assertTrue(validate_playlist(path, expected_duration=30, deep=True)["valid"])
+            mock_ffprobe.assert_not_called()
+            self.assertFalse(validate_playlist(path, expected_duration=5400, deep=True)["valid"])
+            mock_ffprobe.assert_called_once()
+
+    def test_fmp4_playlist(self):
+        path = self.write_playlist("movie", [10.0] * 3)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        lines.insert(1, '#EXT-X-MAP:URI="init.mp4"')
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        result = validate_playlist(path)
+        self.assertFalse(result["valid"])
+        self.assertIn("init.mp4", result["reason"])
+
+        with open(os.path.join(self.tmp_dir, "init.mp4"), "wb") as f:
+            f.write(b"\0" * 32)
+        self.assertTrue(validate_playlist(path)["valid"])
+
+    def test_master_playlist(self):
+        self.write_playlist("movie_720p", [10.0] * 3)
+        self.write_playlist("movie_480p", [10.0] * 3, missing_segment=0)
+        master = os.path.join(self.tmp_dir, "master.m3u8")
+        with open(master, "w") as f:
+            f.write("#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=3000000\nmovie_720p.m3u8\n")
+        self.assertTrue(validate_playlist(master, expected_duration=30)["valid"])
+        with open(master, "a") as f:
+            f.write("#EXT-X-STREAM-INF:BANDWIDTH=1500000\nmovie_480p.m3u8\n")
+        self.assertFalse(validate_playlist(master, expected_duration=30)["valid"])
+
+class ConvertToHLSPoolTests(APITestCase):
+    def setUp(self):
+        self.movies = [Mock(title=f"Movie {i}", tmdb_id=i) for i in range(4)]
+        self.threads = {}
+
+    def prepare(self, movie):
+        return {"movie": movie, "kind": "encode" if movie.tmdb_id % 2 else "remux"}
+
+    def run_job(self, job):
+        movie = job["movie"]
+        self.threads[movie.tmdb_id] = threading.current_thread().name
+        if movie.tmdb_id == 1:
+            raise RuntimeError("ffmpeg vanished")
+        return {"tmdb_id": movie.tmdb_id, "title": movie.title, "kind": job["kind"], "ok": True,
+                "elapsed": 1, "media_seconds": 60, "bytes_in": 1000}
+
+    def convert_pool(self, converter):
+        with patch.object(converter, "prepare", side_effect=self.prepare), \
+             patch.object(converter, "run_job", side_effect=self.run_job):
+            return converter.convert_pool(self.movies)
+
+    def test_jobs_routed_by_kind(self):
+        self.convert_pool(ConvertToHLS(workers=2, io_workers=3))
+        self.assertTrue(self.threads[1].startswith("hls-encode"))
+        self.assertTrue(self.threads[3].startswith("hls-encode"))
+        self.assertTrue(self.threads[0].startswith("hls-remux"))
+        self.assertTrue(self.threads[2].startswith("hls-remux"))
+
+    def test_failing_job_does_not_stop_batch(self):
+        results = self.convert_pool(ConvertToHLS(workers=2))
+        self.assertEqual(len(results), 4)
+        ok = {result["tmdb_id"]: result["ok"] for result in results}
+        self.assertEqual(ok, {0: True, 1: False, 2: True, 3: True})
+
+    def test_failing_prepare_skips_movie(self):
+        converter = ConvertToHLS(workers=2)
+        def prepare(movie):
+            if movie.tmdb_id == 2:
+                raise OSError("gone")
+            return self.prepare(movie)
+        with patch.object(converter, "prepare", side_effect=prepare), \
+             patch.object(converter, "run_job", side_effect=self.run_job):
+            results = converter.convert_pool(self.movies)
+        self.assertEqual(sorted(result["tmdb_id"] for result in results), [0, 1, 3])
+
+    def test_leaves_logger_alone(self):
+        # The JIT packager builds one per request inside the web process
+        logger = ConvertToHLS().logger
+        handlers, level = list(logger.handlers), logger.level
+        ConvertToHLS()
+        self.assertEqual(logger.handlers, handlers)
+        self.assertEqual(logger.level, level)
+
+    def test_io_workers_alone_use_pool(self):
+        converter = ConvertToHLS(workers=1, io_workers=4)
+        with patch.object(Movie.objects, "all", return_value=self.movies), \
+             patch.object(converter, "convert_pool") as mock_pool, \
+             patch.object(converter, "convert") as mock_convert:
+            converter.start()
+        mock_pool.assert_called_once_with(self.movies)
+        mock_convert.assert_not_called()
+
+    def test_encoder_threads_split_cores(self):
+        with patch("utils.convertToHLS.os.cpu_count", return_value=8):
+            self.assertEqual(ConvertToHLS(workers=1).encoder_threads, 0)
+            self.assertEqual(ConvertToHLS(workers=2).encoder_threads, 4)
+            self.assertEqual(ConvertToHLS(workers=3).encoder_threads, 2)
+            self.assertEqual(ConvertToHLS(workers=16).encoder_threads, 1)
+        with patch("utils.convertToHLS.os.cpu_count", return_value=None):
+            self.assertEqual(ConvertToHLS(workers=2).encoder_threads, 1)
+
+class ABRCommandTests(APITestCase):
+    def setUp(self):
+        self.converter = ConvertToHLS(abr=True, ladder=[720, 480])
+        self.video_info = {"container": "matroska", "video_codec": "hevc", "audio_codec": "ac3", "height": 1080}
+
+    def build(self, video_info):
+        return self.converter.build_abr_ffmpeg_command("/downloads/1/torrent/movie.mkv", "/downloads/1/hls", "Movie_1", video_info)
+
+    def option(self, cmd, name):
+        return cmd[cmd.index(name) + 1]
+
+    def test_renditions_with_audio(self):
+        cmd = self.build(self.video_info)
+        self.assertEqual(self.option(cmd, "-var_stream_map"), "v:0,a:0,name:720p v:1,a:1,name:480p a:2,name:audio")
+        self.assertEqual([cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-map"],
+                         ["[v0out]", "0:a:0", "[v1out]", "0:a:0", "0:a:0"])
+        self.assertEqual(self.option(cmd, "-b:a:2"), "64k")
+
+    def test_renditions_without_audio(self):
+        cmd = self.build({**self.video_info, "audio_codec": "None"})
+        self.assertEqual(self.option(cmd, "-var_stream_map"), "v:0,name:720p v:1,name:480p")
+        self.assertNotIn("0:a:0", cmd)
+        self.assertFalse(any(arg.startswith("-c:a") for arg in cmd))
+
+    def test_single_rendition_without_audio(self):
+        cmd = self.converter.build_ffmpeg_command("/downloads/1/torrent/movie.mkv", "/downloads/1/hls/Movie_1.m3u8",
+                                                  "/downloads/1/hls/Movie_1_%d.ts", {**self.video_info, "audio_codec": "None"})
+        self.assertNotIn("-c:a", cmd)
+        cmd = self.converter.build_ffmpeg_command("/downloads/1/torrent/movie.mkv", "/downloads/1/hls/Movie_1.m3u8",
+                                                  "/downloads/1/hls/Movie_1_%d.ts", self.video_info)
+        self.assertEqual(self.option(cmd, "-c:a"), "aac")
+
+class HLSCheckpointTests(APITestCase):
+    def setUp(self):
+        self.download_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_path)
+        self.hls_path = os.path.join(self.download_path, "hls")
+        os.makedirs(self.hls_path)
+
+    def write_attempt(self, name, durations, start_number=0, endlist=False, empty_segment=None, missing_segment=None,
+                      extension="ts", init_filename=None):
+        """ Playlist and segments ffmpeg leaves behind, an interrupted attempt has no #EXT-X-ENDLIST """
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:10", f"#EXT-X-MEDIA-SEQUENCE:{start_number}"]
+        if init_filename:
+            lines.append(f'#EXT-X-MAP:URI="{init_filename}"')
+            with open(os.path.join(self.hls_path, init_filename), "wb") as f:
+                f.write(b"\0" * 32)
+        for i, duration in enumerate(durations, start_number):
+            segment = f"Movie_1_{i}.{extension}"
+            lines += [f"#EXTINF:{duration:.6f},", segment]
+            if i == missing_segment:
+                continue
+            with open(os.path.join(self.hls_path, segment), "wb") as f:
+                f.write(b"" if i == empty_segment else b"\0" * 188)
+        if endlist:
+            lines.append("#EXT-X-ENDLIST")
+        with open(os.path.join(self.hls_path, name), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def read_playlist(self):
+        with open(os.path.join(self.hls_path, "Movie_1.m3u8")) as f:
+            return f.read().splitlines()
+
+    def test_load_interrupted_attempt(self):
+        self.write_attempt("Movie_1.m3u8", [10.0, 10.0, 8.0])
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        self.assertEqual(checkpoint.absorb_interrupted_attempt(), 3)
+        self.assertFalse(os.path.exists(os.path.join(self.hls_path, "Movie_1.m3u8")))
+
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        self.assertEqual([segment["uri"] for segment in checkpoint.segments], ["Movie_1_0.ts", "Movie_1_1.ts", "Movie_1_2.ts"])
+        self.assertEqual(checkpoint.start_number, 3)
+        self.assertAlmostEqual(checkpoint.offset, 28.0)
+        self.assertEqual(checkpoint.parts, 1)
+        self.assertTrue(checkpoint.attempt_playlist_path().endswith("Movie_1.part1.m3u8"))
+
+    def test_partial_last_segment_dropped(self):
+        self.write_attempt("Movie_1.m3u8", [10.0] * 3, empty_segment=2)
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        self.assertEqual(checkpoint.absorb_interrupted_attempt(), 2)
+        self.assertEqual(checkpoint.start_number, 2)
+        self.assertAlmostEqual(checkpoint.offset, 20.0)
+
+        self.write_attempt("Movie_1.part1.m3u8", [10.0] * 3, start_number=2, missing_segment=4)
+        self.assertEqual(checkpoint.absorb_interrupted_attempt(), 2)
+        self.assertEqual(checkpoint.start_number, 4)
+
+    def test_finished_attempt_not_absorbed(self):
+        self.write_attempt("Movie_1.m3u8", [10.0] * 3, endlist=True)
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        self.assertEqual(checkpoint.absorb_interrupted_attempt(), 0)
+        self.assertEqual(checkpoint.segments, [])
+        self.assertTrue(os.path.exists(os.path.join(self.hls_path, "Movie_1.m3u8")))
+
+    def test_stitch_two_attempts(self):
+        self.write_attempt("Movie_1.m3u8", [10.0] * 3)
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        checkpoint.absorb_interrupted_attempt()
+        self.write_attempt("Movie_1.part1.m3u8", [10.0, 4.5], start_number=3, endlist=True)
+        checkpoint.stitch()
+
+        lines = self.read_playlist()
+        self.assertIn("#EXT-X-MEDIA-SEQUENCE:0", lines)
+        self.assertIn("#EXT-X-PLAYLIST-TYPE:VOD", lines)
+        self.assertEqual([line for line in lines if line.endswith(".ts")], [f"Movie_1_{i}.ts" for i in range(5)])
+        self.assertEqual(lines.count("#EXT-X-DISCONTINUITY"), 1)
+        # The discontinuity opens the first segment of the resumed attempt
+        self.assertEqual(lines.index("#EXT-X-DISCONTINUITY"), lines.index("Movie_1_2.ts") + 1)
+        self.assertEqual(lines[-1], "#EXT-X-ENDLIST")
+
+        result = validate_playlist(os.path.join(self.hls_path, "Movie_1.m3u8"), expected_duration=44.5)
+        self.assertTrue(result["valid"])
+        self.assertEqual(result["segments"], 5)
+        self.assertFalse(os.path.exists(checkpoint.path))
+        self.assertFalse(os.path.exists(os.path.join(self.hls_path, "Movie_1.part1.m3u8")))
+
+    def test_discard(self):
+        self.write_attempt("Movie_1.m3u8", [10.0] * 3)
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        checkpoint.absorb_interrupted_attempt()
+        self.write_attempt("Movie_1.part1.m3u8", [10.0], start_number=3)
+        checkpoint.discard()
+        self.assertEqual((checkpoint.segments, checkpoint.parts), ([], 0))
+        self.assertFalse(os.path.exists(checkpoint.path))
+        self.assertFalse(os.path.exists(os.path.join(self.hls_path, "Movie_1.part1.m3u8")))
+        self.assertEqual(HLSCheckpoint(self.hls_path, "Movie_1").segments, [])
+
+    def test_resume_command(self):
+        source = os.path.join(self.download_path, "torrent", "movie.mkv")
+        os.makedirs(os.path.dirname(source))
+        with open(source, "wb") as f:
+            f.write(b"\0" * 1000)
+        movie = Movie.objects.create(title="Movie 1", tmdb_id=1, download_path=self.download_path)
+        self.write_attempt("Movie_1.m3u8", [10.0, 10.0, 8.5])
+
+        converter = ConvertToHLS()
+        video_info = {"container": "matroska", "video_codec": "h264", "audio_codec": "aac", "duration": 60.0}
+        with patch("utils.convertToHLS.mediaIndex.get_source_file", return_value=source), \
+             patch.object(converter, "get_video_info", return_value=video_info):
+            job = converter.prepare(movie)
+
+        cmd = job["cmd"]
+        self.assertEqual(cmd[cmd.index("-ss") + 1], "28.500000")
+        self.assertLess(cmd.index("-ss"), cmd.index("-i"))
+        self.assertEqual(cmd[cmd.index("-output_ts_offset") + 1], "28.500000")
+        self.assertEqual(cmd[cmd.index("-start_number") + 1], "3")
+        self.assertTrue(cmd[-1].endswith("Movie_1.part1.m3u8"))
+
+    def test_fmp4_command(self):
+        converter = ConvertToHLS(segment_format="fmp4")
+        video_info = {"container": "matroska", "video_codec": "h264", "audio_codec": "aac"}
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        cmd = converter.build_ffmpeg_command("/downloads/1/torrent/movie.mkv", checkpoint.attempt_playlist_path(),
+                                             os.path.join(self.hls_path, "Movie_1_%d.m4s"), video_info,
+                                             segment_format="fmp4", init_filename=checkpoint.attempt_init_filename())
+        self.assertEqual(cmd[cmd.index("-hls_segment_type") + 1], "fmp4")
+        self.assertEqual(cmd[cmd.index("-hls_fmp4_init_filename") + 1], "init.mp4")
+        self.assertTrue(cmd[cmd.index("-hls_segment_filename") + 1].endswith("Movie_1_%d.m4s"))
+
+        cmd = converter.build_ffmpeg_command("/downloads/1/torrent/movie.mkv", checkpoint.attempt_playlist_path(),
+                                             os.path.join(self.hls_path, "Movie_1_%d.ts"), video_info)
+        self.assertNotIn("-hls_segment_type", cmd)
+        self.assertNotIn("-hls_fmp4_init_filename", cmd)
+
+    def test_stitch_fmp4_attempts(self):
+        self.write_attempt("Movie_1.m3u8", [10.0] * 2, extension="m4s", init_filename="init.mp4")
+        checkpoint = HLSCheckpoint(self.hls_path, "Movie_1")
+        checkpoint.absorb_interrupted_attempt()
+        self.assertEqual(checkpoint.attempt_init_filename(), "init_part1.mp4")
+        self.write_attempt("Movie_1.part1.m3u8", [10.0], start_number=2, extension="m4s", init_filename="init_part1.mp4")
+        checkpoint.absorb_interrupted_attempt()
+        self.write_attempt("Movie_1.part2.m3u8", [6.0], start_number=3, endlist=True, extension="m4s",
+                           init_filename="init_part2.mp4")
+        checkpoint.stitch()
+
+        lines = self.read_playlist()
+        self.assertIn("#EXT-X-VERSION:7", lines)
+        self.assertEqual(lines.count("#EXT-X-DISCONTINUITY"), 2)
+        # Every attempt is preceded by the init segment it was written with
+        self.assertEqual(lines[lines.index("#EXT-X-PLAYLIST-TYPE:VOD") + 1], '#EXT-X-MAP:URI="init.mp4"')
+        for part, first_segment in ((1, "Movie_1_2.m4s"), (2, "Movie_1_3.m4s")):
+            index = lines.index(first_segment)
+            self.assertEqual(lines[index - 3:index - 1], ["#EXT-X-DISCONTINUITY", f'#EXT-X-MAP:URI="init_part{part}.mp4"'])
+
+        playlist_path = os.path.join(self.hls_path, "Movie_1.m3u8")
+        self.assertTrue(validate_playlist(playlist_path, expected_duration=36)["valid"])
+        os.remove(os.path.join(self.hls_path, "init_part1.mp4"))
+        result = validate_playlist(playlist_path)
+        self.assertFalse(result["valid"])
+        self.assertIn("init_part1.mp4", result["reason"])
@@ -10,6 +10,7 @@ urlpatterns = [
     path("movie/search-tpb/", views.SearchTPB.as_view(), name="search-tpb"),
     path("movie/populars/", views.MoviePopulars.as_view(), name="movie-populars"),
     path("movie/stream-to-client/", views.StreamToClient.as_view(), name="stream-to-client"),
+    path("movie/conversion-progress/", views.ConversionProgress.as_view(), name="conversion-progress"),
     path("playlist-movies/", views.PlaylistMovieList.as_view(), name="playlist-movie-list"),
     path("playlist-movie-create/", views.PlaylistMovieCreate.as_view(), name="playlist-movie-create"),
     path("playlist-movie/modify/<int:tmdb_id>/", views.PlaylistMovieModify.as_view(), name="playlist-movie-modify"),
@@ -1,18 +1,20 @@
-import os
 import logging
 
 from rest_framework import status, generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.exceptions import ValidationError, NotFound
 from django.contrib.postgres.search import TrigramSimilarity
 from django.shortcuts import get_object_or_404
+from django.conf import settings
 
 from .serializers import MovieSerializer, PlaylistMovieSerializer
 from .models import Movie, PlaylistMovie
 from .movieSearch import MovieSearch, TMDB
 from .utils import serialize_movie_cached
+from utils.convertToHLS import get_playlist_path, get_safe_title
+from utils import jitPackager, hlsProgress, mediaIndex
 
 logger = logging.getLogger("movies")
 tmdb = TMDB()
@@ -160,7 +162,12 @@ class PlaylistMovieCreate(generics.ListCreateAPIView):
 class StreamToClient(APIView):
     permission_classes = [AllowAny]
     """
-    Returns the HLS .m3u8 URL for a movie given its TMDB ID.
+    Returns the HLS .m3u8 URL for a movie given its TMDB ID, looked up in the media file index.
+    The ABR master playlist is returned when the movie was converted with --abr,
+    and the WebVTT seek preview track as "thumbnails" when one was generated.
+    With HLS_JIT_ENABLED, requesting an unconverted movie starts a background
+    packager and returns 202 until its EVENT playlist has been written. An
+    EVENT playlist no packager is writing anymore is packaged again.
     Assumes Nginx serves /var/www/media/ as /media/ URL.
     """
     def get(self, request):
@@ -178,15 +185,63 @@ class StreamToClient(APIView):
         except Movie.DoesNotExist:
             return Response({"error": "Movie not found"}, status=status.HTTP_400_BAD_REQUEST)
 
-        safe_title = "".join(c if c.isalnum() or c in "-_" else "_" for c in movie.title)
-        hls_dir = os.path.join(movie.download_path, "hls")
-        m3u8_filename = f"{safe_title}.m3u8"
-        m3u8_path = os.path.join(hls_dir, m3u8_filename)
+        media_file = mediaIndex.lookup(movie)
+        m3u8_path = mediaIndex.get_playlist(media_file, get_safe_title(movie.title))
+        if not m3u8_path and settings.HLS_JIT_ENABLED and jitPackager.is_packaging(movie):
+            # A packager's playlist shows up before the index hears of it
+            media_file = mediaIndex.lookup(movie, max_age=0)
+            m3u8_path = mediaIndex.get_playlist(media_file, get_safe_title(movie.title))
+
+        # An EVENT playlist nobody is writing anymore was left by a packager that died, package it again
+        unfinished = (
+            m3u8_path
+            and not movie.hls_available
+            and settings.HLS_JIT_ENABLED
+            and jitPackager.is_event_playlist(m3u8_path)
+        )
+        packaging = unfinished and jitPackager.is_packaging(movie)
+
+        if m3u8_path and (not unfinished or packaging):
+            data = {"file_path": m3u8_path}
+            if media_file.thumbnail_track:
+                data["thumbnails"] = media_file.thumbnail_track
+            if packaging:
+                data["playlist_type"] = "event"
+            return Response(data, status=status.HTTP_200_OK)
 
-        if not os.path.isfile(m3u8_path):
+        if not settings.HLS_JIT_ENABLED:
             return Response({"error": "HLS not available"}, status=status.HTTP_404_NOT_FOUND)
 
-        return Response({"file_path": m3u8_path}, status=status.HTTP_200_OK)
+        if not media_file or not media_file.source_path:
+            return Response({"error": "HLS not available"}, status=status.HTTP_404_NOT_FOUND)
+
+        if jitPackager.request_packaging(movie) == jitPackager.BUSY:
+            return Response({"error": "HLS not available, packager busy"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response({"file_path": get_playlist_path(movie), "playlist_type": "event"}, status=status.HTTP_202_ACCEPTED)
+
+class ConversionProgress(APIView):
+    """
+    Staff only. Returns the structured progress the HLS conversions publish to
+    Redis: every conversion of the last hour, or one movie with ?tmdb_id=.
+    Live updates are streamed on the ws/conversion-progress/ socket.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        tmdb_id = request.query_params.get("tmdb_id")
+        if tmdb_id is None:
+            return Response({"conversions": hlsProgress.get_progress()}, status=status.HTTP_200_OK)
+
+        try:
+            tmdb_id = int(tmdb_id)
+        except ValueError:
+            return Response({"error": "Invalid tmdb_id, must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        progress = hlsProgress.get_progress(tmdb_id)
+        if progress is None:
+            return Response({"error": "No conversion progress for this movie"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress, status=status.HTTP_200_OK)
 
 class ShowAvailableMovies(APIView):
     """Return a paginated JSON of the movies available on the server"""
@@ -14,6 +14,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from channels.auth import AuthMiddlewareStack
 import rooms.routing
+import api.routing
 from .middleware.customMiddleware import JWTAuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movie.settings')
@@ -23,7 +24,7 @@ application = ProtocolTypeRouter({
     "websocket": AllowedHostsOriginValidator(
         JWTAuthMiddlewareStack(
             URLRouter(
-                rooms.routing.websocket_urlpatterns
+                rooms.routing.websocket_urlpatterns + api.routing.websocket_urlpatterns
             )
         )
     )
@@ -4,6 +4,9 @@ from django.conf import settings
 from channels.sessions import CookieMiddleware
 from channels.db import database_sync_to_async
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rooms import resume
 
 import logging
 
@@ -13,6 +16,11 @@ class JWTAuthMiddleware:
     """
     Custom middleware for JWT authentication. Must be wrapped in CookieMiddleware.
     Adds user to scope if they have a valid JWT.
+
+    A room socket reconnecting with a valid resume token in its subprotocols
+    (see rooms.resume) skips both: its user is the token's, as a TokenUser,
+    and the token's session goes to scope["resume"] for RoomConsumer, which
+    refuses a token used before.
     """
 
     def __init__(self, inner):
@@ -21,6 +29,15 @@ class JWTAuthMiddleware:
     async def __call__(self, scope, receive, send):
         close_old_connections()
 
+        resume_token = resume.offered_token(scope)
+        if resume_token:
+            session = resume.load(resume_token)
+            # Only for the room it was issued for
+            if session is not None and scope.get("path") == f"/ws/room/{session['r']}/":
+                scope["user"] = TokenUser({api_settings.USER_ID_CLAIM: session["u"]})
+                scope["resume"] = session
+                return await self.inner(scope, receive, send)
+
         # cookies are in scope, since we're wrapped in CookieMiddleware
         jwt_cookie = scope["cookies"].get(settings.SIMPLE_JWT["AUTH_COOKIE"])
 
@@ -37,6 +37,14 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 def str_to_bool(val):
     return val.lower() in ['true', '1', 'yes']
 
+def parse_redis_nodes(val):
+    """ "host:port,host:port" -> [(host, port), ...] """
+    nodes = []
+    for node in filter(None, (part.strip() for part in val.split(","))):
+        host, _, port = node.rpartition(":")
+        nodes.append((host, int(port)))
+    return nodes
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get("DJANGO_SECRET_KEY")
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -135,12 +143,58 @@ ASGI_APPLICATION = "movie.asgi.application"
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Nodes room state and channel groups are spread over by room (see utils.redisClient.node_for),
+# the first one also holds everything else. Defaults to the single REDIS_HOST:REDIS_PORT.
+REDIS_NODES = parse_redis_nodes(os.getenv("REDIS_NODES", "")) or [(REDIS_HOST, REDIS_PORT)]
+# While rooms move after REDIS_NODES changed: the nodes before. Broadcasts still reach the
+# sockets that joined on a room's old node, and its state is taken over from there.
+REDIS_PREVIOUS_NODES = parse_redis_nodes(os.getenv("REDIS_PREVIOUS_NODES", ""))
+# Connections of the async Redis pool consumers share (per process, see utils.redisClient)
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.getenv("REDIS_ASYNC_MAX_CONNECTIONS", 50))
+
+# Clock sync of room sockets (see rooms.clockSync): pings sent right after connecting,
+# then seconds between pings to follow drift. 0 pings disables it.
+ROOM_CLOCK_SYNC_SAMPLES = int(os.getenv("ROOM_CLOCK_SYNC_SAMPLES", 5))
+ROOM_CLOCK_SYNC_INTERVAL = float(os.getenv("ROOM_CLOCK_SYNC_INTERVAL", 30))
+# Periodic position broadcast of playing rooms (see rooms.heartbeat)
+ROOM_HEARTBEAT_ENABLED = str_to_bool(os.getenv("ROOM_HEARTBEAT_ENABLED", "True"))
+# Seconds a room socket's resume token lets it reconnect without authenticating again
+# (see rooms.resume), 0 disables resuming
+ROOM_RESUME_TOKEN_TTL = float(os.getenv("ROOM_RESUME_TOKEN_TTL", 120))
+# Control actions of a room within this many seconds are applied and broadcast together (see rooms.actionCoalescer)
+ROOM_ACTION_COALESCE_WINDOW = float(os.getenv("ROOM_ACTION_COALESCE_WINDOW", 0.1))
+# Token bucket of each room socket's control actions: refill per second, burst size
+ROOM_ACTION_RATE = float(os.getenv("ROOM_ACTION_RATE", 5))
+ROOM_ACTION_BURST = int(os.getenv("ROOM_ACTION_BURST", 10))
+# Presence of room members (see rooms.presence): seconds between renewals of each socket,
+# seconds a member counts as watching after the last one, seconds between writes to RoomUser
+ROOM_PRESENCE_INTERVAL = float(os.getenv("ROOM_PRESENCE_INTERVAL", 10))
+ROOM_PRESENCE_TTL = float(os.getenv("ROOM_PRESENCE_TTL", 30))
+ROOM_PRESENCE_FLUSH_INTERVAL = float(os.getenv("ROOM_PRESENCE_FLUSH_INTERVAL", 15))
+# Seconds between writes of dirty room states from Redis to Room.current_timestamp (see rooms.writeBehind)
+ROOM_STATE_FLUSH_INTERVAL = float(os.getenv("ROOM_STATE_FLUSH_INTERVAL", 10))
+# Frames a room socket queues for a slow client (see rooms.sendQueue), older positions are
+# dropped first and a client that falls further behind is disconnected to resume
+ROOM_SEND_QUEUE_SIZE = int(os.getenv("ROOM_SEND_QUEUE_SIZE", 64))
+# Seconds a room's Redis keys outlive its last activity (join, action, presence renewal)
+ROOM_STATE_TTL = int(os.getenv("ROOM_STATE_TTL", 86400))
+# Rooms without sockets for this many seconds are deactivated and their Redis keys reclaimed
+# by the sweeper (see rooms.sweeper), every ROOM_SWEEP_INTERVAL seconds with sweepRooms --loop
+ROOM_IDLE_TIMEOUT = float(os.getenv("ROOM_IDLE_TIMEOUT", 3600))
+ROOM_SWEEP_INTERVAL = float(os.getenv("ROOM_SWEEP_INTERVAL", 300))
+
+# Just-in-time HLS packaging of movies that haven't been converted yet (see utils.jitPackager)
+HLS_JIT_ENABLED = str_to_bool(os.environ.get("HLS_JIT_ENABLED", "False"))
+HLS_JIT_MAX_JOBS = int(os.environ.get("HLS_JIT_MAX_JOBS", 2))
+# Seconds a media index entry is trusted before a lookup rescans its directory (see utils.mediaIndex)
+MEDIA_INDEX_MAX_AGE = float(os.environ.get("MEDIA_INDEX_MAX_AGE", 60))
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "utils.shardedChannelLayer.RoomShardedChannelLayer",
         "CONFIG": {
-            "hosts": [(REDIS_HOST, REDIS_PORT)],
+            "nodes": REDIS_NODES,
+            "previous_nodes": REDIS_PREVIOUS_NODES,
         },
     },
 }
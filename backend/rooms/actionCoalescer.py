@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import weakref
+from datetime import datetime, timezone
+
+from django.conf import settings
+from redis.exceptions import RedisError
+from rooms import roomState, metrics
+
+logger = logging.getLogger("movies")
+
+# A seek and a play/pause pending together are applied in this order: the seek
+# sets the position, then playing or pausing carries on from it
+APPLY_ORDER = ["seek", "play_state"]
+
+# event loop -> {group_name: RoomActions}
+_rooms = weakref.WeakKeyDictionary()
+
+class RoomActions:
+    """
+    Control actions of one room on this process. The first action after a
+    quiet period is applied and broadcast at once; actions arriving within
+    ROOM_ACTION_COALESCE_WINDOW seconds after it are held, and only the
+    latest of each type is applied when the window closes, with a single
+    broadcast of the resulting state. A user scrubbing the timeline costs two
+    Redis writes and fan-outs per window instead of one per seek.
+    """
+
+    def __init__(self, group_name, key, redis, channel_layer):
+        self.group_name = group_name
+        self.key = key
+        self.redis = redis
+        self.channel_layer = channel_layer
+        self.pending = {}
+        self.window_until = 0.0
+        self.task = None
+
+    async def submit(self, action_type, action_state, action_time, sender):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if action_type in self.pending:
+            metrics.incr("actions_coalesced")
+        self.pending[action_type] = (action_state, action_time, sender)
+
+        if self.task is not None:
+            return
+        if now < self.window_until:
+            self.task = asyncio.create_task(self.flush_later(self.window_until - now))
+            return
+        # Opened before the await, actions arriving meanwhile already wait for the trailing flush
+        self.open_window()
+        try:
+            await self.flush()
+        except RedisError as e:
+            logger.warning(f"Failed to apply actions of {self.group_name}: {e}")
+
+    async def flush_later(self, delay):
+        try:
+            await asyncio.sleep(delay)
+            self.open_window()
+            await self.flush()
+        except RedisError as e:
+            logger.warning(f"Failed to apply actions of {self.group_name}: {e}")
+        finally:
+            self.task = None
+            # Arrived while the flush was writing, they go out when the new window closes
+            if self.pending:
+                delay = max(0.0, self.window_until - asyncio.get_running_loop().time())
+                self.task = asyncio.create_task(self.flush_later(delay))
+
+    def open_window(self):
+        loop = asyncio.get_running_loop()
+        self.window_until = loop.time() + settings.ROOM_ACTION_COALESCE_WINDOW
+        loop.call_later(settings.ROOM_ACTION_COALESCE_WINDOW, self.expire)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        action_types = [t for t in APPLY_ORDER if t in pending] + [t for t in pending if t not in APPLY_ORDER]
+        now = datetime.now(timezone.utc).timestamp()
+        for action_type in action_types:
+            action_state, action_time, sender = pending[action_type]
+            state = await roomState.apply_action(
+                self.redis,
+                self.key,
+                action_type,
+                action_state,
+                action_time=action_time,
+                now=now,
+            )
+
+        metrics.incr("broadcasts")
+        await self.channel_layer.group_send(
+            self.group_name,
+            {
+                "type": "control_state",
+                "timestamp": state["timestamp"],
+                "last_updated": state["last_updated"],
+                "play_state": state["play_state"],
+                "sender": sender
+            }
+        )
+
+    def expire(self):
+        """ Forget the room once its window closed with nothing left to apply """
+        loop = asyncio.get_running_loop()
+        # A later window may have been opened since this expiry was scheduled
+        if self.task is None and not self.pending and loop.time() >= self.window_until - 0.001:
+            rooms = _rooms.get(loop, {})
+            if rooms.get(self.group_name) is self:
+                del rooms[self.group_name]
+
+async def submit(redis, channel_layer, group_name, key, action_type, action_state, action_time=None, sender=None):
+    """
+    Apply a control action to the room, coalesced with the room's other
+    actions on this process (see RoomActions).
+
+    Args:
+        key (str): The room's state hash, on the node `redis` is a client of.
+        action_time (datetime): When the sender seeked, on the server's clock.
+    """
+    rooms = _rooms.setdefault(asyncio.get_running_loop(), {})
+    room = rooms.get(group_name)
+    if room is None:
+        room = rooms[group_name] = RoomActions(group_name, key, redis, channel_layer)
+    await room.submit(action_type, action_state, action_time, sender)
@@ -0,0 +1,78 @@
+from collections import deque, OrderedDict
+
+# Samples the estimate is chosen from, older ones age out so the offset follows clock drift
+WINDOW = 8
+# Seconds between the pings of the burst sent right after connecting
+BURST_SPACING = 0.1
+
+class ClockSync:
+    """
+    Estimates the offset between a client's clock and the server's from
+    ping/pong exchanges on the room socket.
+
+    The server stamps a ping with its send time t0 (kept server side, keyed by
+    ping id), the client answers with its own clock reading tc and the server
+    notes the receive time t1:
+
+        rtt    = t1 - t0
+        offset = tc - (t0 + t1) / 2     (client clock - server clock)
+
+    The estimate is the offset of the sample with the lowest RTT in the last
+    WINDOW samples, whose error is bounded by half its RTT.
+    """
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.samples = deque(maxlen=WINDOW)
+        self.next_id = 0
+
+    def ping(self, now):
+        """ Register a ping sent at `now` (server epoch seconds), returns its id """
+        ping_id = self.next_id
+        self.next_id += 1
+        self.pending[ping_id] = now
+        # Unanswered pings don't pile up
+        while len(self.pending) > WINDOW:
+            self.pending.popitem(last=False)
+        return ping_id
+
+    def pong(self, ping_id, client_time, now):
+        """
+        Add the sample of an answered ping.
+
+        Returns:
+            bool: False for unknown, repeated or malformed pongs.
+        """
+        try:
+            sent = self.pending.pop(int(ping_id))
+            client_time = float(client_time)
+        except (KeyError, TypeError, ValueError):
+            return False
+        rtt = now - sent
+        if rtt < 0:
+            return False
+        self.samples.append((rtt, client_time - (sent + now) / 2))
+        return True
+
+    def restore(self, rtt, offset):
+        """ Start from an earlier estimate, of the socket the client reconnects from """
+        self.samples.append((rtt, offset))
+
+    @property
+    def ready(self):
+        return bool(self.samples)
+
+    @property
+    def offset(self):
+        """ Client clock minus server clock in seconds, 0 until there's a sample """
+        return min(self.samples)[1] if self.samples else 0.0
+
+    @property
+    def rtt(self):
+        return min(self.samples)[0] if self.samples else None
+
+    def to_server_time(self, client_time):
+        return client_time - self.offset
+
+    def to_client_time(self, server_time):
+        return server_time + self.offset
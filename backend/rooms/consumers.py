@@ -1,66 +1,127 @@
 import json
+import time
+import asyncio
 from datetime import datetime, timezone
 from dateutil.parser import isoparse
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from utils.redisClient import redis_client
+from utils.redisClient import get_async_room_redis, get_async_redis, previous_node_for
 from utils import customStatus
 from channels.db import database_sync_to_async
 from django.core.exceptions import ObjectDoesNotExist
-from rooms.models import Room, RoomUser, RoomUserPrivileges
+from rooms.models import Room, RoomUser
+from rooms.exceptions import ResumeTokenReused
+from rooms import roomState, heartbeat, actionCoalescer, metrics, presence, writeBehind, resume
+from rooms.rateLimit import TokenBucket
+from rooms.sendQueue import SendQueue, LATEST, DROPPABLE, RELIABLE
+from rooms.clockSync import ClockSync, BURST_SPACING, WINDOW
 
 class RoomConsumer(AsyncWebsocketConsumer):
+    @staticmethod
+    def user_group_name(room_hash, user_id):
+        """ Group of one user's sockets in a room, for events only that user should get """
+        return f"room_{room_hash}_user_{user_id}"
+
     async def connect(self):
         self.room_hash = f"{self.scope['url_route']['kwargs']['room_hash']}"
         self.group_name = f"room_{self.room_hash}"
+        self.state_key = roomState.state_key(self.room_hash)
         self.user = self.scope["user"]
+        self.user_group = None
+        self.clock = ClockSync()
+        self.clock_synced = False
+        self.clock_task = None
+        self.heartbeat = False
+        self.presence = False
+        self.write_behind = False
+        self.presence_task = None
+        self.position = None
+        self.session_issued = None
+        self.outbox = SendQueue(settings.ROOM_SEND_QUEUE_SIZE)
+        self.writer_task = None
+        self.overflowed = False
+        self.action_bucket = TokenBucket(settings.ROOM_ACTION_RATE, settings.ROOM_ACTION_BURST)
 
         await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        # A browser drops a socket that offered subprotocols and isn't answered one,
+        # even if its resume token is refused and the cookie authenticated it
+        offered = self.scope.get("subprotocols") or []
+        await self.accept(subprotocol=resume.PROTOCOL if resume.PROTOCOL in offered else None)
+        self.writer_task = asyncio.create_task(self.write())
 
         if self.user.is_anonymous:
             await self.close(code=customStatus.WS_4001_UNAUTHORISED)
             return
 
-        try:
-            self.room = await database_sync_to_async(Room.objects.get)(
-                room_hash=self.room_hash
-            )
-            self.room_user= await database_sync_to_async(RoomUser.objects.get)(
-                room=self.room, user=self.user
-            )
-            self.privileges = await database_sync_to_async(RoomUserPrivileges.objects.get)(
-                pk=self.room_user.privileges_id
-            )
-        except ObjectDoesNotExist:
-            await self.close(code=customStatus.WS_4003_FORBIDDEN)
-            return
+        # The node holding the room, see utils.redisClient.node_for
+        self.redis = get_async_room_redis(self.room_hash)
 
-        # Fetch current state from Redis
-        state = redis_client.hgetall(self.group_name)
-        if not state:
-            # Initialize default state
-            redis_client.hset(self.group_name, mapping={
-                "timestamp": 0.0,
-                "last_updated": datetime.now(timezone.utc).isoformat(),
-                "play_state": "True"
-            })
-            state = redis_client.hgetall(self.group_name)
-
-        timestamp = float(state["timestamp"])
-        last_updated = datetime.fromisoformat(state["last_updated"])
-        play_state = state.get("play_state") == "True"
-
-        # Calculate live timestamp
-        diff = (datetime.now(timezone.utc) - last_updated).total_seconds()
-        current_timestamp = timestamp + diff if play_state else timestamp
-        new_last_updated = datetime.now(timezone.utc).isoformat()
-
-        await self.send(json.dumps({
-            "type": "control_state",
-            "timestamp": current_timestamp,
-            "last_updated": new_last_updated,
-            "play_state": play_state
-        }))
+        # A socket reconnecting with its resume token is let in on the token, see rooms.resume.
+        # None: no token, or the user's privileges changed since it was issued.
+        session = self.scope.get("resume")
+        missed = None
+        if session is not None and session["r"] == self.room_hash:
+            try:
+                missed = await resume.missed_updates(self.redis, session)
+            except ResumeTokenReused:
+                # Replayed, clients forget a token once they used it
+                await self.close(code=customStatus.WS_4001_UNAUTHORISED)
+                return
+        if missed is not None:
+            self.room, self.privileges = resume.restore(session)
+            if "c" in session:
+                self.clock.restore(*session["c"])
+                self.clock_synced = True
+        else:
+            # Room, membership and privileges in one query. The privileges are then
+            # kept up to date by privileges_update events, receive never queries them.
+            try:
+                room_user = await database_sync_to_async(
+                    RoomUser.objects.select_related("room", "privileges").get
+                )(room__room_hash=self.room_hash, user_id=self.user.id)
+            except ObjectDoesNotExist:
+                await self.close(code=customStatus.WS_4003_FORBIDDEN)
+                return
+            self.room = room_user.room
+            self.privileges = room_user.privileges
+            if self.privileges is None:
+                await self.close(code=customStatus.WS_4003_FORBIDDEN)
+                return
+            if not self.room.is_active:
+                # Deactivated by rooms.sweeper while nobody was in it
+                await database_sync_to_async(Room.objects.filter(pk=self.room.pk).update)(is_active=True)
+                self.room.is_active = True
+        # Last room_update the socket has, resumed sockets get the ones they missed below
+        self.version = self.room.version
+
+        self.user_group = self.user_group_name(self.room_hash, self.user.id)
+        await self.channel_layer.group_add(self.user_group, self.channel_name)
+
+        previous_node = previous_node_for(self.room_hash)
+        if previous_node is not None:
+            # The room moved to this node, carry on from its state on the old one
+            await roomState.adopt(self.redis, self.state_key, get_async_redis(previous_node))
+        # Redis may have lost the room's state, it's then rehydrated from the last persisted position
+        state = await roomState.join(self.redis, self.state_key, initial=self.room.current_timestamp)
+        await self.send_control_state(state)
+        for event in missed or []:
+            await self.room_update(event)
+        await self.send_session()
+        writeBehind.flusher.join()
+        self.write_behind = True
+
+        if settings.ROOM_HEARTBEAT_ENABLED:
+            heartbeat.join(self.room_hash)
+            self.heartbeat = True
+
+        if settings.ROOM_CLOCK_SYNC_SAMPLES > 0:
+            # A resumed socket follows drift from the estimate it had, without a burst
+            burst = 0 if self.clock_synced else settings.ROOM_CLOCK_SYNC_SAMPLES
+            self.clock_task = asyncio.create_task(self.clock_sync(burst))
+
+        await presence.connect(self.redis, self.room_hash, self.user.id)
+        self.presence = True
+        self.presence_task = asyncio.create_task(self.presence_heartbeat())
 
     async def receive(self, text_data):
         data = json.loads(text_data)
@@ -68,68 +129,176 @@ class RoomConsumer(AsyncWebsocketConsumer):
         action_state = data.get("action_state")
         action_time = data.get("action_time")
 
-        # Fetch current state
-        state = redis_client.hgetall(self.group_name)
-        timestamp = float(state.get("timestamp", 0.0))
-        last_updated = datetime.fromisoformat(
-            state.get("last_updated", datetime.now(timezone.utc).isoformat())
-        )
-        play_state = state.get("play_state", "False") == "True"
+        if action_type == "clock_pong":
+            await self.clock_pong(data)
+            return
 
-        now = datetime.now(timezone.utc)
+        if action_type == "position":
+            # Kept for the next presence heartbeat, any member reports their own
+            try:
+                self.position = float(action_state)
+            except (TypeError, ValueError):
+                pass
+            return
 
         # Update server state based on action
         if (self.privileges.play_pause):
+            if not self.action_bucket.take():
+                # Dropped: the sender is corrected by the next broadcast
+                metrics.incr("actions_rate_limited")
+                return
+            metrics.incr("actions_received")
+
+            now = datetime.now(timezone.utc).timestamp()
             if action_type == "seek":
-                timestamp = float(action_state)
-                last_updated = now
-                action_time_clean = isoparse(action_time)
-                diff = (now - action_time_clean).total_seconds()
-                timestamp += diff
-
-            elif action_type == "play_state":
-                new_play_state = str(action_state).lower() == "true"
-
-                # If user is pausing -> calculate current timestamp
-                if play_state and not new_play_state:
-                    diff = (now - last_updated).total_seconds()
-                    timestamp += diff  # freeze playback position
-
-                # If user is resuming -> just update last_updated
-                last_updated = now
-                play_state = new_play_state
-
-            # Save updated state
-            redis_client.hset(self.group_name, mapping={
-                "timestamp": timestamp,
-                "last_updated": last_updated.isoformat(),
-                "play_state": str(play_state)
-            })
-
-            # Broadcast to others
-            await self.channel_layer.group_send(
+                # action_time is on the sender's clock, move it to the server's.
+                # A seek can't have happened after it arrived.
+                action_time = min(self.clock.to_server_time(isoparse(action_time).timestamp()), now)
+                action_time = datetime.fromtimestamp(action_time, timezone.utc)
+            else:
+                action_time = None
+            # Applied and broadcast with the room's other actions of the moment
+            await actionCoalescer.submit(
+                self.redis,
+                self.channel_layer,
                 self.group_name,
-                {
-                    "type": "control_state",
-                    "timestamp": timestamp,
-                    "last_updated": last_updated.isoformat(),
-                    "play_state": play_state,
-                    "sender": self.channel_name
-                }
+                self.state_key,
+                action_type,
+                action_state,
+                action_time=action_time,
+                sender=self.channel_name,
             )
+            if self.heartbeat:
+                heartbeat.poke(self.room_hash)
+
+    async def disconnect(self, code):
+        if self.writer_task:
+            self.writer_task.cancel()
+        if self.clock_task:
+            self.clock_task.cancel()
+        if self.heartbeat:
+            heartbeat.leave(self.room_hash)
+        if self.presence_task:
+            self.presence_task.cancel()
+        if self.presence:
+            await presence.disconnect(self.redis, self.room_hash, self.user.id)
+        if self.write_behind:
+            writeBehind.flusher.leave()
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if self.user_group:
+            await self.channel_layer.group_discard(self.user_group, self.channel_name)
+
+    async def clock_sync(self, burst):
+        """
+        Ping the client: a burst of `burst` pings right after connecting for a
+        first estimate, then one every ROOM_CLOCK_SYNC_INTERVAL seconds to follow drift.
+        """
+        for _ in range(burst):
+            await self.send_clock_ping()
+            await asyncio.sleep(BURST_SPACING)
+        if settings.ROOM_CLOCK_SYNC_INTERVAL <= 0:
+            return
+        while True:
+            await asyncio.sleep(settings.ROOM_CLOCK_SYNC_INTERVAL)
+            await self.send_clock_ping()
+
+    async def presence_heartbeat(self):
+        """
+        Renew the user's presence while the socket is open, with the position
+        they last reported, and their resume token before it runs out.
+        """
+        while True:
+            await asyncio.sleep(settings.ROOM_PRESENCE_INTERVAL)
+            await presence.touch(self.redis, self.room_hash, self.user.id, position=self.position)
+            if self.session_issued is not None and time.monotonic() - self.session_issued >= settings.ROOM_RESUME_TOKEN_TTL / 2:
+                await self.send_session()
+
+    async def send_session(self):
+        """ A resume token carrying the socket's current privileges, version and clock estimate """
+        if settings.ROOM_RESUME_TOKEN_TTL <= 0:
+            return
+        token = resume.issue(self.user.id, self.room, self.privileges, self.version, self.clock)
+        self.session_issued = time.monotonic()
+        await self.push(RELIABLE, {
+            "type": "session",
+            "resume_token": token
+        })
+
+    async def push(self, kind, message):
+        """
+        Queue a frame for the writer, see rooms.sendQueue. Handlers return
+        right away instead of waiting on the client, so a slow one can't back
+        up the socket's channel layer queue.
+        """
+        if self.overflowed:
+            return
+        if not self.outbox.put(kind, json.dumps(message)):
+            # Too far behind to catch up, the client reconnects and resumes
+            self.overflowed = True
+            metrics.incr("send_queue_overflows")
+            await self.close(code=customStatus.WS_4008_TOO_SLOW)
+
+    async def write(self):
+        """ Send the queued frames in order, as fast as the client takes them """
+        while True:
+            await self.send(await self.outbox.get())
+
+    async def send_clock_ping(self):
+        ping_id = self.clock.ping(datetime.now(timezone.utc).timestamp())
+        await self.push(DROPPABLE, {
+            "type": "clock_ping",
+            "id": ping_id
+        })
+
+    async def clock_pong(self, data):
+        now = datetime.now(timezone.utc).timestamp()
+        if not self.clock.pong(data.get("id"), data.get("client_time"), now):
+            return
+        # The state sent on connect used the client's own clock, resend it once the burst is in
+        if not self.clock_synced and len(self.clock.samples) >= min(settings.ROOM_CLOCK_SYNC_SAMPLES, WINDOW):
+            self.clock_synced = True
+            await self.send_control_state(await roomState.join(self.redis, self.state_key))
+            # With the estimate, so a resumed socket starts from it
+            await self.send_session()
+
+    async def send_control_state(self, state):
+        # last_updated is on the server's clock, clients compensate with theirs
+        last_updated = self.clock.to_client_time(datetime.fromisoformat(state["last_updated"]).timestamp())
+        await self.push(LATEST, {
+            "type": "control_state",
+            "timestamp": state["timestamp"],
+            "last_updated": datetime.fromtimestamp(last_updated, timezone.utc).isoformat(),
+            "play_state": state["play_state"]
+        })
 
     async def control_state(self, event):
         # if event["sender"] == self.channel_name:
         #     return
-        await self.send(json.dumps({
-            "type": "control_state",
-            "timestamp": event["timestamp"],
-            "last_updated": event["last_updated"],
-            "play_state": event["play_state"]
-        }))
+        if self.heartbeat and event["play_state"]:
+            # Resumed through another process, this one's heartbeat takes over if that one's stops
+            heartbeat.resume(self.room_hash)
+        await self.send_control_state(event)
+
+    async def privileges_update(self, event):
+        # None: the user was removed from the room
+        if event["privileges"] is None:
+            await self.close(code=customStatus.WS_4003_FORBIDDEN)
+            return
+
+        for field, value in event["privileges"].items():
+            setattr(self.privileges, field, value)
+        await self.push(RELIABLE, {
+            "type": "privileges_update",
+            "privileges": event["privileges"]
+        })
+        # Tokens issued before were revoked with the change
+        await self.send_session()
 
     async def room_update(self, event):
-        await self.send(json.dumps({
+        # Only the changed fields, clients fetch a snapshot if they missed a version
+        self.version = max(self.version, event["version"])
+        await self.push(RELIABLE, {
             "type": "room_update",
-            "room": event["room"]
-        }))
+            "version": event["version"],
+            "changes": event["changes"]
+        })
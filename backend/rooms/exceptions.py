@@ -2,3 +2,8 @@ class RoomFullException(Exception):
     def __init__(self, message="The room is full"):
         self.message = message
         super().__init__(self.message)
+
+class ResumeTokenReused(Exception):
+    def __init__(self, message="The resume token was used already"):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,71 @@
+import uuid
+import asyncio
+import logging
+import weakref
+
+from django.conf import settings
+from django.db import DatabaseError
+from channels.db import database_sync_to_async
+from redis.exceptions import RedisError
+from utils.redisClient import get_async_redis
+from rooms import roomState
+
+logger = logging.getLogger("movies")
+
+# The lease outlives the holder's sleep by this much, so it doesn't lapse between flushes
+LEASE_MARGIN = 5
+
+# Lease value of this process' flushers
+INSTANCE_ID = uuid.uuid4().hex
+
+class LeasedFlusher:
+    """
+    Periodically runs a synchronous `flush` (Redis to database, in a thread)
+    while room sockets are open on the event loop, see join/leave. Every
+    process with sockets runs one, but only the holder of the Redis lease
+    `lease_key` flushes, so processes don't write the same rows.
+    """
+
+    def __init__(self, name, lease_key, flush, interval_setting):
+        self.name = name
+        self.lease_key = lease_key
+        self.flush = flush
+        # Read on every round, so tests can override it
+        self.interval_setting = interval_setting
+        # event loop -> sockets on it
+        self._sockets = weakref.WeakKeyDictionary()
+        # event loop -> flusher task
+        self._tasks = weakref.WeakKeyDictionary()
+
+    def join(self):
+        """ A socket opened, starts the flusher of this loop if it isn't running """
+        loop = asyncio.get_running_loop()
+        self._sockets[loop] = self._sockets.get(loop, 0) + 1
+        if loop not in self._tasks:
+            self._tasks[loop] = loop.create_task(self.run(loop))
+
+    def leave(self):
+        """ A socket closed, the flusher stops after its next round once there are none """
+        loop = asyncio.get_running_loop()
+        self._sockets[loop] = self._sockets.get(loop, 0) - 1
+
+    async def run(self, loop):
+        redis = get_async_redis()
+        try:
+            while True:
+                interval = getattr(settings, self.interval_setting)
+                await asyncio.sleep(interval)
+                try:
+                    if await roomState.acquire_lease(redis, self.lease_key, INSTANCE_ID, interval + LEASE_MARGIN):
+                        await database_sync_to_async(self.flush)()
+                except (RedisError, DatabaseError) as e:
+                    logger.warning(f"Failed to flush {self.name}: {e}")
+                # After the flush, so what the last sockets did is written too
+                if self._sockets.get(loop, 0) <= 0:
+                    break
+        finally:
+            self._tasks.pop(loop, None)
+            try:
+                await roomState.release_lease(redis, self.lease_key, INSTANCE_ID)
+            except RedisError:
+                pass
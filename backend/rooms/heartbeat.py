@@ -0,0 +1,170 @@
+import uuid
+import asyncio
+import logging
+import weakref
+from datetime import datetime, timezone
+
+from channels.layers import get_channel_layer
+from redis.exceptions import RedisError
+from utils.redisClient import get_async_room_redis
+from rooms import roomState
+
+logger = logging.getLogger("movies")
+
+# Seconds between two heartbeats of a playing room, by time since its last transition:
+# right after a seek or play clients are still settling, later they only drift slowly
+FAST_INTERVAL = 1
+FAST_PERIOD = 10
+STEADY_INTERVAL = 5
+STEADY_PERIOD = 60
+SLOW_INTERVAL = 15
+# The lease outlives the holder's sleep by this much, so it doesn't lapse between renewals
+LEASE_MARGIN = 5
+
+# Lease value of this process' heartbeats
+INSTANCE_ID = uuid.uuid4().hex
+
+# event loop -> {room_hash: RoomHeartbeat}, one heartbeat per room with sockets on the loop
+_heartbeats = weakref.WeakKeyDictionary()
+
+def interval_for(state, now):
+    """ Seconds to wait before the next heartbeat of a room in `state`, None if it's paused """
+    if state is None or not state["play_state"]:
+        return None
+    since = now - state["changed_at"]
+    if since < FAST_PERIOD:
+        return FAST_INTERVAL
+    if since < STEADY_PERIOD:
+        return STEADY_INTERVAL
+    return SLOW_INTERVAL
+
+class RoomHeartbeat:
+    """
+    Periodically broadcasts the authoritative position of a playing room as a
+    control_state, so viewers that drifted get corrected without anyone acting.
+
+    There's one per room and process (see join/leave), and across processes
+    only the holder of the room's Redis lease broadcasts. The others just
+    renew their claim at the same pace, and take over once the holder is gone.
+
+    A paused room has nothing to broadcast, its heartbeat stops until an
+    action or a control_state of another process resumes it (see poke/resume).
+    """
+
+    def __init__(self, room_hash):
+        self.room_hash = room_hash
+        self.group_name = f"room_{room_hash}"
+        self.state_key = roomState.state_key(room_hash)
+        self.lease_key = f"{self.state_key}:heartbeat"
+        self.sockets = 0
+        self.wake = asyncio.Event()
+        self.task = None
+        self.paused = False
+
+    def start(self):
+        self.paused = False
+        self.task = asyncio.create_task(self.run(self.task))
+
+    async def run(self, previous=None):
+        if previous is not None:
+            # The run that paused releases the lease first, so it doesn't release ours
+            await previous
+        redis = get_async_room_redis(self.room_hash)
+        channel_layer = get_channel_layer()
+        broadcast = True
+        try:
+            while self.sockets > 0:
+                self.wake.clear()
+                interval = await self.tick(redis, channel_layer, broadcast)
+                if interval is None:
+                    if not self.wake.is_set():
+                        self.paused = True
+                        break
+                    # Poked while reading the paused state, read it again
+                    broadcast = False
+                    continue
+                try:
+                    await asyncio.wait_for(self.wake.wait(), interval)
+                    # Woken by an action, which was broadcast already, just re-plan
+                    broadcast = False
+                except asyncio.TimeoutError:
+                    broadcast = True
+        finally:
+            try:
+                await roomState.release_lease(redis, self.lease_key, INSTANCE_ID)
+            except RedisError:
+                pass
+
+    async def tick(self, redis, channel_layer, broadcast):
+        """ Broadcast the room's position if it's playing and this process holds the lease """
+        now = datetime.now(timezone.utc).timestamp()
+        try:
+            state = await roomState.current(redis, self.state_key, now=now)
+            interval = interval_for(state, now)
+            if interval is None:
+                return None
+            holder = await roomState.acquire_lease(redis, self.lease_key, INSTANCE_ID, interval + LEASE_MARGIN)
+        except RedisError as e:
+            logger.warning(f"Room heartbeat of {self.group_name} failed: {e}")
+            return SLOW_INTERVAL
+
+        if holder and broadcast:
+            try:
+                # The position moves on without transitions, have it persisted too
+                await roomState.mark_dirty(redis, self.state_key)
+            except RedisError as e:
+                logger.warning(f"Room heartbeat of {self.group_name} failed: {e}")
+            await channel_layer.group_send(self.group_name, {
+                "type": "control_state",
+                "timestamp": state["timestamp"],
+                "last_updated": state["last_updated"],
+                "play_state": state["play_state"],
+            })
+        return interval
+
+def _rooms():
+    return _heartbeats.setdefault(asyncio.get_running_loop(), {})
+
+def join(room_hash):
+    """ A socket joined the room, starts its heartbeat if it's the first on this process """
+    rooms = _rooms()
+    heartbeat = rooms.get(room_hash)
+    if heartbeat is None:
+        heartbeat = rooms[room_hash] = RoomHeartbeat(room_hash)
+        heartbeat.sockets = 1
+        heartbeat.start()
+    else:
+        heartbeat.sockets += 1
+        resume(room_hash)
+    return heartbeat
+
+def leave(room_hash):
+    """ A socket left the room, the heartbeat stops with the last one """
+    rooms = _rooms()
+    heartbeat = rooms.get(room_hash)
+    if heartbeat is None:
+        return
+    heartbeat.sockets -= 1
+    if heartbeat.sockets <= 0:
+        del rooms[room_hash]
+        heartbeat.wake.set()
+
+def poke(room_hash):
+    """ The room's state changed, re-plan its heartbeat (faster after a seek) or start it again if it was paused """
+    heartbeat = _rooms().get(room_hash)
+    if heartbeat is None:
+        return
+    if heartbeat.paused:
+        heartbeat.start()
+    else:
+        heartbeat.wake.set()
+
+def resume(room_hash):
+    """
+    The room may be playing, start its heartbeat again if it was paused.
+    Unlike poke a running heartbeat is left alone, this is called for every
+    control_state the room's sockets get, including its own broadcasts.
+    """
+    heartbeat = _rooms().get(room_hash)
+    if heartbeat is not None and heartbeat.paused:
+        heartbeat.start()
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import statistics
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+from utils.redisClient import redis_client, get_async_redis
+from rooms import roomState
+
+KEY_PREFIX = "room_benchmark_"
+# The probe expects to wake up every TICK seconds, anything later is time the loop was blocked
+TICK = 0.005
+
+class Command(BaseCommand):
+    help = (
+        "Measures event loop latency while many rooms update their state in Redis at once, "
+        "with the blocking client RoomConsumer used to call and with the async client and state script it uses now"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rooms",
+            type=int,
+            default=300,
+            help="Number of concurrent rooms",
+        )
+        parser.add_argument(
+            "--actions",
+            type=int,
+            default=20,
+            help="Play/pause/seek actions per room",
+        )
+        parser.add_argument(
+            "--client",
+            choices=["sync", "async", "both"],
+            default="both",
+            help="Redis client to benchmark",
+        )
+
+    def handle(self, *args, **options):
+        rooms = options.get("rooms")
+        actions = options.get("actions")
+        clients = ["sync", "async"] if options.get("client") == "both" else [options.get("client")]
+
+        for client in clients:
+            result = asyncio.run(self.run(client, rooms, actions))
+            self.stdout.write(
+                f"{client:>5}: {result['actions']} actions in {result['elapsed']:.2f}s "
+                f"({result['actions'] / result['elapsed']:.0f}/s), event loop lag "
+                f"p50 {result['lag_p50'] * 1000:.1f}ms, p99 {result['lag_p99'] * 1000:.1f}ms, "
+                f"max {result['lag_max'] * 1000:.1f}ms"
+            )
+
+    async def run(self, client, rooms, actions):
+        keys = [f"{KEY_PREFIX}{i}" for i in range(rooms)]
+        async_redis = get_async_redis()
+        lags = []
+        done = asyncio.Event()
+
+        async def probe():
+            while not done.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(TICK)
+                lags.append(time.perf_counter() - started - TICK)
+
+        async def room(key):
+            for i in range(actions):
+                if client == "sync":
+                    # The blocking read-modify-write RoomConsumer.receive used to do
+                    state = redis_client.hgetall(key)
+                    redis_client.hset(key, mapping={
+                        "timestamp": float(state.get("timestamp", 0.0)) + 1,
+                        "last_updated": datetime.now(timezone.utc).timestamp(),
+                        "play_state": str(i % 2 == 0),
+                    })
+                else:
+                    await roomState.apply_action(async_redis, key, "play_state", i % 2 == 0)
+                # Yield like a consumer does between two websocket messages
+                await asyncio.sleep(0)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(room(key) for key in keys))
+            elapsed = time.perf_counter() - started
+        finally:
+            done.set()
+            await probe_task
+            await async_redis.delete(*keys)
+            await async_redis.aclose()
+
+        lags.sort()
+        return {
+            "actions": rooms * actions,
+            "elapsed": elapsed,
+            "lag_p50": statistics.median(lags) if lags else 0.0,
+            "lag_p99": lags[int(len(lags) * 0.99)] if lags else 0.0,
+            "lag_max": lags[-1] if lags else 0.0,
+        }
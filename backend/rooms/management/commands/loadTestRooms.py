@@ -0,0 +1,268 @@
+import time
+import json
+import random
+import asyncio
+import statistics
+import tracemalloc
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.test import override_settings
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+from utils.redisClient import room_redis_client
+from rooms import roomState, presence
+from rooms.models import Room
+
+User = get_user_model()
+
+EMAIL_PREFIX = "loadtest-"
+EMAIL_DOMAIN = "@loadtest.invalid"
+# Seeks go to multiples of this, so a control_state's timestamp tells which seek it
+# carries (a broadcast is at most a few seconds past the seek position)
+SEEK_SPACING = 1000
+# Of a room's actions, this share are seeks, the rest toggle play/pause
+SEEK_SHARE = 0.7
+# Sockets connecting at once
+CONNECT_CONCURRENCY = 100
+
+CHANNEL_LAYERS = {
+    "redis": None,  # As configured
+    "memory": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+}
+
+class Command(BaseCommand):
+    help = (
+        "Opens authenticated room sockets through movie.asgi.application and drives play/pause/seek "
+        "traffic through them, then reports control_state fan-out latency, throughput and memory per connection. "
+        "Creates its own users and rooms (loadtest-*) and removes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rooms",
+            type=int,
+            default=100,
+            help="Number of rooms",
+        )
+        parser.add_argument(
+            "--users-per-room",
+            type=int,
+            default=8,
+            help="Sockets per room, the first one (the owner) sends the actions",
+        )
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=30,
+            help="Seconds of traffic",
+        )
+        parser.add_argument(
+            "--action-interval",
+            type=float,
+            default=2,
+            help="Mean seconds between two actions of a room",
+        )
+        parser.add_argument(
+            "--channel-layer",
+            choices=list(CHANNEL_LAYERS),
+            default="redis",
+            help="Channel layer, the configured Redis one or in-memory (a single process only)",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed of the action schedule, the same seed replays the same traffic",
+        )
+        parser.add_argument(
+            "--origin",
+            default=None,
+            help="Origin header of the sockets, defaults to the first ALLOWED_HOSTS",
+        )
+
+    def handle(self, *args, **options):
+        rooms = options.get("rooms")
+        users_per_room = options.get("users_per_room")
+        layers = CHANNEL_LAYERS[options.get("channel_layer")]
+        origin = options.get("origin") or f"http://{settings.ALLOWED_HOSTS[0]}"
+
+        self.stdout.write(f"Creating {rooms} rooms with {users_per_room} users each")
+        room_members = self.create_fixtures(rooms, users_per_room)
+        try:
+            if layers is None:
+                result = asyncio.run(self.run(room_members, origin, options))
+            else:
+                with override_settings(CHANNEL_LAYERS=layers):
+                    result = asyncio.run(self.run(room_members, origin, options))
+        finally:
+            self.remove_fixtures(room_members)
+
+        latencies = sorted(result["latencies"])
+        self.stdout.write(
+            f"{result['connected']}/{result['sockets']} sockets connected in {result['connect_time']:.2f}s, "
+            f"{result['memory'] / max(result['connected'], 1) / 1024:.1f} KiB per connection (server and client side)"
+        )
+        self.stdout.write(
+            f"{result['actions']} actions, {result['messages']} control_state frames received "
+            f"({result['messages'] / result['duration']:.0f}/s) in {result['duration']:.2f}s"
+        )
+        if latencies:
+            self.stdout.write(
+                f"fan-out latency p50 {statistics.median(latencies) * 1000:.1f}ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, "
+                f"max {latencies[-1] * 1000:.1f}ms over {len(latencies)} deliveries"
+            )
+        else:
+            self.stdout.write("fan-out latency: no seek was delivered")
+
+    def create_fixtures(self, rooms, users_per_room):
+        """ Users and rooms of the run, the first user of each room owns it """
+        password = make_password(None)
+        users = User.objects.bulk_create([
+            User(email=f"{EMAIL_PREFIX}{i}{EMAIL_DOMAIN}", password=password)
+            for i in range(rooms * users_per_room)
+        ])
+        room_members = []
+        for i in range(rooms):
+            members = users[i * users_per_room:(i + 1) * users_per_room]
+            room = Room.objects.create(movie_id=None, created_by=members[0], max_users=users_per_room)
+            for user in members[1:]:
+                room.add_user(user)
+            room_members.append((room, members))
+        return room_members
+
+    def remove_fixtures(self, room_members):
+        for room, _ in room_members:
+            redis = room_redis_client(room.room_hash)
+            state_key = roomState.state_key(room.room_hash)
+            redis.delete(state_key, presence.presence_key(room.room_hash), presence.positions_key(room.room_hash))
+            redis.srem(roomState.DIRTY_KEY, state_key)
+            redis.zrem(presence.ROOMS_KEY, room.room_hash)
+        # Rooms and memberships go with their users
+        User.objects.filter(email__startswith=EMAIL_PREFIX, email__endswith=EMAIL_DOMAIN).delete()
+
+    async def run(self, room_members, origin, options):
+        from movie.asgi import application
+
+        rng = random.Random(options.get("seed"))
+        duration = options.get("duration")
+        action_interval = options.get("action_interval")
+        latencies = []
+        messages = 0
+        actions = 0
+        # room index -> {seek sequence: monotonic time it was sent}
+        sent = [{} for _ in room_members]
+
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def connect(room, user):
+            token = AccessToken.for_user(user)
+            communicator = WebsocketCommunicator(
+                application,
+                f"/ws/room/{room.room_hash}/",
+                headers=[
+                    (b"origin", origin.encode()),
+                    (b"cookie", f"{settings.SIMPLE_JWT['AUTH_COOKIE']}={token}".encode()),
+                ],
+            )
+            async with semaphore:
+                try:
+                    connected, _ = await communicator.connect(timeout=30)
+                except asyncio.TimeoutError:
+                    connected = False
+            return communicator if connected else None
+
+        async def read(index, communicator):
+            """ Answers clock pings and times each socket's first delivery of every seek """
+            nonlocal messages
+            seen = set()
+            while True:
+                # Straight from the queue: receive_from() cancels the consumer when it times out
+                output = await communicator.output_queue.get()
+                if output["type"] != "websocket.send":
+                    return
+                data = json.loads(output["text"])
+                if data["type"] == "clock_ping":
+                    await communicator.send_json_to({
+                        "action_type": "clock_pong",
+                        "id": data["id"],
+                        "client_time": datetime.now(timezone.utc).timestamp(),
+                    })
+                elif data["type"] == "control_state":
+                    messages += 1
+                    seq = round(data["timestamp"] / SEEK_SPACING)
+                    if seq in sent[index] and seq not in seen:
+                        seen.add(seq)
+                        latencies.append(time.monotonic() - sent[index][seq])
+
+        async def drive(index, owner):
+            """ The owner's actions: seeks to a fresh position or play/pause, at seeded random intervals """
+            nonlocal actions
+            room_rng = random.Random(rng.random())
+            playing = True
+            seq = 0
+            deadline = time.monotonic() + duration
+            while True:
+                await asyncio.sleep(room_rng.expovariate(1 / action_interval))
+                if time.monotonic() >= deadline:
+                    return
+                if room_rng.random() < SEEK_SHARE:
+                    seq += 1
+                    sent[index][seq] = time.monotonic()
+                    await owner.send_json_to({
+                        "action_type": "seek",
+                        "action_state": seq * SEEK_SPACING,
+                        "action_time": datetime.now(timezone.utc).isoformat(),
+                    })
+                else:
+                    playing = not playing
+                    await owner.send_json_to({"action_type": "play_state", "action_state": playing})
+                actions += 1
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.monotonic()
+        sockets = await asyncio.gather(*(
+            asyncio.gather(*(connect(room, user) for user in members))
+            for room, members in room_members
+        ))
+        connect_time = time.monotonic() - started
+        memory = tracemalloc.get_traced_memory()[0] - memory_before
+        tracemalloc.stop()
+
+        readers = [
+            asyncio.create_task(read(index, communicator))
+            for index, room_sockets in enumerate(sockets)
+            for communicator in room_sockets if communicator is not None
+        ]
+        started = time.monotonic()
+        await asyncio.gather(*(
+            drive(index, room_sockets[0])
+            for index, room_sockets in enumerate(sockets) if room_sockets[0] is not None
+        ))
+        # Let the last broadcasts arrive
+        await asyncio.sleep(1)
+        elapsed = time.monotonic() - started
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*(
+            communicator.disconnect()
+            for room_sockets in sockets for communicator in room_sockets if communicator is not None
+        ), return_exceptions=True)
+
+        return {
+            "sockets": sum(len(members) for _, members in room_members),
+            "connected": sum(communicator is not None for room_sockets in sockets for communicator in room_sockets),
+            "connect_time": connect_time,
+            "memory": memory,
+            "actions": actions,
+            "messages": messages,
+            "duration": elapsed,
+            "latencies": latencies,
+        }
@@ -0,0 +1,60 @@
+import time
+import uuid
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection
+from redis.exceptions import RedisError
+from utils.redisClient import redis_client
+from rooms import roomState, sweeper
+from rooms.flusher import LEASE_MARGIN
+
+logger = logging.getLogger("movies")
+
+_lease_script = redis_client.register_script(roomState.LEASE_SCRIPT)
+
+class Command(BaseCommand):
+    help = (
+        "Deactivates the rooms nobody has had a socket in for ROOM_IDLE_TIMEOUT seconds and reclaims their Redis keys. "
+        "Run it from cron or a systemd timer, or keep it running with --loop (the docker-compose sweeper service)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Sweep every ROOM_SWEEP_INTERVAL seconds until stopped. "
+                 "Only the replica holding the sweeper's Redis lease sweeps, the others stand by",
+        )
+        parser.add_argument(
+            "--legacy",
+            action="store_true",
+            help="Also delete the room_<hash> state hashes of older versions once, then sweep as usual",
+        )
+
+    def handle(self, *args, **options):
+        if options.get("legacy"):
+            removed = sweeper.sweep_legacy()
+            self.stdout.write(f"Removed {removed} legacy room states")
+
+        if not options.get("loop"):
+            self.sweep()
+            return
+
+        owner = uuid.uuid4().hex
+        while True:
+            interval = settings.ROOM_SWEEP_INTERVAL
+            try:
+                lease_ms = int((interval + LEASE_MARGIN) * 1000)
+                if _lease_script(keys=[sweeper.LEASE_KEY], args=[owner, lease_ms]):
+                    self.sweep()
+            except (RedisError, DatabaseError) as e:
+                logger.warning(f"Failed to sweep idle rooms: {e}")
+                # Reconnect on the next round
+                connection.close()
+            time.sleep(interval)
+
+    def sweep(self):
+        swept = sweeper.sweep()
+        self.stdout.write(f"Swept {swept['rooms']} idle rooms, reclaimed {swept['bytes']} bytes of Redis")
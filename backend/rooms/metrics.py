@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import weakref
+from collections import Counter
+
+from redis.exceptions import RedisError
+from utils.redisClient import redis_client, get_async_redis
+
+logger = logging.getLogger("movies")
+
+# Counters of every process add up in this hash
+METRICS_KEY = "room_metrics"
+# Seconds counts are buffered in process before they're added to Redis
+FLUSH_INTERVAL = 1
+
+_pending = Counter()
+# event loop -> flush scheduled on it
+_flushes = weakref.WeakKeyDictionary()
+
+def incr(name, amount=1):
+    """
+    Count an event. Counts are buffered and added to Redis at most every
+    FLUSH_INTERVAL seconds, so counting costs no round trip on the hot path.
+    """
+    _pending[name] += amount
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush()
+        return
+    if loop not in _flushes:
+        _flushes[loop] = loop.create_task(_flush_later(loop))
+
+def _take():
+    counts = dict(_pending)
+    _pending.clear()
+    return counts
+
+def _restore(counts, error):
+    logger.warning(f"Failed to flush room metrics: {error}")
+    _pending.update(counts)
+
+def flush():
+    """ Add the buffered counts to Redis now (synchronous callers, tests) """
+    counts = _take()
+    if not counts:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for name, amount in counts.items():
+            pipe.hincrby(METRICS_KEY, name, amount)
+        pipe.execute()
+    except RedisError as e:
+        _restore(counts, e)
+
+async def _flush_later(loop):
+    try:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        counts = _take()
+        if counts:
+            try:
+                async with get_async_redis().pipeline(transaction=False) as pipe:
+                    for name, amount in counts.items():
+                        pipe.hincrby(METRICS_KEY, name, amount)
+                    await pipe.execute()
+            except RedisError as e:
+                _restore(counts, e)
+    finally:
+        _flushes.pop(loop, None)
+
+def get_metrics():
+    """ Counters of all processes, as of their last flush """
+    return {name: int(value) for name, value in redis_client.hgetall(METRICS_KEY).items()}
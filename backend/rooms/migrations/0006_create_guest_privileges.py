@@ -0,0 +1,24 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:45
+
+from django.db import migrations
+
+
+def create_guest_privileges(apps, schema_editor):
+    """ Rooms get their Guest role on creation now, give it to the rooms that joins haven't yet """
+    Room = apps.get_model("rooms", "Room")
+    RoomUserPrivileges = apps.get_model("rooms", "RoomUserPrivileges")
+    RoomUserPrivileges.objects.bulk_create([
+        RoomUserPrivileges(room_id=room_id, name="Guest")
+        for room_id in Room.objects.exclude(privilege_roles__name="Guest").values_list("id", flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0005_room_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_guest_privileges, migrations.RunPython.noop),
+    ]
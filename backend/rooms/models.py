@@ -1,5 +1,5 @@
 import hashlib
-from django.db import models
+from django.db import models, transaction, connection
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -18,6 +18,8 @@ class Room(models.Model):
     password_hash = models.CharField(max_length=100, blank=True, null=True)
     current_timestamp = models.FloatField(default=0.0)
     max_users = models.PositiveIntegerField(default=8)
+    # Bumped by every room_update broadcast, clients that miss one fetch a snapshot
+    version = models.PositiveIntegerField(default=0)
 
     users = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
@@ -26,33 +28,50 @@ class Room(models.Model):
     )
 
     def add_user(self, user, privileges=None):
-        if self.users.filter(id=user.id).exists():
-            return RoomUser.objects.get(room=self, user=user)
-
-        user_ids = set(self.users.values_list('id', flat=True))
-        user_ids.add(user.id)
-
-        if len(user_ids) > self.max_users:
-            raise RoomFullException()
-
-        if privileges is None:
-            privileges, _ = RoomUserPrivileges.objects.get_or_create(
-                name="Guest",
-                room=self,
-                defaults={
-                    "play_pause": False,
-                    "choose_movie": False,
-                    "add_users": False,
-                    "remove_users": False,
-                    "change_privileges": False
-                }
-            )
-
-        room_user, created = RoomUser.objects.get_or_create(
-            room=self,
-            user=user,
-            defaults={"privileges": privileges}
-        )
+        """
+        Add user to the room with privileges, the room's Guest role by default,
+        or return their RoomUser if they're in already.
+
+        Joins of a room queue up on a lock of its row, and the INSERT itself
+        checks the capacity, so concurrent joins can't exceed max_users. A
+        join costs two queries, three if the user was in the room already.
+
+        Raises:
+            RoomFullException: The room has max_users members.
+        """
+        with transaction.atomic():
+            list(Room.objects.select_for_update().filter(pk=self.pk).values_list("pk"))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {RoomUser._meta.db_table}
+                        (room_id, user_id, privileges_id, joined_at, last_watched_timestamp, is_watching)
+                    SELECT r.id, %s, COALESCE(%s, (
+                        SELECT p.id FROM {RoomUserPrivileges._meta.db_table} p
+                        WHERE p.room_id = r.id AND p.name = 'Guest'
+                    )), %s, 0, false
+                    FROM {Room._meta.db_table} r
+                    WHERE r.id = %s AND (
+                        SELECT COUNT(*) FROM {RoomUser._meta.db_table} u WHERE u.room_id = r.id
+                    ) < r.max_users
+                    ON CONFLICT (room_id, user_id) DO NOTHING
+                    RETURNING id, privileges_id, joined_at
+                    """,
+                    [user.id, privileges.id if privileges else None, timezone.now(), self.pk],
+                )
+                row = cursor.fetchone()
+
+            if row is None:
+                # Either in the room already, or it's full
+                try:
+                    return RoomUser.objects.get(room=self, user=user)
+                except RoomUser.DoesNotExist:
+                    raise RoomFullException()
+
+        room_user_id, privileges_id, joined_at = row
+        room_user = RoomUser(id=room_user_id, room=self, user=user, privileges_id=privileges_id, joined_at=joined_at)
+        if privileges is not None:
+            room_user.privileges = privileges
         return room_user
 
     def remove_user(self, user):
@@ -74,27 +93,30 @@ class Room(models.Model):
             input_string = f"{self.movie_id}-{self.created_by_id}-{timezone.now().isoformat()}"
             self.room_hash = hashlib.sha256(input_string.encode()).hexdigest()[:12]
 
-        super().save(*args, **kwargs)
-
-        # On first save, assign the creator as an owner
-        if is_new:
-            owner_privileges, _ = RoomUserPrivileges.objects.get_or_create(
-                room=self,
-                name="Owner",
-                defaults={
-                    "play_pause": True,
-                    "choose_movie": True,
-                    "add_users": True,
-                    "remove_users": True,
-                    "change_privileges": True
-                }
-            )
-
-            RoomUser.objects.get_or_create(
-                room=self,
-                user=self.created_by,
-                defaults={"privileges": owner_privileges}
-            )
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            # On first save, create the room's roles and assign the creator as an owner.
+            # Guest is the role add_user gives by default.
+            if is_new:
+                owner_privileges, _ = RoomUserPrivileges.objects.bulk_create([
+                    RoomUserPrivileges(
+                        room=self,
+                        name="Owner",
+                        play_pause=True,
+                        choose_movie=True,
+                        add_users=True,
+                        remove_users=True,
+                        change_privileges=True
+                    ),
+                    RoomUserPrivileges(room=self, name="Guest"),
+                ])
+
+                RoomUser.objects.create(
+                    room=self,
+                    user=self.created_by,
+                    privileges=owner_privileges
+                )
 
     def set_password(self, raw_password):
         if raw_password:
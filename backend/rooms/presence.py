@@ -0,0 +1,167 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from utils.redisClient import redis_client, room_redis_client, node_clients
+from rooms import roomState
+from rooms.models import RoomUser
+from rooms.flusher import LeasedFlusher
+
+# Presence of room members lives in Redis, the database only gets it in batches.
+# On the node holding the room (utils.redisClient.node_for):
+#   room:{<hash>}:presence   sorted set, user id -> epoch their presence expires
+#   room:{<hash>}:positions  hash, user id -> last playback position they reported
+#   ROOMS_KEY                sorted set, room hash -> latest expiry of its members,
+#                            the rooms of the node the flusher has to look at
+# Sockets renew their member's expiry every ROOM_PRESENCE_INTERVAL seconds, a
+# member is watching until ROOM_PRESENCE_TTL seconds after the last renewal.
+# Renewals also keep the room's keys from expiring (ROOM_STATE_TTL).
+ROOMS_KEY = "room_presence"
+FLUSHER_LEASE_KEY = "room_presence:flusher"
+# Rows per UPDATE of a flush
+BATCH_SIZE = 500
+
+# KEYS[1] = presence sorted set, KEYS[2] = positions hash
+# ARGV = now
+# Returns flat {user id, "1" watching / "0" expired, position or ""} triples,
+# and forgets the expired members
+FLUSH_SCRIPT = """
+local live = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local result = {}
+for _, user in ipairs(live) do
+    table.insert(result, user)
+    table.insert(result, '1')
+    table.insert(result, redis.call('HGET', KEYS[2], user) or '')
+end
+for _, user in ipairs(expired) do
+    table.insert(result, user)
+    table.insert(result, '0')
+    table.insert(result, redis.call('HGET', KEYS[2], user) or '')
+    redis.call('HDEL', KEYS[2], user)
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+end
+return result
+"""
+
+_flush_script = redis_client.register_script(FLUSH_SCRIPT)
+
+def presence_key(room_hash):
+    return f"room:{{{room_hash}}}:presence"
+
+def positions_key(room_hash):
+    return f"room:{{{room_hash}}}:positions"
+
+def _now():
+    return datetime.now(timezone.utc).timestamp()
+
+def _take_node(redis, now):
+    """ Presence of the rooms of one node, (room_hash, user_id) -> (is_watching, position) """
+    room_hashes = redis.zrange(ROOMS_KEY, 0, -1)
+    if not room_hashes:
+        return {}
+
+    pipe = redis.pipeline(transaction=False)
+    for room_hash in room_hashes:
+        _flush_script(keys=[presence_key(room_hash), positions_key(room_hash)], args=[f"{now:.6f}"], client=pipe)
+    # Rooms whose members all expired are done, a touch since then has raised their score past now
+    pipe.zremrangebyscore(ROOMS_KEY, "-inf", f"{now:.6f}")
+    results = pipe.execute()[:-1]
+
+    presence = {}
+    for room_hash, values in zip(room_hashes, results):
+        for i in range(0, len(values), 3):
+            user_id, is_watching, position = values[i:i + 3]
+            presence[(room_hash, int(user_id))] = (is_watching == "1", float(position) if position else None)
+    return presence
+
+async def touch(redis, room_hash, user_id, position=None, now=None):
+    """
+    Renew the member's presence, and their playback position if they reported
+    one. The room's keys live on for another ROOM_STATE_TTL seconds.
+    """
+    now = now if now is not None else _now()
+    expires = now + settings.ROOM_PRESENCE_TTL
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.zadd(presence_key(room_hash), {user_id: expires})
+        if position is not None:
+            pipe.hset(positions_key(room_hash), user_id, f"{position:.3f}")
+        pipe.zadd(ROOMS_KEY, {room_hash: expires}, gt=True)
+        for key in (presence_key(room_hash), positions_key(room_hash), roomState.state_key(room_hash)):
+            pipe.expire(key, settings.ROOM_STATE_TTL)
+        await pipe.execute()
+
+async def connect(redis, room_hash, user_id):
+    """ A socket of the member opened, they're watching. Starts this process' flusher. """
+    await touch(redis, room_hash, user_id)
+    flusher.join()
+
+async def disconnect(redis, room_hash, user_id):
+    """
+    A socket of the member closed. Their presence expires now, the next flush
+    marks them as no longer watching unless another socket of theirs renews it.
+    """
+    flusher.leave()
+    await redis.zadd(presence_key(room_hash), {user_id: _now()}, xx=True)
+
+def watching(room_hash, now=None):
+    """
+    Members of the room watching right now, read from Redis only.
+
+    Returns:
+        list[dict]: user_id and position (None if they haven't reported one).
+    """
+    now = now if now is not None else _now()
+    redis = room_redis_client(room_hash)
+    user_ids = redis.zrangebyscore(presence_key(room_hash), f"({now:.6f}", "+inf")
+    if not user_ids:
+        return []
+    positions = redis.hmget(positions_key(room_hash), user_ids)
+    return [
+        {
+            "user_id": int(user_id),
+            "position": float(position) if position is not None else None,
+        }
+        for user_id, position in zip(user_ids, positions)
+    ]
+
+def flush(now=None):
+    """
+    Write the presence of every room with members watching or recently gone
+    to RoomUser.is_watching and last_watched_timestamp: one script call per
+    room in a single pipeline per node, one SELECT and batched bulk UPDATEs
+    of the rows that changed.
+
+    Returns:
+        int: RoomUser rows updated.
+    """
+    now = now if now is not None else _now()
+    presence = {}
+    for redis in node_clients():
+        presence.update(_take_node(redis, now))
+    if not presence:
+        return 0
+
+    room_users = (
+        RoomUser.objects
+        .filter(room__room_hash__in={room_hash for room_hash, _ in presence})
+        .select_related("room")
+        .only("id", "user_id", "is_watching", "last_watched_timestamp", "room__room_hash")
+    )
+    changed = []
+    for room_user in room_users:
+        state = presence.get((room_user.room.room_hash, room_user.user_id))
+        if state is None:
+            continue
+        is_watching, position = state
+        if position is None:
+            position = room_user.last_watched_timestamp
+        if (room_user.is_watching, room_user.last_watched_timestamp) != (is_watching, position):
+            room_user.is_watching = is_watching
+            room_user.last_watched_timestamp = position
+            changed.append(room_user)
+    RoomUser.objects.bulk_update(changed, ["is_watching", "last_watched_timestamp"], batch_size=BATCH_SIZE)
+    return len(changed)
+
+flusher = LeasedFlusher("room presence", FLUSHER_LEASE_KEY, flush, "ROOM_PRESENCE_FLUSH_INTERVAL")
@@ -0,0 +1,22 @@
+import time
+
+class TokenBucket:
+    """
+    Allows bursts of up to `capacity` events, refilled at `rate` events per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """ Spend a token, False if the bucket is empty and the event should be dropped """
+        now = now if now is not None else time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -0,0 +1,141 @@
+import json
+import uuid
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from utils.redisClient import room_redis_client
+from rooms.models import Room, RoomUserPrivileges
+from rooms.exceptions import ResumeTokenReused
+
+# Room sockets get a resume token on connect (see RoomConsumer.send_session), a
+# signed and timestamped record of the member's user, room and privileges, valid
+# for ROOM_RESUME_TOKEN_TTL seconds. A socket reconnecting with it is let in on
+# the token alone: no JWT validation, no user lookup, no membership query. It
+# then only gets the room_update deltas it missed, replayed from the room's
+# update log, and a fresh token.
+# The token is offered as the WebSocket subprotocols [PROTOCOL, <token>], a header
+# proxies and access logs leave alone unlike the URL, and lets a single socket in.
+#
+# On the node holding the room (utils.redisClient.node_for):
+#   room:{<hash>}:revoked        hash, user id -> epoch their privileges last changed,
+#                                tokens issued before are refused (see revoke)
+#   room:{<hash>}:updates        list, the latest room_update events as JSON
+#   room:{<hash>}:resumed:<nonce> set once the token with that nonce was used
+# They live for ROOM_RESUME_TOKEN_TTL seconds, as long as a token that needs them.
+SALT = "rooms.resume"
+PROTOCOL = "movies.resume"
+# Subprotocols are HTTP tokens, which can't hold the signer's default ":"
+SEPARATOR = "~"
+# room_update events kept for resumed sockets, further behind they fetch a snapshot
+UPDATE_LOG_SIZE = 20
+
+PRIVILEGE_FIELDS = ["play_pause", "choose_movie", "add_users", "remove_users", "change_privileges"]
+
+def revoked_key(room_hash):
+    return f"room:{{{room_hash}}}:revoked"
+
+def updates_key(room_hash):
+    return f"room:{{{room_hash}}}:updates"
+
+def resumed_key(room_hash, nonce):
+    return f"room:{{{room_hash}}}:resumed:{nonce}"
+
+def _now():
+    return datetime.now(timezone.utc).timestamp()
+
+def _ttl():
+    return max(int(settings.ROOM_RESUME_TOKEN_TTL), 1)
+
+def issue(user_id, room, privileges, version, clock=None):
+    """
+    Resume token of a member's socket.
+
+    Args:
+        version (int): Last room_update version the socket got.
+        clock (ClockSync): The socket's clock estimate, a resumed socket starts from it.
+    """
+    session = {
+        "u": user_id,
+        "r": room.room_hash,
+        "room": room.id,
+        "t": room.current_timestamp,
+        "v": version,
+        "p": {"id": privileges.id, "name": privileges.name, **{field: getattr(privileges, field) for field in PRIVILEGE_FIELDS}},
+        "i": _now(),
+        "n": uuid.uuid4().hex,
+    }
+    if clock is not None and clock.ready:
+        session["c"] = [clock.rtt, clock.offset]
+    return signing.TimestampSigner(salt=SALT, sep=SEPARATOR).sign_object(session, compress=True)
+
+def load(token):
+    """ Session of a resume token, None if it's forged, malformed or expired """
+    if settings.ROOM_RESUME_TOKEN_TTL <= 0:
+        return None
+    try:
+        return signing.TimestampSigner(salt=SALT, sep=SEPARATOR).unsign_object(token, max_age=settings.ROOM_RESUME_TOKEN_TTL)
+    except (signing.BadSignature, ValueError):
+        return None
+
+def offered_token(scope):
+    """ Resume token a socket offers in its subprotocols, None if it offers none """
+    subprotocols = scope.get("subprotocols") or []
+    if len(subprotocols) >= 2 and subprotocols[0] == PROTOCOL:
+        return subprotocols[1]
+    return None
+
+def restore(session):
+    """
+    Room and privileges of a resumed socket, built from its token. Only what
+    RoomConsumer reads of them is set.
+    """
+    room = Room(id=session["room"], room_hash=session["r"], current_timestamp=session["t"], version=session["v"])
+    privileges = RoomUserPrivileges(room_id=session["room"], **session["p"])
+    return room, privileges
+
+async def missed_updates(redis, session):
+    """
+    room_update events a resumed socket missed since its token was issued,
+    oldest first, in one round trip to the room's node. The token is used up.
+
+    Returns:
+        list[dict] | None: None if the member's privileges changed since, the
+            token is no good then.
+
+    Raises:
+        ResumeTokenReused: The token let a socket in already.
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.set(resumed_key(session["r"], session["n"]), 1, nx=True, ex=_ttl())
+        pipe.hget(revoked_key(session["r"]), session["u"])
+        pipe.lrange(updates_key(session["r"]), 0, -1)
+        first_use, revoked_at, updates = await pipe.execute()
+    if not first_use:
+        raise ResumeTokenReused()
+    if revoked_at is not None and float(revoked_at) >= session["i"]:
+        return None
+    updates = [json.loads(update) for update in updates]
+    return [update for update in updates if update["version"] > session["v"]]
+
+def revoke(room_hash, user_ids):
+    """ The members' privileges changed or they were removed, their resume tokens issued so far are refused """
+    user_ids = list(user_ids)
+    if settings.ROOM_RESUME_TOKEN_TTL <= 0 or not user_ids:
+        return
+    now = f"{_now():.6f}"
+    pipe = room_redis_client(room_hash).pipeline(transaction=False)
+    pipe.hset(revoked_key(room_hash), mapping={user_id: now for user_id in user_ids})
+    pipe.expire(revoked_key(room_hash), _ttl())
+    pipe.execute()
+
+def record_update(room_hash, event):
+    """ Keep a room_update event for the room's sockets that resume later """
+    if settings.ROOM_RESUME_TOKEN_TTL <= 0:
+        return
+    pipe = room_redis_client(room_hash).pipeline(transaction=False)
+    pipe.rpush(updates_key(room_hash), json.dumps(event, cls=DjangoJSONEncoder))
+    pipe.ltrim(updates_key(room_hash), -UPDATE_LOG_SIZE, -1)
+    pipe.expire(updates_key(room_hash), _ttl())
+    pipe.execute()
@@ -0,0 +1,232 @@
+import weakref
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# Playback state of a room lives in the Redis hash room:{<hash>} (state_key) on
+# the node holding the room (utils.redisClient.node_for):
+#   timestamp     position (seconds) at last_updated
+#   last_updated  epoch seconds of the last transition
+#   play_state    "True" / "False"
+# Every key of a room carries its hash as a {hash tag}, and the scripts only
+# touch the keys of one room, so each script's keys share a slot. The untagged
+# sets of a node (DIRTY_KEY, rooms.presence.ROOMS_KEY) are never passed to a
+# script, they're updated by plain commands pipelined next to it.
+# Every transition runs as one Lua script, so concurrent actions can't
+# interleave their read and write, and each costs a single round trip.
+# `now` is passed in by the caller, scripts don't read the clock themselves.
+# Room keys expire ROOM_STATE_TTL seconds after the room's last join, transition
+# or presence renewal (see rooms.presence.touch), rooms.sweeper reclaims the keys
+# of idle rooms before that.
+# Transitions add the hash to DIRTY_KEY of the room's node, the set of states
+# rooms.writeBehind still has to persist to Room.current_timestamp.
+DIRTY_KEY = "room_state_dirty"
+
+def state_key(room_hash):
+    return f"room:{{{room_hash}}}"
+
+def room_hash_of(key):
+    """ Room hash of any of the room's keys """
+    return key[key.index("{") + 1:key.index("}")]
+
+# KEYS[1] = state hash
+# ARGV = now, initial position, ttl (s)
+# Returns {live position, play_state}, initialising the hash on first use
+# (a new room, or one whose state Redis lost) at the initial position
+JOIN_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'timestamp', 'last_updated', 'play_state')
+local now = tonumber(ARGV[1])
+local timestamp = tonumber(state[1])
+if not timestamp then
+    redis.call('HSET', KEYS[1], 'timestamp', ARGV[2], 'last_updated', ARGV[1], 'play_state', 'True')
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return {ARGV[2], 'True'}
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local last_updated = tonumber(state[2]) or now
+local play_state = state[3] or 'False'
+if play_state == 'True' then
+    timestamp = timestamp + (now - last_updated)
+end
+return {string.format('%.6f', timestamp), play_state}
+"""
+
+# KEYS[1] = state hash
+# ARGV = now, ttl (s), action_type ("seek" / "play_state"), action_state, action_time (epoch, seek only)
+# Returns {timestamp, last_updated, play_state} after the transition
+ACTION_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'timestamp', 'last_updated', 'play_state')
+local now = tonumber(ARGV[1])
+local timestamp = tonumber(state[1]) or 0
+local last_updated = tonumber(state[2]) or now
+local play_state = state[3] or 'False'
+
+if ARGV[3] == 'seek' then
+    -- The seek happened at action_time on the sender's clock, move on by the time since
+    timestamp = tonumber(ARGV[4]) + (now - tonumber(ARGV[5]))
+    last_updated = now
+elseif ARGV[3] == 'play_state' then
+    local new_play_state = 'False'
+    if string.lower(ARGV[4]) == 'true' then
+        new_play_state = 'True'
+    end
+    -- Freeze the position reached so far, then restart the clock
+    if play_state == 'True' then
+        timestamp = timestamp + (now - last_updated)
+    end
+    last_updated = now
+    play_state = new_play_state
+end
+
+timestamp = string.format('%.6f', timestamp)
+last_updated = string.format('%.6f', last_updated)
+redis.call('HSET', KEYS[1], 'timestamp', timestamp, 'last_updated', last_updated, 'play_state', play_state)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {timestamp, last_updated, play_state}
+"""
+
+# KEYS[1] = lease key
+# ARGV = owner, ttl (ms)
+# Returns 1 if owner holds the lease now (taken or renewed), 0 if someone else does
+LEASE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] = lease key
+# ARGV = owner
+# Deletes the lease only if owner still holds it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] = state hash
+# ARGV = ttl (s), field, value, field, value... of the state on the room's previous node
+# Sets the state unless the room has one here already
+ADOPT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Scripts are bound to the client they were registered on, and there's one async client per event loop
+_scripts = weakref.WeakKeyDictionary()
+
+def _script(redis, source):
+    scripts = _scripts.setdefault(redis, {})
+    if source not in scripts:
+        scripts[source] = redis.register_script(source)
+    return scripts[source]
+
+def _isoformat(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+async def join(redis, key, now=None, initial=0.0):
+    """
+    State a socket joining the room starts from: the live position (moved on
+    by the time played since the last transition) as of now.
+
+    Args:
+        initial (float): Position to start from if the room has no state in
+            Redis, the last one persisted to Room.current_timestamp.
+
+    Returns:
+        dict: timestamp, last_updated (ISO 8601) and play_state.
+    """
+    now = now if now is not None else datetime.now(timezone.utc).timestamp()
+    timestamp, play_state = await _script(redis, JOIN_SCRIPT)(keys=[key], args=[f"{now:.6f}", f"{initial:.6f}", settings.ROOM_STATE_TTL])
+    return {
+        "timestamp": float(timestamp),
+        "last_updated": _isoformat(now),
+        "play_state": play_state == "True",
+    }
+
+async def apply_action(redis, key, action_type, action_state, action_time=None, now=None):
+    """
+    Apply a play/pause ("play_state") or "seek" action to the room state.
+    Other action types leave the state as is.
+
+    Args:
+        action_state: Position to seek to, or the new play state ("true"/"false").
+        action_time (datetime): When the sender seeked, required for "seek".
+
+    Returns:
+        dict: timestamp, last_updated (ISO 8601) and play_state after the action.
+    """
+    now = now if now is not None else datetime.now(timezone.utc).timestamp()
+    args = [f"{now:.6f}", settings.ROOM_STATE_TTL, action_type or "", str(action_state)]
+    if action_type == "seek":
+        args[3] = f"{float(action_state):.6f}"
+        args.append(f"{action_time.timestamp():.6f}")
+    async with redis.pipeline(transaction=False) as pipe:
+        await _script(redis, ACTION_SCRIPT)(keys=[key], args=args, client=pipe)
+        pipe.sadd(DIRTY_KEY, key)
+        (timestamp, last_updated, play_state), _ = await pipe.execute()
+    return {
+        "timestamp": float(timestamp),
+        "last_updated": _isoformat(float(last_updated)),
+        "play_state": play_state == "True",
+    }
+
+async def current(redis, key, now=None):
+    """
+    Live state of the room without initialising it, like join.
+
+    Returns:
+        dict | None: timestamp, last_updated (ISO 8601), play_state and
+            changed_at (epoch of the last transition). None if the room has no state.
+    """
+    now = now if now is not None else datetime.now(timezone.utc).timestamp()
+    timestamp, last_updated, play_state = await redis.hmget(key, "timestamp", "last_updated", "play_state")
+    if timestamp is None:
+        return None
+    changed_at = float(last_updated) if last_updated is not None else now
+    playing = play_state == "True"
+    return {
+        "timestamp": float(timestamp) + (now - changed_at if playing else 0.0),
+        "last_updated": _isoformat(now),
+        "play_state": playing,
+        "changed_at": changed_at,
+    }
+
+async def adopt(redis, key, previous_redis):
+    """
+    Take the room's state over from the node that held it before the nodes
+    changed, unless it has one on its new node already.
+    """
+    state = await previous_redis.hgetall(key)
+    if state:
+        args = [settings.ROOM_STATE_TTL] + [value for field_value in state.items() for value in field_value]
+        await _script(redis, ADOPT_SCRIPT)(keys=[key], args=args)
+
+def live_position(state, now):
+    """
+    Position of a state hash as read from Redis (strings) at `now`, None if
+    the room has no state.
+    """
+    timestamp, last_updated, play_state = state.get("timestamp"), state.get("last_updated"), state.get("play_state")
+    if timestamp is None:
+        return None
+    changed_at = float(last_updated) if last_updated is not None else now
+    return float(timestamp) + (now - changed_at if play_state == "True" else 0.0)
+
+async def mark_dirty(redis, key):
+    """ Have rooms.writeBehind persist the room's position, which moves on while it plays """
+    await redis.sadd(DIRTY_KEY, key)
+
+async def acquire_lease(redis, key, owner, ttl):
+    """ Take or renew the lease `key` for `owner` for `ttl` seconds, True if owner holds it """
+    return bool(await _script(redis, LEASE_SCRIPT)(keys=[key], args=[owner, int(ttl * 1000)]))
+
+async def release_lease(redis, key, owner):
+    await _script(redis, RELEASE_SCRIPT)(keys=[key], args=[owner])
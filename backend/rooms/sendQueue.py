@@ -0,0 +1,81 @@
+import asyncio
+from collections import deque
+
+from rooms import metrics
+
+# How a frame may be treated while the client is behind:
+#   LATEST    only the newest one matters (control_state), a newer one replaces it
+#   DROPPABLE may be dropped to make room (clock_ping, the client answers the next one)
+#   RELIABLE  never dropped (room_update, privileges_update, session)
+LATEST = "latest"
+DROPPABLE = "droppable"
+RELIABLE = "reliable"
+
+class SendQueue:
+    """
+    Bounded queue of the frames a room socket has yet to send, so handlers of
+    channel layer events never wait on a slow client: they queue the frame
+    and return, one writer sends them in order (see get).
+
+    At `capacity` frames, DROPPABLE and LATEST ones give way to newer frames.
+    A queue full of RELIABLE ones overflows, see put.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frames = deque()
+        # The LATEST frame queued, [kind, text], replaced in place by newer ones
+        self.latest = None
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, kind, text):
+        """
+        Queue a frame.
+
+        Returns:
+            bool: False if the queue is full of RELIABLE frames, the client
+                is too far behind to catch up and the frame wasn't queued.
+        """
+        metrics.incr("send_queue_frames")
+        metrics.incr("send_queue_depth", len(self.frames))
+        if kind == LATEST and self.latest is not None:
+            self.latest[1] = text
+            metrics.incr("send_frames_dropped")
+            return True
+
+        if len(self.frames) >= self.capacity and not self._drop():
+            if kind != RELIABLE:
+                metrics.incr("send_frames_dropped")
+                return True
+            return False
+
+        frame = [kind, text]
+        self.frames.append(frame)
+        if kind == LATEST:
+            self.latest = frame
+        self.ready.set()
+        return True
+
+    def _drop(self):
+        """ Drop the oldest DROPPABLE frame, else the LATEST one, False if all are RELIABLE """
+        victim = next((frame for frame in self.frames if frame[0] == DROPPABLE), self.latest)
+        if victim is None:
+            return False
+        self.frames.remove(victim)
+        if victim is self.latest:
+            self.latest = None
+        metrics.incr("send_frames_dropped")
+        return True
+
+    async def get(self):
+        """ Next frame to send, waits for one """
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        frame = self.frames.popleft()
+        if frame is self.latest:
+            self.latest = None
+        return frame[1]
@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import Room, RoomUser, RoomUserPrivileges
 
@@ -33,6 +34,7 @@ class RoomSerializer(serializers.ModelSerializer):
             "password",
             "current_timestamp",
             "max_users",
+            "version",
             "users"
         ]
         read_only_fields = [
@@ -40,13 +42,28 @@ class RoomSerializer(serializers.ModelSerializer):
             "created_at",
             "room_hash",
             "is_active",
+            "version",
             "users",
         ]
 
+    @staticmethod
+    def prefetch(queryset):
+        """ Rooms of queryset with their members, users and privileges fetched in one more query """
+        return queryset.prefetch_related(
+            Prefetch("roomuser_set", queryset=RoomUser.objects.select_related("user", "room", "privileges"))
+        )
+
     def get_users(self, obj):
-        room_users = RoomUser.objects.filter(room=obj)
+        if "roomuser_set" in getattr(obj, "_prefetched_objects_cache", {}):
+            room_users = obj.roomuser_set.all()
+        else:
+            room_users = RoomUser.objects.filter(room=obj).select_related("user", "room", "privileges")
         return RoomUserSerializer(room_users, many=True).data
 
+    def changes(self, instance, fields):
+        """ Representation of only the given fields, the changes of a room_update """
+        return {field: self.fields[field].to_representation(getattr(instance, field)) for field in fields}
+
 class RoomUserSerializer(serializers.ModelSerializer):
     user_email = serializers.EmailField(source="user.email", read_only=True)
     room_hash = serializers.CharField(source="room.room_hash", read_only=True)
@@ -0,0 +1,140 @@
+import logging
+import fnmatch
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from utils.redisClient import redis_client, node_client, node_clients, node_for
+from rooms import roomState, presence, writeBehind, metrics
+from rooms.models import Room
+
+logger = logging.getLogger("movies")
+
+# Rooms nobody has had a socket in for ROOM_IDLE_TIMEOUT seconds are deactivated,
+# and their Redis keys reclaimed once rooms.writeBehind persisted their position. A room's
+# keys expire ROOM_STATE_TTL seconds after its last activity (see rooms.roomState),
+# so what's left of that TTL tells how long it has been idle. A socket opening in
+# a deactivated room activates it again.
+# Sweeps run from the sweepRooms command, every ROOM_SWEEP_INTERVAL seconds with
+# --loop (the sweeper service of docker-compose.yml) or from cron. Running replicas
+# take turns through this lease. Sockets don't sweep, so rooms are swept on quiet servers too.
+LEASE_KEY = "room_sweeper:lease"
+# Rooms per SELECT / UPDATE of a sweep
+BATCH_SIZE = 500
+# Room state used to live in a hash named after the room's channel group, without a TTL.
+# The room_<hash>_user_<id> group names share the prefix, so they are skipped.
+LEGACY_PATTERN = "room_*"
+LEGACY_SKIP_PATTERN = "room_*_user_*"
+
+# KEYS[1] = state hash, KEYS[2] = presence sorted set, KEYS[3] = positions hash
+# ARGV = now, idle ttl (ms, the state is idle at or below it)
+# Returns {0} if the room is in use, else deletes its keys and returns {1, bytes reclaimed}
+RECLAIM_SCRIPT = """
+if redis.call('ZCOUNT', KEYS[2], '(' .. ARGV[1], '+inf') > 0 then
+    return {0}
+end
+if redis.call('PTTL', KEYS[1]) > tonumber(ARGV[2]) then
+    return {0}
+end
+local bytes = 0
+for i = 1, 3 do
+    bytes = bytes + (redis.call('MEMORY', 'USAGE', KEYS[i]) or 0)
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+return {1, bytes}
+"""
+
+_reclaim_script = redis_client.register_script(RECLAIM_SCRIPT)
+
+def sweep(now=None):
+    """
+    Deactivate the active rooms idle for ROOM_IDLE_TIMEOUT seconds and
+    reclaim their Redis keys, BATCH_SIZE rooms at a time: one SELECT, one
+    script call per room in a single pipeline per node and one UPDATE.
+    Dirty room states are written first, so what's reclaimed is persisted.
+
+    Returns:
+        dict: rooms deactivated and bytes of Redis reclaimed.
+    """
+    now = now if now is not None else datetime.now(timezone.utc).timestamp()
+    writeBehind.flush(now)
+    # Rooms created since haven't had the time to be idle
+    created_before = datetime.fromtimestamp(now, timezone.utc) - timedelta(seconds=settings.ROOM_IDLE_TIMEOUT)
+    idle_ttl = max(int((settings.ROOM_STATE_TTL - settings.ROOM_IDLE_TIMEOUT) * 1000), 0)
+
+    swept = {"rooms": 0, "bytes": 0}
+    last_id = 0
+    while True:
+        rooms = list(
+            Room.objects
+            .filter(is_active=True, created_at__lt=created_before, id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "room_hash")[:BATCH_SIZE]
+        )
+        if not rooms:
+            break
+        last_id = rooms[-1][0]
+        rooms_swept, bytes_reclaimed = _sweep_batch(rooms, now, idle_ttl)
+        swept["rooms"] += rooms_swept
+        swept["bytes"] += bytes_reclaimed
+
+    if swept["rooms"]:
+        metrics.incr("rooms_swept", swept["rooms"])
+        metrics.incr("room_bytes_reclaimed", swept["bytes"])
+        logger.info(f"Swept {swept['rooms']} idle rooms, reclaimed {swept['bytes']} bytes of Redis")
+    return swept
+
+def _sweep_batch(rooms, now, idle_ttl):
+    # room hashes by node, the scripts of a node go in one pipeline
+    by_node = {}
+    for room_id, room_hash in rooms:
+        by_node.setdefault(node_for(room_hash), []).append((room_id, room_hash))
+
+    idle = []
+    bytes_reclaimed = 0
+    for node, node_rooms in by_node.items():
+        client = node_client(node)
+        pipe = client.pipeline(transaction=False)
+        for _, room_hash in node_rooms:
+            keys = [roomState.state_key(room_hash), presence.presence_key(room_hash), presence.positions_key(room_hash)]
+            _reclaim_script(keys=keys, args=[f"{now:.6f}", idle_ttl], client=pipe)
+        reclaimed = []
+        for (room_id, room_hash), result in zip(node_rooms, pipe.execute()):
+            if not int(result[0]):
+                continue
+            idle.append(room_id)
+            reclaimed.append(room_hash)
+            bytes_reclaimed += int(result[1])
+
+        # The node's untagged sets are left out of the script, a second round trip drops the rooms from them
+        if reclaimed:
+            pipe = client.pipeline(transaction=False)
+            pipe.srem(roomState.DIRTY_KEY, *(roomState.state_key(room_hash) for room_hash in reclaimed))
+            pipe.zrem(presence.ROOMS_KEY, *reclaimed)
+            pipe.execute()
+
+    if idle:
+        Room.objects.filter(id__in=idle).update(is_active=False)
+    return len(idle), bytes_reclaimed
+
+def sweep_legacy():
+    """
+    Deletes the room_<hash> state hashes older versions left behind, from every node.
+
+    Returns:
+        int: Number of keys deleted.
+    """
+    removed = 0
+    for client in node_clients():
+        batch = []
+        for key in client.scan_iter(match=LEGACY_PATTERN, count=1000, _type="HASH"):
+            if fnmatch.fnmatchcase(key, LEGACY_SKIP_PATTERN):
+                continue
+            batch.append(key)
+            if len(batch) >= BATCH_SIZE:
+                removed += client.unlink(*batch)
+                batch = []
+        if batch:
+            removed += client.unlink(*batch)
+    if removed:
+        logger.info(f"Removed {removed} legacy room states")
+    return removed
@@ -1,10 +1,34 @@
 import json
+import time
+import asyncio
+from unittest import mock
+from datetime import datetime, timedelta, timezone
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from django.urls import reverse
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection, connections
+from asgiref.sync import sync_to_async, async_to_sync
 from django.contrib.auth import get_user_model
 from rooms.models import Room, RoomUser, RoomUserPrivileges
+from rooms.exceptions import RoomFullException
 from api.models import Movie
+from redis.exceptions import RedisError
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from utils import customStatus
+from utils.redisClient import redis_client, get_async_redis, node_for
+from utils.shardedChannelLayer import RoomShardedChannelLayer
+import rooms.routing
+from movie.middleware.customMiddleware import JWTAuthMiddlewareStack
+from rooms import roomState, heartbeat, actionCoalescer, presence, writeBehind, sweeper, resume
+from rooms.rateLimit import TokenBucket
+from rooms.sendQueue import SendQueue, LATEST, DROPPABLE, RELIABLE
+from rooms.clockSync import ClockSync
 
 User = get_user_model()
 
@@ -22,14 +46,17 @@ class ManageRoomTest(APITestCase):
         self.room = Room.objects.create(movie_id=self.movie.tmdb_id, created_by=self.owner, max_users=2)
 
         self.owner_room_user = RoomUser.objects.get(user=self.owner, room=self.room)
-        self.guest_privilege = RoomUserPrivileges.objects.create(
+        # The room's Guest role exists since it was created
+        self.guest_privilege, _ = RoomUserPrivileges.objects.update_or_create(
             room=self.room,
             name="Guest",
-            play_pause=False,
-            choose_movie=False,
-            add_users=False,
-            remove_users=False,
-            change_privileges=False
+            defaults={
+                "play_pause": False,
+                "choose_movie": False,
+                "add_users": False,
+                "remove_users": False,
+                "change_privileges": False,
+            }
         )
         self.room.add_user(self.guest, privileges=self.guest_privilege)
 
@@ -73,6 +100,50 @@ class ManageRoomTest(APITestCase):
         self.assertNotEqual(room.password_hash, "testpass")
         self.assertTrue(room.check_password("testpass"))
 
+    def test_update_broadcasts_changes_with_version(self):
+        url = reverse(self.url_name, kwargs={"room_hash": self.room.room_hash})
+        with mock.patch("rooms.views.get_channel_layer") as get_channel_layer:
+            group_send = get_channel_layer.return_value.group_send = mock.AsyncMock()
+            response = self.client.patch(url, {"max_users": 5, "password": "testpass"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["version"], 1)
+        group_send.assert_awaited_once_with(f"room_{self.room.room_hash}", {
+            "type": "room_update",
+            "version": 1,
+            "changes": {"max_users": 5},
+        })
+
+    def test_update_without_changes_not_broadcast(self):
+        url = reverse(self.url_name, kwargs={"room_hash": self.room.room_hash})
+        with mock.patch("rooms.views.get_channel_layer") as get_channel_layer:
+            response = self.client.patch(url, {"password": "testpass"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        get_channel_layer.assert_not_called()
+        self.assertEqual(Room.objects.get(pk=self.room.pk).version, 0)
+
+class RoomSnapshotViewTest(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.room = Room.objects.create(movie_id=1, created_by=self.owner)
+        for i in range(5):
+            self.room.add_user(User.objects.create_user(email=f"guest{i}@example.com", password="guest123"))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.owner)
+        self.url = reverse("room-snapshot", kwargs={"room_hash": self.room.room_hash})
+
+    def test_snapshot_in_two_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(len(response.data["room"]["users"]), 6)
+        self.assertEqual(response.data["room"]["version"], 0)
+
+    def test_snapshot_outsider_forbidden(self):
+        self.client.force_authenticate(user=User.objects.create_user(email="outsider@example.com", password="outsider123"))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
 class RoomUserViewTest(APITestCase):
     def setUp(self):
         self.owner = User.objects.create_user(email="owner@example.com", password="password123")
@@ -87,14 +158,16 @@ class RoomUserViewTest(APITestCase):
         self.room = Room.objects.create(movie_id=self.movie.tmdb_id, created_by=self.owner, max_users=2)
 
         self.owner_room_user = RoomUser.objects.get(user=self.owner, room=self.room)
-        self.guest_privilege = RoomUserPrivileges.objects.create(
+        self.guest_privilege, _ = RoomUserPrivileges.objects.update_or_create(
             room=self.room,
             name="Guest",
-            play_pause=True,
-            choose_movie=False,
-            add_users=False,
-            remove_users=False,
-            change_privileges=False
+            defaults={
+                "play_pause": True,
+                "choose_movie": False,
+                "add_users": False,
+                "remove_users": False,
+                "change_privileges": False,
+            }
         )
         self.room.add_user(self.guest, privileges=self.guest_privilege)
 
@@ -122,6 +195,39 @@ class RoomUserViewTest(APITestCase):
         self.assertTrue(response.data["room_user"]["privileges"]["play_pause"])
         self.assertFalse(response.data["room_user"]["privileges"]["choose_movie"])
 
+class AddUserTest(TransactionTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.room = Room.objects.create(movie_id=1, created_by=self.owner, max_users=8)
+
+    def test_room_created_with_guest_role(self):
+        guest = User.objects.create_user(email="guest@example.com", password="guest123")
+        with CaptureQueriesContext(connection) as queries:
+            room_user = self.room.add_user(guest)
+        # Row lock and conditional insert
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(room_user.privileges.name, "Guest")
+        self.assertEqual(self.room.add_user(guest).id, room_user.id)
+
+    def test_parallel_joins_respect_capacity(self):
+        users = [User.objects.create_user(email=f"user{i}@example.com", password="password123") for i in range(50)]
+
+        def join(user):
+            try:
+                Room.objects.get(pk=self.room.pk).add_user(user)
+                return True
+            except RoomFullException:
+                return False
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            joined = list(pool.map(join, users))
+
+        # The owner holds one of the 8 seats
+        self.assertEqual(joined.count(True), 7)
+        self.assertEqual(RoomUser.objects.filter(room=self.room).count(), 8)
+
 class JoinRoomViewTest(APITestCase):
     def setUp(self):
         self.owner = User.objects.create_user(email="owner@example.com", password="password123")
@@ -210,14 +316,16 @@ class EditUserPrivilegesTest(APITestCase):
 
         self.owner_privilege = self.room.privilege_roles.get(name="Owner")
 
-        self.guest_privilege = RoomUserPrivileges.objects.create(
+        self.guest_privilege, _ = RoomUserPrivileges.objects.update_or_create(
             room=self.room,
             name="Guest",
-            play_pause=False,
-            choose_movie=False,
-            add_users=False,
-            remove_users=False,
-            change_privileges=False
+            defaults={
+                "play_pause": False,
+                "choose_movie": False,
+                "add_users": False,
+                "remove_users": False,
+                "change_privileges": False,
+            }
         )
 
         self.owner_room_user = RoomUser.objects.get(user=self.owner, room=self.room)
@@ -282,14 +390,16 @@ class RemoveUserFromRoomTest(APITestCase):
 
         self.room = Room.objects.create(movie_id=self.movie.tmdb_id, created_by=self.owner, max_users=3)
 
-        self.guest_privilege = RoomUserPrivileges.objects.create(
+        self.guest_privilege, _ = RoomUserPrivileges.objects.update_or_create(
             room=self.room,
             name="Guest",
-            play_pause=False,
-            choose_movie=False,
-            add_users=False,
-            remove_users=False,
-            change_privileges=False
+            defaults={
+                "play_pause": False,
+                "choose_movie": False,
+                "add_users": False,
+                "remove_users": False,
+                "change_privileges": False,
+            }
         )
 
         self.owner_privilege = self.room.privilege_roles.get(name="Owner")
@@ -424,14 +534,16 @@ class AddUserToRoomTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
     def test_user_without_add_privilege_cannot_add(self):
-        guest_privilege = RoomUserPrivileges.objects.create(
+        guest_privilege, _ = RoomUserPrivileges.objects.update_or_create(
             room=self.room,
             name="Guest",
-            play_pause=True,
-            choose_movie=False,
-            add_users=False,
-            remove_users=False,
-            change_privileges=False
+            defaults={
+                "play_pause": True,
+                "choose_movie": False,
+                "add_users": False,
+                "remove_users": False,
+                "change_privileges": False,
+            }
         )
 
         # Replace the default "Owner" with "Guest"
@@ -505,3 +617,762 @@ class CreateCodeTest(APITestCase):
         })
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+# database_sync_to_async closes old connections, which a TestCase's transaction doesn't survive.
+# Clock sync and heartbeats are off unless a test turns them on, their messages would
+# interleave with the ones the tests expect.
+@override_settings(ROOM_CLOCK_SYNC_SAMPLES=0, ROOM_HEARTBEAT_ENABLED=False, ROOM_RESUME_TOKEN_TTL=0)
+class RoomConsumerTest(TransactionTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.guest = User.objects.create_user(email="guest@example.com", password="guest123")
+        self.outsider = User.objects.create_user(email="outsider@example.com", password="outsider123")
+        self.movie = Movie.objects.create(title="Movie 1", tmdb_id=1)
+        self.room = Room.objects.create(movie_id=self.movie.tmdb_id, created_by=self.owner)
+        self.room.add_user(self.guest)
+        self.state_key = roomState.state_key(self.room.room_hash)
+        keys = [self.state_key, presence.presence_key(self.room.room_hash), presence.positions_key(self.room.room_hash)]
+        redis_client.delete(*keys)
+        self.addCleanup(redis_client.delete, *keys)
+        self.addCleanup(redis_client.zrem, presence.ROOMS_KEY, self.room.room_hash)
+        self.addCleanup(redis_client.srem, roomState.DIRTY_KEY, self.state_key)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(rooms.routing.websocket_urlpatterns),
+            f"/ws/room/{self.room.room_hash}/",
+        )
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_connect_initialises_state(self):
+        communicator = await self.connect(self.owner)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["type"], "control_state")
+        self.assertTrue(message["play_state"])
+        self.assertEqual(await get_async_redis().hget(self.state_key, "play_state"), "True")
+        await communicator.disconnect()
+
+    async def test_connect_rehydrates_lost_state(self):
+        self.room.current_timestamp = 120.0
+        await sync_to_async(self.room.save)(update_fields=["current_timestamp"])
+        communicator = await self.connect(self.owner)
+        message = await communicator.receive_json_from()
+        self.assertAlmostEqual(message["timestamp"], 120.0, delta=1)
+        await communicator.disconnect()
+
+    async def test_connect_outsider_forbidden(self):
+        communicator = await self.connect(self.outsider)
+        output = await communicator.receive_output()
+        self.assertEqual(output["type"], "websocket.close")
+        self.assertEqual(output["code"], customStatus.WS_4003_FORBIDDEN)
+
+    async def test_pause_is_stored_and_broadcast(self):
+        owner = await self.connect(self.owner)
+        guest = await self.connect(self.guest)
+        await owner.receive_json_from()
+        await guest.receive_json_from()
+
+        await owner.send_json_to({"action_type": "play_state", "action_state": False})
+        message = await guest.receive_json_from()
+        self.assertFalse(message["play_state"])
+        self.assertEqual(await get_async_redis().hget(self.state_key, "play_state"), "False")
+        await owner.disconnect()
+        await guest.disconnect()
+
+    async def test_guest_cant_seek(self):
+        guest = await self.connect(self.guest)
+        await guest.receive_json_from()
+        await guest.send_json_to({"action_type": "seek", "action_state": 100, "action_time": "2026-01-01T00:00:00+00:00"})
+        self.assertTrue(await guest.receive_nothing())
+        self.assertEqual(float(await get_async_redis().hget(self.state_key, "timestamp")), 0.0)
+        await guest.disconnect()
+
+    async def test_connect_marks_user_watching(self):
+        guest = await self.connect(self.guest)
+        await guest.receive_json_from()
+        watching = await sync_to_async(presence.watching)(self.room.room_hash)
+        self.assertEqual(watching, [{"user_id": self.guest.id, "position": None}])
+        await guest.disconnect()
+        self.assertEqual(await sync_to_async(presence.watching)(self.room.room_hash), [])
+
+    def test_connect_authorises_in_one_query(self):
+        async def connect_and_receive():
+            communicator = await self.connect(self.guest)
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        # Sync test: the consumer's database_sync_to_async calls come back to this thread's connection
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(connect_and_receive)()
+        self.assertEqual(len(queries), 1)
+
+    def test_privileges_update_pushed_to_socket(self):
+        client = APIClient()
+        client.force_authenticate(user=self.owner)
+        url = reverse("manage-user-detail", kwargs={"room_hash": self.room.room_hash, "user_id": self.guest.id})
+
+        async def update_privileges_while_connected():
+            guest = await self.connect(self.guest)
+            await guest.receive_json_from()
+
+            response = await sync_to_async(client.patch)(url, {"play_pause": True}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            message = await guest.receive_json_from()
+            self.assertEqual(message["type"], "privileges_update")
+            self.assertTrue(message["privileges"]["play_pause"])
+
+            # The socket uses the new privileges without going back to the database
+            queries_before = len(queries)
+            await guest.send_json_to({"action_type": "play_state", "action_state": False})
+            message = await guest.receive_json_from()
+            self.assertFalse(message["play_state"])
+            self.assertEqual(len(queries), queries_before)
+            await guest.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(update_privileges_while_connected)()
+
+    async def test_removed_user_disconnected(self):
+        guest = await self.connect(self.guest)
+        await guest.receive_json_from()
+
+        client = APIClient()
+        client.force_authenticate(user=self.owner)
+        url = reverse("manage-user-detail", kwargs={"room_hash": self.room.room_hash, "user_id": self.guest.id})
+        response = await sync_to_async(client.delete)(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        output = await guest.receive_output()
+        self.assertEqual(output["type"], "websocket.close")
+        self.assertEqual(output["code"], customStatus.WS_4003_FORBIDDEN)
+
+    async def test_clock_sync_corrects_state_and_seeks(self):
+        # The client's clock is 100s ahead of the server's
+        skew = 100.0
+        with override_settings(ROOM_CLOCK_SYNC_SAMPLES=3, ROOM_CLOCK_SYNC_INTERVAL=0):
+            owner = await self.connect(self.owner)
+            await owner.receive_json_from()
+            for _ in range(3):
+                message = await owner.receive_json_from()
+                self.assertEqual(message["type"], "clock_ping")
+                await owner.send_json_to({"action_type": "clock_pong", "id": message["id"], "client_time": time.time() + skew})
+
+            # The state is resent with last_updated on the client's clock
+            message = await owner.receive_json_from()
+            self.assertEqual(message["type"], "control_state")
+            last_updated = datetime.fromisoformat(message["last_updated"]).timestamp()
+            self.assertAlmostEqual(last_updated, time.time() + skew, delta=1)
+
+            # Seeked 2s ago by the client's clock
+            action_time = datetime.fromtimestamp(time.time() + skew - 2, timezone.utc).isoformat()
+            await owner.send_json_to({"action_type": "seek", "action_state": 600, "action_time": action_time})
+            message = await owner.receive_json_from()
+            self.assertAlmostEqual(message["timestamp"], 602, delta=0.5)
+            await owner.disconnect()
+
+    @override_settings(ROOM_HEARTBEAT_ENABLED=True)
+    @mock.patch.object(heartbeat, "FAST_INTERVAL", 0.05)
+    async def test_heartbeat_broadcasts_while_playing(self):
+        owner = await self.connect(self.owner)
+        guest = await self.connect(self.guest)
+        await owner.receive_json_from()
+        await guest.receive_json_from()
+
+        # One heartbeat for the room, not one per socket
+        room_heartbeat = heartbeat._rooms()[self.room.room_hash]
+        self.assertEqual(room_heartbeat.sockets, 2)
+        message = await guest.receive_json_from(timeout=1)
+        self.assertEqual(message["type"], "control_state")
+        self.assertTrue(message["play_state"])
+
+        await owner.send_json_to({"action_type": "play_state", "action_state": False})
+        while (await guest.receive_json_from(timeout=1))["play_state"]:
+            pass
+        # Paused: no more heartbeats, nor polling of the room's state
+        self.assertTrue(await guest.receive_nothing(timeout=0.3))
+        self.assertTrue(room_heartbeat.paused)
+        self.assertTrue(room_heartbeat.task.done())
+        self.assertIsNone(await get_async_redis().get(room_heartbeat.lease_key))
+
+        # Playing again: the action restarts it
+        await owner.send_json_to({"action_type": "play_state", "action_state": True})
+        for _ in range(3):
+            message = await guest.receive_json_from(timeout=1)
+            self.assertTrue(message["play_state"])
+        self.assertFalse(room_heartbeat.paused)
+
+        await owner.disconnect()
+        await guest.disconnect()
+        await asyncio.wait_for(room_heartbeat.task, 1)
+        self.assertNotIn(self.room.room_hash, heartbeat._rooms())
+        self.assertIsNone(await get_async_redis().get(room_heartbeat.lease_key))
+
+@override_settings(ROOM_CLOCK_SYNC_SAMPLES=0, ROOM_HEARTBEAT_ENABLED=False, ROOM_RESUME_TOKEN_TTL=120)
+class ResumeTest(TransactionTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.guest = User.objects.create_user(email="guest@example.com", password="guest123")
+        self.room = Room.objects.create(movie_id=1, created_by=self.owner)
+        self.room.add_user(self.guest)
+        room_hash = self.room.room_hash
+        keys = [
+            roomState.state_key(room_hash),
+            presence.presence_key(room_hash),
+            presence.positions_key(room_hash),
+            resume.revoked_key(room_hash),
+            resume.updates_key(room_hash),
+        ]
+        redis_client.delete(*keys)
+        self.addCleanup(redis_client.delete, *keys)
+        self.addCleanup(redis_client.zrem, presence.ROOMS_KEY, room_hash)
+        self.addCleanup(redis_client.srem, roomState.DIRTY_KEY, roomState.state_key(room_hash))
+
+    async def connect(self, user=None, token=None):
+        path = f"/ws/room/{self.room.room_hash}/"
+        if token is None:
+            communicator = WebsocketCommunicator(URLRouter(rooms.routing.websocket_urlpatterns), path)
+            communicator.scope["user"] = user
+        else:
+            # Through the authentication middleware, which lets the token in
+            communicator = WebsocketCommunicator(
+                JWTAuthMiddlewareStack(URLRouter(rooms.routing.websocket_urlpatterns)),
+                path,
+                subprotocols=[resume.PROTOCOL, token],
+            )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        if token is not None:
+            self.assertEqual(subprotocol, resume.PROTOCOL)
+        return communicator
+
+    async def first_session(self):
+        """ Connects the guest without a token, returns the one they're given """
+        guest = await self.connect(self.guest)
+        self.assertEqual((await guest.receive_json_from())["type"], "control_state")
+        message = await guest.receive_json_from()
+        self.assertEqual(message["type"], "session")
+        await guest.disconnect()
+        return message["resume_token"]
+
+    def test_token_rejected_when_forged_or_expired(self):
+        privileges = RoomUser.objects.get(room=self.room, user=self.guest).privileges
+        token = resume.issue(self.guest.id, self.room, privileges, self.room.version)
+        session = resume.load(token)
+        self.assertEqual((session["u"], session["r"]), (self.guest.id, self.room.room_hash))
+        # Offered as a subprotocol, which must be an HTTP token
+        self.assertRegex(token, r"^[A-Za-z0-9._~-]+$")
+        self.assertIsNone(resume.load(token[:-1] + ("A" if token[-1] != "A" else "B")))
+        with mock.patch("django.core.signing.time.time", return_value=time.time() + 121):
+            self.assertIsNone(resume.load(token))
+
+    def test_resume_skips_database_and_replays_missed_updates(self):
+        token = async_to_sync(self.first_session)()
+
+        client = APIClient()
+        client.force_authenticate(user=self.owner)
+        response = client.patch(reverse("manage-room", kwargs={"room_hash": self.room.room_hash}), {"max_users": 5}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        async def resume_session():
+            guest = await self.connect(token=token)
+            self.assertEqual((await guest.receive_json_from())["type"], "control_state")
+            message = await guest.receive_json_from()
+            self.assertEqual(message, {"type": "room_update", "version": 1, "changes": {"max_users": 5}})
+            self.assertEqual((await guest.receive_json_from())["type"], "session")
+            await guest.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(resume_session)()
+        self.assertEqual(len(queries), 0)
+
+    def test_revoked_token_falls_back_to_database(self):
+        token = async_to_sync(self.first_session)()
+        resume.revoke(self.room.room_hash, [self.guest.id])
+
+        async def resume_session():
+            guest = await self.connect(token=token)
+            self.assertEqual((await guest.receive_json_from())["type"], "control_state")
+            await guest.disconnect()
+
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(resume_session)()
+        self.assertEqual(len(queries), 1)
+
+    def test_token_lets_one_socket_in(self):
+        token = async_to_sync(self.first_session)()
+        session = resume.load(token)
+        self.addCleanup(redis_client.delete, resume.resumed_key(session["r"], session["n"]))
+
+        async def resume_twice():
+            guest = await self.connect(token=token)
+            self.assertEqual((await guest.receive_json_from())["type"], "control_state")
+            await guest.disconnect()
+
+            replayed = await self.connect(token=token)
+            output = await replayed.receive_output(timeout=1)
+            self.assertEqual((output["type"], output["code"]), ("websocket.close", customStatus.WS_4001_UNAUTHORISED))
+
+        async_to_sync(resume_twice)()
+
+    def test_token_in_url_ignored(self):
+        token = async_to_sync(self.first_session)()
+
+        async def connect_with_query():
+            communicator = WebsocketCommunicator(
+                JWTAuthMiddlewareStack(URLRouter(rooms.routing.websocket_urlpatterns)),
+                f"/ws/room/{self.room.room_hash}/?resume={token}",
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            output = await communicator.receive_output(timeout=1)
+            self.assertEqual((output["type"], output["code"]), ("websocket.close", customStatus.WS_4001_UNAUTHORISED))
+
+        async_to_sync(connect_with_query)()
+
+class ClockSyncTest(APITestCase):
+    def test_offset_of_lowest_rtt_sample(self):
+        clock = ClockSync()
+        for sent, received, client_time in [(0.0, 0.2, 5.2), (1.0, 1.02, 6.01), (2.0, 2.5, 7.05)]:
+            self.assertTrue(clock.pong(clock.ping(sent), client_time, received))
+        self.assertAlmostEqual(clock.rtt, 0.02)
+        self.assertAlmostEqual(clock.offset, 5.0)
+        self.assertAlmostEqual(clock.to_server_time(15.0), 10.0)
+        self.assertAlmostEqual(clock.to_client_time(10.0), 15.0)
+
+    def test_rejects_unknown_and_repeated_pongs(self):
+        clock = ClockSync()
+        ping_id = clock.ping(0.0)
+        self.assertFalse(clock.pong(ping_id + 1, 1.0, 0.1))
+        self.assertTrue(clock.pong(ping_id, 1.0, 0.1))
+        self.assertFalse(clock.pong(ping_id, 1.0, 0.2))
+        self.assertFalse(clock.pong(clock.ping(1.0), "soon", 1.1))
+        self.assertEqual(len(clock.samples), 1)
+
+    def test_no_offset_before_first_sample(self):
+        clock = ClockSync()
+        self.assertFalse(clock.ready)
+        self.assertEqual(clock.offset, 0.0)
+        self.assertIsNone(clock.rtt)
+
+class RoomStateTest(APITestCase):
+    def setUp(self):
+        self.key = "room_state_test"
+        redis_client.delete(self.key)
+        self.addCleanup(redis_client.delete, self.key)
+        self.addCleanup(redis_client.srem, roomState.DIRTY_KEY, self.key)
+
+    async def test_join_initialises_playing_state(self):
+        state = await roomState.join(get_async_redis(), self.key, now=1000.0)
+        self.assertEqual(state["timestamp"], 0.0)
+        self.assertTrue(state["play_state"])
+        self.assertEqual(redis_client.hgetall(self.key)["last_updated"], "1000.000000")
+
+    async def test_join_rehydrates_from_initial_position(self):
+        state = await roomState.join(get_async_redis(), self.key, now=1000.0, initial=42.0)
+        self.assertEqual(state["timestamp"], 42.0)
+        state = await roomState.join(get_async_redis(), self.key, now=1001.0, initial=0.0)
+        self.assertEqual(state["timestamp"], 43.0)
+
+    @override_settings(ROOM_STATE_TTL=100)
+    async def test_join_and_actions_renew_expiry(self):
+        redis = get_async_redis()
+        await roomState.join(redis, self.key, now=1000.0)
+        self.assertEqual(redis_client.ttl(self.key), 100)
+        redis_client.expire(self.key, 5)
+        await roomState.apply_action(redis, self.key, "play_state", False, now=1010.0)
+        self.assertEqual(redis_client.ttl(self.key), 100)
+
+    async def test_join_returns_live_position(self):
+        redis = get_async_redis()
+        await roomState.join(redis, self.key, now=1000.0)
+        state = await roomState.join(redis, self.key, now=1012.5)
+        self.assertEqual(state["timestamp"], 12.5)
+
+    async def test_pause_freezes_position(self):
+        redis = get_async_redis()
+        await roomState.join(redis, self.key, now=1000.0)
+        state = await roomState.apply_action(redis, self.key, "play_state", False, now=1030.0)
+        self.assertEqual(state["timestamp"], 30.0)
+        self.assertFalse(state["play_state"])
+        state = await roomState.join(redis, self.key, now=1100.0)
+        self.assertEqual(state["timestamp"], 30.0)
+
+        state = await roomState.apply_action(redis, self.key, "play_state", "true", now=1100.0)
+        self.assertEqual(state["timestamp"], 30.0)
+        self.assertTrue(state["play_state"])
+        self.assertEqual((await roomState.join(redis, self.key, now=1105.0))["timestamp"], 35.0)
+
+    async def test_play_while_playing_keeps_position(self):
+        redis = get_async_redis()
+        await roomState.join(redis, self.key, now=1000.0)
+        state = await roomState.apply_action(redis, self.key, "play_state", True, now=1010.0)
+        self.assertEqual(state["timestamp"], 10.0)
+
+    async def test_seek_compensates_for_delay(self):
+        redis = get_async_redis()
+        await roomState.join(redis, self.key, now=1000.0)
+        action_time = datetime.fromtimestamp(1049.5, timezone.utc)
+        state = await roomState.apply_action(redis, self.key, "seek", 600, action_time=action_time, now=1050.0)
+        self.assertEqual(state["timestamp"], 600.5)
+        self.assertEqual(state["last_updated"], datetime.fromtimestamp(1050.0, timezone.utc).isoformat())
+
+    async def test_current_doesnt_initialise(self):
+        redis = get_async_redis()
+        self.assertIsNone(await roomState.current(redis, self.key, now=1000.0))
+        await roomState.join(redis, self.key, now=1000.0)
+        state = await roomState.current(redis, self.key, now=1004.0)
+        self.assertEqual(state["timestamp"], 4.0)
+        self.assertEqual(state["changed_at"], 1000.0)
+
+    async def test_lease_has_one_holder(self):
+        redis = get_async_redis()
+        lease_key = f"{self.key}:heartbeat"
+        self.addCleanup(redis_client.delete, lease_key)
+        self.assertTrue(await roomState.acquire_lease(redis, lease_key, "a", 10))
+        self.assertTrue(await roomState.acquire_lease(redis, lease_key, "a", 10))
+        self.assertFalse(await roomState.acquire_lease(redis, lease_key, "b", 10))
+        await roomState.release_lease(redis, lease_key, "b")
+        self.assertFalse(await roomState.acquire_lease(redis, lease_key, "b", 10))
+        await roomState.release_lease(redis, lease_key, "a")
+        self.assertTrue(await roomState.acquire_lease(redis, lease_key, "b", 10))
+
+class HeartbeatIntervalTest(APITestCase):
+    def test_interval_slows_down_after_transition(self):
+        state = {"play_state": True, "changed_at": 1000.0}
+        self.assertEqual(heartbeat.interval_for(state, 1002.0), heartbeat.FAST_INTERVAL)
+        self.assertEqual(heartbeat.interval_for(state, 1030.0), heartbeat.STEADY_INTERVAL)
+        self.assertEqual(heartbeat.interval_for(state, 2000.0), heartbeat.SLOW_INTERVAL)
+
+    def test_paused_and_missing_rooms_have_no_interval(self):
+        self.assertIsNone(heartbeat.interval_for(None, 1000.0))
+        state = {"play_state": False, "changed_at": 1000.0}
+        self.assertIsNone(heartbeat.interval_for(state, 1001.0))
+
+class TokenBucketTest(APITestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        bucket.updated = 0.0
+        self.assertEqual([bucket.take(now=0.0) for _ in range(4)], [True, True, True, False])
+        self.assertFalse(bucket.take(now=0.25))
+        self.assertTrue(bucket.take(now=0.5))
+        self.assertEqual([bucket.take(now=100.0) for _ in range(4)], [True, True, True, False])
+
+@override_settings(ROOM_ACTION_COALESCE_WINDOW=0.2)
+class SendQueueTest(APITestCase):
+    async def test_newest_state_replaces_queued_one(self):
+        queue = SendQueue(8)
+        queue.put(LATEST, "state 1")
+        queue.put(RELIABLE, "update")
+        queue.put(LATEST, "state 2")
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(await queue.get(), "state 2")
+        self.assertEqual(await queue.get(), "update")
+        # Sent, so the next one queues again
+        queue.put(LATEST, "state 3")
+        self.assertEqual(await queue.get(), "state 3")
+
+    async def test_full_queue_drops_all_but_reliable_frames(self):
+        queue = SendQueue(2)
+        self.assertTrue(queue.put(DROPPABLE, "ping"))
+        self.assertTrue(queue.put(LATEST, "state"))
+        self.assertTrue(queue.put(RELIABLE, "update 1"))
+        self.assertTrue(queue.put(RELIABLE, "update 2"))
+        # Nothing left to drop
+        self.assertTrue(queue.put(DROPPABLE, "ping"))
+        self.assertFalse(queue.put(RELIABLE, "update 3"))
+        self.assertEqual([await queue.get(), await queue.get()], ["update 1", "update 2"])
+
+class ActionCoalescerTest(APITestCase):
+    def setUp(self):
+        self.key = "room_coalesce_test"
+        redis_client.delete(self.key)
+        self.addCleanup(redis_client.delete, self.key)
+
+    async def test_burst_broadcast_once_with_latest_state(self):
+        redis = get_async_redis()
+        channel_layer = mock.AsyncMock()
+        await roomState.join(redis, self.key)
+        now = datetime.now(timezone.utc)
+        for position in [10, 20, 30, 40]:
+            await actionCoalescer.submit(redis, channel_layer, self.key, self.key, "seek", position, action_time=now)
+        await actionCoalescer.submit(redis, channel_layer, self.key, self.key, "play_state", False)
+
+        # The first seek goes out at once, the rest together when the window closes
+        self.assertEqual(channel_layer.group_send.await_count, 1)
+        await asyncio.sleep(0.4)
+        self.assertEqual(channel_layer.group_send.await_count, 2)
+        event = channel_layer.group_send.await_args.args[1]
+        self.assertFalse(event["play_state"])
+        self.assertAlmostEqual(event["timestamp"], 40, delta=1)
+
+    async def test_redis_error_on_first_action(self):
+        redis = get_async_redis()
+        channel_layer = mock.AsyncMock()
+        await roomState.join(redis, self.key)
+        with mock.patch.object(roomState, "apply_action", side_effect=RedisError("connection lost")):
+            # Logged like a trailing flush, not raised into the consumer
+            await actionCoalescer.submit(redis, channel_layer, self.key, self.key, "play_state", False)
+        channel_layer.group_send.assert_not_awaited()
+
+        # The room isn't stuck once Redis is back
+        await asyncio.sleep(0.4)
+        await actionCoalescer.submit(redis, channel_layer, self.key, self.key, "play_state", False)
+        self.assertEqual(channel_layer.group_send.await_count, 1)
+        self.assertFalse(channel_layer.group_send.await_args.args[1]["play_state"])
+
+@override_settings(ROOM_PRESENCE_TTL=30)
+class PresenceTest(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.guest = User.objects.create_user(email="guest@example.com", password="guest123")
+        self.room = Room.objects.create(movie_id=1, created_by=self.owner)
+        self.room.add_user(self.guest)
+        self.room_hash = self.room.room_hash
+        keys = [presence.presence_key(self.room_hash), presence.positions_key(self.room_hash)]
+        redis_client.delete(*keys)
+        self.addCleanup(redis_client.delete, *keys)
+        self.addCleanup(redis_client.zrem, presence.ROOMS_KEY, self.room_hash)
+
+    def touch(self, user, position=None, now=1000.0):
+        async def touch():
+            await presence.touch(get_async_redis(), self.room_hash, user.id, position=position, now=now)
+        async_to_sync(touch)()
+
+    def test_watching_until_ttl(self):
+        self.touch(self.owner, position=12.5)
+        self.touch(self.guest, now=1010.0)
+        self.assertEqual(presence.watching(self.room_hash, now=1020.0), [
+            {"user_id": self.owner.id, "position": 12.5},
+            {"user_id": self.guest.id, "position": None},
+        ])
+        self.assertEqual(presence.watching(self.room_hash, now=1035.0), [{"user_id": self.guest.id, "position": None}])
+
+    def test_flush_updates_changed_rows_in_one_update(self):
+        self.touch(self.owner, position=12.5)
+        self.touch(self.guest, position=3.0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(presence.flush(now=1005.0), 2)
+        self.assertEqual(len(queries), 2)
+        owner = RoomUser.objects.get(room=self.room, user=self.owner)
+        self.assertTrue(owner.is_watching)
+        self.assertEqual(owner.last_watched_timestamp, 12.5)
+
+        # Unchanged rows aren't written again
+        self.assertEqual(presence.flush(now=1006.0), 0)
+
+    def test_flush_expires_members(self):
+        self.touch(self.guest, position=40.0)
+        presence.flush(now=1005.0)
+        self.assertEqual(presence.flush(now=1100.0), 1)
+        guest = RoomUser.objects.get(room=self.room, user=self.guest)
+        self.assertFalse(guest.is_watching)
+        self.assertEqual(guest.last_watched_timestamp, 40.0)
+        # Forgotten once written
+        self.assertIsNone(redis_client.zscore(presence.ROOMS_KEY, self.room_hash))
+        self.assertEqual(presence.flush(now=1200.0), 0)
+
+    def test_watching_endpoint(self):
+        self.touch(self.guest, position=7.0, now=datetime.now(timezone.utc).timestamp())
+        client = APIClient()
+        client.force_authenticate(user=self.owner)
+        response = client.get(reverse("room-watching", kwargs={"room_hash": self.room_hash}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["watching"], [{"user_id": self.guest.id, "position": 7.0}])
+
+        outsider = User.objects.create_user(email="outsider@example.com", password="outsider123")
+        client.force_authenticate(user=outsider)
+        response = client.get(reverse("room-watching", kwargs={"room_hash": self.room_hash}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class WriteBehindTest(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.rooms = [Room.objects.create(movie_id=1, created_by=self.owner) for _ in range(3)]
+        self.keys = [roomState.state_key(room.room_hash) for room in self.rooms]
+        redis_client.delete(*self.keys)
+        self.addCleanup(redis_client.delete, *self.keys)
+        self.addCleanup(redis_client.srem, roomState.DIRTY_KEY, *self.keys)
+
+    def apply(self, key, action_type, action_state, now):
+        async def apply():
+            redis = get_async_redis()
+            await roomState.join(redis, key, now=1000.0)
+            await roomState.apply_action(redis, key, action_type, action_state, now=now)
+        async_to_sync(apply)()
+
+    def test_flush_persists_dirty_rooms_in_one_update(self):
+        self.apply(self.keys[0], "play_state", False, now=1030.0)
+        self.apply(self.keys[1], "play_state", True, now=1010.0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(writeBehind.flush(now=1050.0), 2)
+        self.assertEqual(len(queries), 2)
+
+        # Paused rooms keep their position, playing ones are persisted as of the flush
+        self.rooms[0].refresh_from_db()
+        self.rooms[1].refresh_from_db()
+        self.rooms[2].refresh_from_db()
+        self.assertEqual(self.rooms[0].current_timestamp, 30.0)
+        self.assertEqual(self.rooms[1].current_timestamp, 50.0)
+        self.assertEqual(self.rooms[2].current_timestamp, 0.0)
+
+        # Clean once flushed
+        self.assertEqual(writeBehind.flush(now=1060.0), 0)
+
+    def test_failed_flush_keeps_rooms_dirty(self):
+        self.apply(self.keys[0], "play_state", False, now=1030.0)
+        with mock.patch.object(Room.objects, "bulk_update", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                writeBehind.flush(now=1050.0)
+        self.assertTrue(redis_client.sismember(roomState.DIRTY_KEY, self.keys[0]))
+        self.assertEqual(writeBehind.flush(now=1050.0), 1)
+
+@override_settings(ROOM_STATE_TTL=86400, ROOM_IDLE_TIMEOUT=3600)
+class SweeperTest(APITestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(email="owner@example.com", password="password123")
+        self.rooms = [Room.objects.create(movie_id=1, created_by=self.owner) for _ in range(3)]
+        Room.objects.update(created_at=datetime.now(timezone.utc) - timedelta(days=1))
+        self.keys = [roomState.state_key(room.room_hash) for room in self.rooms]
+        for room in self.rooms:
+            keys = [presence.presence_key(room.room_hash), presence.positions_key(room.room_hash)]
+            redis_client.delete(*keys)
+            self.addCleanup(redis_client.delete, *keys)
+            self.addCleanup(redis_client.zrem, presence.ROOMS_KEY, room.room_hash)
+        redis_client.delete(*self.keys)
+        self.addCleanup(redis_client.delete, *self.keys)
+        self.addCleanup(redis_client.srem, roomState.DIRTY_KEY, *self.keys)
+
+    def join(self, room, user=None):
+        async def join():
+            redis = get_async_redis()
+            await roomState.join(redis, roomState.state_key(room.room_hash))
+            if user is not None:
+                await presence.touch(redis, room.room_hash, user.id)
+        async_to_sync(join)()
+
+    def test_sweep_deactivates_idle_rooms_and_reclaims_keys(self):
+        # Idle for two hours, with a socket open and just left
+        self.join(self.rooms[0])
+        redis_client.expire(self.keys[0], 86400 - 7200)
+        self.join(self.rooms[1], user=self.owner)
+        self.join(self.rooms[2])
+
+        with CaptureQueriesContext(connection) as queries:
+            swept = sweeper.sweep()
+        self.assertEqual(swept["rooms"], 1)
+        self.assertGreater(swept["bytes"], 0)
+        # A SELECT per batch, the last one empty, and the UPDATE
+        self.assertEqual(len(queries), 3)
+
+        self.assertEqual(list(Room.objects.filter(is_active=False)), [self.rooms[0]])
+        self.assertFalse(redis_client.exists(self.keys[0]))
+        self.assertEqual(redis_client.exists(self.keys[1], self.keys[2]), 2)
+        self.assertEqual(sweeper.sweep(), {"rooms": 0, "bytes": 0})
+
+    def test_sweep_spares_new_rooms(self):
+        room = Room.objects.create(movie_id=1, created_by=self.owner)
+        swept = sweeper.sweep()
+        # The other rooms never had a socket
+        self.assertEqual(swept["rooms"], 3)
+        room.refresh_from_db()
+        self.assertTrue(room.is_active)
+
+    def test_command_loop_sweeps_while_holding_lease(self):
+        class Stop(Exception):
+            pass
+
+        redis_client.delete(sweeper.LEASE_KEY)
+        self.addCleanup(redis_client.delete, sweeper.LEASE_KEY)
+        out = StringIO()
+        with mock.patch("rooms.management.commands.sweepRooms.time.sleep", side_effect=[None, Stop]):
+            with self.assertRaises(Stop):
+                call_command("sweepRooms", "--loop", stdout=out)
+        # Three idle rooms on the first round, nothing left on the second
+        self.assertEqual(out.getvalue().count("Swept"), 2)
+        self.assertIn("Swept 3 idle rooms", out.getvalue())
+        self.assertFalse(Room.objects.filter(is_active=True).exists())
+
+        # Another replica holds the lease, this one stands by
+        redis_client.set(sweeper.LEASE_KEY, "other", px=10000)
+        out = StringIO()
+        with mock.patch("rooms.management.commands.sweepRooms.time.sleep", side_effect=[Stop]):
+            with self.assertRaises(Stop):
+                call_command("sweepRooms", "--loop", stdout=out)
+        self.assertEqual(out.getvalue(), "")
+
+    def test_command_removes_legacy_room_states(self):
+        room = self.rooms[0]
+        legacy = f"room_{room.room_hash}"
+        user_group = f"room_{room.room_hash}_user_1"
+        redis_client.hset(legacy, mapping={"time": 10, "is_playing": "false"})
+        redis_client.hset(user_group, mapping={"time": 10})
+        self.addCleanup(redis_client.delete, legacy, user_group)
+        self.join(room)
+
+        out = StringIO()
+        call_command("sweepRooms", "--legacy", stdout=out)
+        self.assertIn("Removed 1 legacy room states", out.getvalue())
+        self.assertFalse(redis_client.exists(legacy))
+        self.assertTrue(redis_client.exists(user_group))
+        self.assertTrue(redis_client.exists(self.keys[0]))
+
+class LoadTestRoomsCommandTest(TransactionTestCase):
+    def test_small_run_reports_latency(self):
+        out = StringIO()
+        call_command(
+            "loadTestRooms",
+            rooms=2,
+            users_per_room=3,
+            duration=1,
+            action_interval=0.2,
+            channel_layer="memory",
+            origin="http://localhost",
+            stdout=out,
+        )
+        output = out.getvalue()
+        self.assertIn("6/6 sockets connected", output)
+        self.assertIn("fan-out latency p50", output)
+        self.assertFalse(User.objects.filter(email__startswith="loadtest-").exists())
+
+class RoomShardingTest(APITestCase):
+    nodes = [("redis-a", 6379), ("redis-b", 6379), ("redis-c", 6379)]
+
+    def test_adding_a_node_only_moves_rooms_to_it(self):
+        room_hashes = [f"{i:012x}" for i in range(1000)]
+        before = {room_hash: node_for(room_hash, self.nodes) for room_hash in room_hashes}
+        nodes = self.nodes + [("redis-d", 6379)]
+        moved = [room_hash for room_hash in room_hashes if node_for(room_hash, nodes) != before[room_hash]]
+        self.assertTrue(all(node_for(room_hash, nodes) == ("redis-d", 6379) for room_hash in moved))
+        self.assertLess(len(moved), 400)
+        self.assertEqual(len(set(before.values())), 3)
+
+    def test_room_groups_follow_room_node(self):
+        layer = RoomShardedChannelLayer(nodes=self.nodes)
+        room_hash = "0123456789ab"
+        index = self.nodes.index(node_for(room_hash, self.nodes))
+        self.assertEqual(layer.consistent_hash(f"room_{room_hash}"), index)
+        self.assertEqual(layer.consistent_hash(f"room_{room_hash}_user_7"), index)
+        self.assertEqual(layer.room_node_index("specific.abc!def"), None)
+
+    def test_moved_room_broadcasts_to_both_nodes(self):
+        nodes = self.nodes[:2]
+        room_hash = next(
+            f"{i:012x}" for i in range(1000)
+            if node_for(f"{i:012x}", self.nodes) != node_for(f"{i:012x}", nodes)
+        )
+        layer = RoomShardedChannelLayer(nodes=self.nodes, previous_nodes=nodes)
+        indexes = []
+
+        async def group_send(layer, group, message):
+            indexes.append(layer.consistent_hash(group))
+
+        with mock.patch("channels_redis.core.RedisChannelLayer.group_send", group_send):
+            async_to_sync(layer.group_send)(f"room_{room_hash}", {"type": "room_update"})
+        self.assertEqual(indexes, [
+            self.nodes.index(node_for(room_hash, self.nodes)),
+            self.nodes.index(node_for(room_hash, nodes)),
+        ])
@@ -1,17 +1,68 @@
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from .models import Room, RoomUser
-from .serializers import RoomSerializer, RoomUserSerializer
+from .serializers import RoomSerializer, RoomUserSerializer, RoomUserPrivilegesSerializer
 from .exceptions import RoomFullException
+from .consumers import RoomConsumer
+from . import metrics, presence, resume
 
 User = get_user_model()
 
+def notify_privileges_update(room_hash, user_ids, privileges):
+    """
+    Push privileges to the connected sockets of the given users, None when
+    they were removed from the room. RoomConsumer holds the privileges of its
+    user and relies on these events to keep them current. Resume tokens of
+    the users issued so far no longer let their sockets in.
+    """
+    user_ids = list(user_ids)
+    resume.revoke(room_hash, user_ids)
+    channel_layer = get_channel_layer()
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(
+            RoomConsumer.user_group_name(room_hash, user_id),
+            {
+                "type": "privileges_update",
+                "privileges": privileges
+            }
+        )
+
+class RoomMetricsView(APIView):
+    """
+    Staff only. Counters of the room sockets of all processes: control actions
+    received, dropped by the rate limit and coalesced, and state broadcasts.
+    Also the idle rooms swept and the Redis bytes that freed (rooms.sweeper),
+    and the sockets' send queues (rooms.sendQueue): frames queued, their
+    summed queue depth (mean depth = send_queue_depth / send_queue_frames),
+    frames dropped and sockets closed for falling behind.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(metrics.get_metrics(), status=status.HTTP_200_OK)
+
+class RoomWatchingView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    """
+        Returns the members watching the room right now with their last reported
+        position, from Redis. Membership of the requester is only looked up in
+        the database when they aren't watching themselves.
+    """
+    def get(self, request, room_hash):
+        watching = presence.watching(room_hash)
+        if not any(member["user_id"] == request.user.id for member in watching):
+            if not RoomUser.objects.filter(room__room_hash=room_hash, user=request.user).exists():
+                return Response({"error": "You are not in this room"}, status=status.HTTP_403_FORBIDDEN)
+        return Response({"watching": watching}, status=status.HTTP_200_OK)
+
 class RoomUserView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -38,36 +89,60 @@ class ManageRoomView(APIView):
         Returns the updated Room on success, or an error if not allowed or invalid.
     """
     def patch(self, request, room_hash):
-        try:
-            room = Room.objects.get(room_hash=room_hash)
-        except Room.DoesNotExist:
-            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+        with transaction.atomic():
+            # Locked, so concurrent updates get consecutive versions
+            try:
+                room = Room.objects.select_for_update().get(room_hash=room_hash)
+            except Room.DoesNotExist:
+                return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        if room.created_by != request.user:
-            return Response({"error": "Not allowed to modify this room."}, status=status.HTTP_403_FORBIDDEN)
+            if room.created_by_id != request.user.id:
+                return Response({"error": "Not allowed to modify this room."}, status=status.HTTP_403_FORBIDDEN)
 
-        serializer = RoomSerializer(room, data=request.data, partial=True)
+            serializer = RoomSerializer(room, data=request.data, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        if serializer.is_valid():
             password = serializer.validated_data.pop("password", None)
-            updated_room = serializer.save()
+            changed = list(serializer.validated_data)
+            if changed:
+                updated_room = serializer.save(version=room.version + 1)
+            else:
+                updated_room = room
             if password:
                 updated_room.set_password(password)
                 updated_room.save(update_fields=["password_hash"])
 
-            # Notify WebSocket clients about the updated room
+        if changed:
+            # Notify WebSocket clients with only the fields that changed
+            event = {
+                "type": "room_update",
+                "version": updated_room.version,
+                "changes": serializer.changes(updated_room, changed),
+            }
+            # Kept for sockets that resume after missing it
+            resume.record_update(room_hash, event)
             channel_layer = get_channel_layer()
+            async_to_sync(channel_layer.group_send)(f"room_{room_hash}", event)
 
-            async_to_sync(channel_layer.group_send)(
-                f"room_{room_hash}",
-                {
-                    "type": "room_update",
-                    "room": RoomSerializer(updated_room).data
-                }
-            )
+        return Response(RoomSerializer(updated_room).data, status=status.HTTP_200_OK)
 
-            return Response(RoomSerializer(updated_room).data, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+class RoomSnapshotView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    """
+        Returns the full room, for clients that missed a room_update (a gap in
+        its version) to catch up from.
+    """
+    def get(self, request, room_hash):
+        try:
+            room = RoomSerializer.prefetch(Room.objects).get(room_hash=room_hash)
+        except Room.DoesNotExist:
+            return Response({"error": "Room not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        if not any(room_user.user_id == request.user.id for room_user in room.roomuser_set.all()):
+            return Response({"error": "You are not in this room"}, status=status.HTTP_403_FORBIDDEN)
+        return Response({"room": RoomSerializer(room).data}, status=status.HTTP_200_OK)
 
 class JoinRoomView(APIView):
     permission_classes = [IsAuthenticated]
@@ -133,6 +208,13 @@ class ManagerUsersInRoom(APIView):
 
         room_user.privileges.save()
 
+        # Privileges are a role shared by everyone it was given to
+        notify_privileges_update(
+            room_hash,
+            RoomUser.objects.filter(privileges=room_user.privileges).values_list("user_id", flat=True),
+            RoomUserPrivilegesSerializer(room_user.privileges).data,
+        )
+
         return Response({
             "message": "Privileges updated successfully",
             "user": RoomUserSerializer(room_user).data
@@ -152,6 +234,7 @@ class ManagerUsersInRoom(APIView):
             return Response({"error": "You are not in this room"}, status=status.HTTP_403_FORBIDDEN)
 
         room.remove_user(user_id)
+        notify_privileges_update(room_hash, [user_id], None)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+from utils.redisClient import node_clients
+from rooms import roomState
+from rooms.models import Room
+from rooms.flusher import LeasedFlusher
+
+# Room.current_timestamp follows the Redis state of the room (see rooms.roomState)
+# with a delay of up to ROOM_STATE_FLUSH_INTERVAL seconds. Transitions and the
+# heartbeats of playing rooms mark their state dirty, a flush persists the dirty
+# ones and the next socket of a room whose state Redis lost starts from there.
+FLUSHER_LEASE_KEY = "room_state_dirty:flusher"
+# Rooms per SELECT / UPDATE of a flush
+BATCH_SIZE = 500
+
+def flush(now=None):
+    """
+    Persist the live position of every room marked dirty since the last
+    flush, node by node: the states are read in one pipeline and written with
+    one SELECT and one bulk UPDATE per BATCH_SIZE rooms. Rooms of a batch
+    that fails to be written stay dirty.
+
+    Returns:
+        int: Room rows updated.
+    """
+    now = now if now is not None else datetime.now(timezone.utc).timestamp()
+    updated = 0
+    for redis in node_clients():
+        while True:
+            keys = redis.spop(roomState.DIRTY_KEY, BATCH_SIZE)
+            if not keys:
+                break
+            try:
+                updated += _flush_batch(redis, keys, now)
+            except Exception:
+                redis.sadd(roomState.DIRTY_KEY, *keys)
+                raise
+    return updated
+
+def _flush_batch(redis, keys, now):
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    positions = {}
+    for key, state in zip(keys, pipe.execute()):
+        position = roomState.live_position(state, now)
+        if position is not None:
+            positions[roomState.room_hash_of(key)] = position
+
+    changed = []
+    for room in Room.objects.filter(room_hash__in=positions).only("id", "room_hash", "current_timestamp"):
+        position = positions[room.room_hash]
+        if room.current_timestamp != position:
+            room.current_timestamp = position
+            changed.append(room)
+    Room.objects.bulk_update(changed, ["current_timestamp"])
+    return len(changed)
+
+flusher = LeasedFlusher("room state", FLUSHER_LEASE_KEY, flush, "ROOM_STATE_FLUSH_INTERVAL")
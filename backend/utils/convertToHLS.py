@@ -1,24 +1,90 @@
 import os
-import sys
-import json
+import time
 import logging
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from django.db import connection
 from api.models import Movie
+from utils.mediaProbe import probe_media
+from utils.hlsValidator import validate_playlist
+from utils.hlsCheckpoint import HLSCheckpoint
+from utils.hlsProgress import ConversionProgress
+from utils import mediaIndex
+from utils.hlsThumbnails import ThumbnailSprites, DEFAULT_THUMBNAIL_INTERVAL, thumbnail_track_path
+
+MASTER_PLAYLIST = "master.m3u8"
+
+# Rendition ladder used in ABR mode, keyed by output height
+ABR_RENDITIONS = {
+    2160: {"video_bitrate": "14000k", "maxrate": "15000k", "bufsize": "21000k", "audio_bitrate": "192k"},
+    1440: {"video_bitrate": "8000k", "maxrate": "8560k", "bufsize": "12000k", "audio_bitrate": "192k"},
+    1080: {"video_bitrate": "5000k", "maxrate": "5350k", "bufsize": "7500k", "audio_bitrate": "128k"},
+    720: {"video_bitrate": "2800k", "maxrate": "2996k", "bufsize": "4200k", "audio_bitrate": "128k"},
+    480: {"video_bitrate": "1400k", "maxrate": "1498k", "bufsize": "2100k", "audio_bitrate": "96k"},
+    360: {"video_bitrate": "800k", "maxrate": "856k", "bufsize": "1200k", "audio_bitrate": "96k"},
+}
+DEFAULT_ABR_LADDER = [1080, 720, 480]
+AUDIO_ONLY_BITRATE = "64k"
+
+# Segment containers: MPEG-TS (.ts) or fragmented MP4 / CMAF (init.mp4 + .m4s)
+SEGMENT_FORMATS = ["ts", "fmp4"]
+SEGMENT_EXTENSIONS = {"ts": "ts", "fmp4": "m4s"}
+FMP4_INIT_FILENAME = "init.mp4"
+
+def get_safe_title(title):
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in title)
+
+def has_audio(video_info):
+    """ probe_media reports "None" as the audio codec of a source without audio """
+    return (video_info.get("audio_codec") or "None") != "None"
+
+def get_playlist_path(movie):
+    """
+    Returns the playlist a client should load for a movie: the ABR master
+    playlist if one was generated, else the single rendition playlist.
+    """
+    hls_dir = os.path.join(movie.download_path, "hls")
+    master_path = os.path.join(hls_dir, MASTER_PLAYLIST)
+    if os.path.isfile(master_path):
+        return master_path
+    return os.path.join(hls_dir, f"{get_safe_title(movie.title)}.m3u8")
 
 class ConvertToHLS:
-    def __init__(self, tmdb_id=None, force=False, verbose=False):
+    def __init__(self, tmdb_id=None, force=False, workers=1, io_workers=None, abr=False, ladder=None, deep=False,
+                 segment_format="ts", playlist_type="vod", preset="fast", thumbnails=False,
+                 thumbnail_interval=DEFAULT_THUMBNAIL_INTERVAL, thumbnail_format="jpg", on_progress=None):
         self.tmdb_id = tmdb_id
         self.force = force
-        self.verbose = verbose
-
+        # Called with a job's progress dict (see utils.hlsProgress) on each ffmpeg progress block and when it ends
+        self.on_progress = on_progress
+        self.deep = deep
+        # "event" playlists can be played while they are still being written (see utils.jitPackager)
+        self.playlist_type = playlist_type
+        self.preset = preset
+        if segment_format not in SEGMENT_FORMATS:
+            raise ValueError(f"Unsupported segment format: {segment_format}. Choose from {SEGMENT_FORMATS}")
+        self.segment_format = segment_format
+        self.abr = abr
+        # Seek preview sprite sheets + WebVTT track (see utils.hlsThumbnails)
+        self.thumbnails = thumbnails
+        self.thumbnail_interval = thumbnail_interval
+        self.thumbnail_format = thumbnail_format
+        self.ladder = sorted(ladder or DEFAULT_ABR_LADDER, reverse=True)
+        unknown = [height for height in self.ladder if height not in ABR_RENDITIONS]
+        if unknown:
+            raise ValueError(f"Unsupported ABR rendition(s): {unknown}. Choose from {sorted(ABR_RENDITIONS)}")
+        # libx264 re-encodes are CPU bound and remuxes (-c:v copy) are I/O bound,
+        # so they get separate pools. Each job runs in its own ffmpeg process.
+        self.workers = max(1, workers)
+        self.io_workers = max(1, io_workers if io_workers else self.workers)
+        # Split the cores between concurrent encodes instead of letting every
+        # libx264 instance spawn a thread per core.
+        self.encoder_threads = max(1, (os.cpu_count() or 1) // self.workers) if self.workers > 1 else 0
+
+        # Handlers and level are left to the caller, see the convertToHLS command
         self.logger = logging.getLogger(__name__)
-        handler = logging.StreamHandler()
-
-        if not self.logger.handlers:
-            self.logger.addHandler(handler)
-
-        self.logger.setLevel(logging.INFO if verbose else logging.WARNING)
 
     def start(self):
         # If no tmdb_id is provided, convert all movies from the DB
@@ -31,64 +97,285 @@ class ConvertToHLS:
         else:
             self.logger.info("Converting all movies...")
             movies = Movie.objects.all()
-            for movie in movies:
-                self.convert(movie)
+            if self.workers > 1 or self.io_workers > 1:
+                self.convert_pool(movies)
+            else:
+                started = time.monotonic()
+                results = [self.convert(movie) for movie in movies]
+                self.report(results, time.monotonic() - started)
             self.logger.info("Finished converting all movies")
 
+    def convert_pool(self, movies):
+        """
+        Convert movies concurrently. Encodes and remuxes are scheduled on
+        separate pools sized by self.workers and self.io_workers. A failing
+        job (ffmpeg crash, missing file, ...) is reported and the batch continues.
+
+        Returns:
+            list: Result dicts of every job that was run.
+        """
+        started = time.monotonic()
+        results = []
+        futures = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hls-encode") as encode_pool, \
+             ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="hls-remux") as remux_pool:
+            for movie in movies:
+                try:
+                    job = self.prepare(movie)
+                except Exception as e:
+                    self.logger.warning(f"Failed to prepare {movie.title} ({movie.tmdb_id}): {e}")
+                    continue
+                if not job:
+                    continue
+                pool = encode_pool if job["kind"] == "encode" else remux_pool
+                futures[pool.submit(self._run_pooled_job, job)] = job
+
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    movie = futures[future]["movie"]
+                    self.logger.warning(f"Conversion crashed for {movie.title} ({movie.tmdb_id}): {e}")
+                    results.append({
+                        "tmdb_id": movie.tmdb_id,
+                        "title": movie.title,
+                        "kind": futures[future]["kind"],
+                        "ok": False,
+                        "elapsed": 0,
+                        "media_seconds": 0,
+                        "bytes_in": 0,
+                    })
+
+        self.report(results, time.monotonic() - started)
+        return results
+
+    def _run_pooled_job(self, job):
+        try:
+            return self.run_job(job)
+        finally:
+            # Worker threads get their own DB connection, don't leak it
+            connection.close()
+
+    def report(self, results, elapsed):
+        results = [r for r in results if r]
+        if not results:
+            return
+        ok = [r for r in results if r["ok"]]
+        media_seconds = sum(r["media_seconds"] for r in ok)
+        bytes_in = sum(r["bytes_in"] for r in ok)
+        elapsed = max(elapsed, 1e-6)
+        self.logger.info(
+            f"Converted {len(ok)}/{len(results)} movies in {elapsed:.1f}s: "
+            f"{media_seconds / elapsed:.2f}x realtime, {bytes_in / elapsed / 1_000_000:.1f} MB/s"
+        )
+        for r in results:
+            if not r["ok"]:
+                self.logger.warning(f"Conversion failed for {r['title']} ({r['tmdb_id']})")
+
     def convert(self, movie):
+        """
+        Convert a single movie.
+
+        Returns:
+            dict | None: Job result, None if the movie was skipped.
+        """
+        job = self.prepare(movie)
+        if not job:
+            return None
+        return self.run_job(job)
+
+    def prepare(self, movie):
+        """
+        Locate and probe the source of a movie and build its ffmpeg command.
+
+        Returns:
+            dict | None: Job description, None if there is nothing to convert.
+        """
         self.logger.info(f"Converting {movie.tmdb_id}...")
         if not self.force:
             if movie.hls_available and self.validate_hls_exists(movie):
+                if self.thumbnails and not os.path.isfile(thumbnail_track_path(os.path.join(movie.download_path, "hls"))):
+                    return self.prepare_thumbnails(movie)
                 self.logger.info(f"HLS already available for {movie.title} ({movie.tmdb_id})")
-                return
+                return None
 
-        torrent_path = os.path.join(movie.download_path, "torrent")
-        movie_path = self.get_movie_file(torrent_path)
+        movie_path = mediaIndex.get_source_file(movie)
         if not movie_path:
             self.logger.warning(f"Couldn't locate movie file for {movie.title} ({movie.tmdb_id})");
-            return
+            return None
 
         HLS_PATH = os.path.join(movie.download_path, "hls")
         os.makedirs(HLS_PATH, exist_ok=True)
 
-        safe_title = "".join(c if c.isalnum() or c in "-_" else "_" for c in movie.title)
-        m3u8_path = os.path.join(HLS_PATH, f"{safe_title}.m3u8")
-        segment_pattern = os.path.join(HLS_PATH, f"{safe_title}_%d.ts")
+        safe_title = get_safe_title(movie.title)
+        master_path = os.path.join(HLS_PATH, MASTER_PLAYLIST)
 
         video_info  = self.get_video_info(movie_path)
-        duration = video_info["duration"]
-        ffmpeg_cmd = self.build_ffmpeg_command(movie_path, m3u8_path, segment_pattern, video_info)
+        if not video_info:
+            self.logger.warning(f"Couldn't probe movie file for {movie.title} ({movie.tmdb_id})")
+            return None
+
+        # The movie's own setting wins over the run's default
+        segment_format = movie.hls_segment_format or self.segment_format
+        extension = SEGMENT_EXTENSIONS[segment_format]
+
+        thumbnails = None
+        thumbnail_cmd = None
+        if self.thumbnails:
+            thumbnails = ThumbnailSprites(HLS_PATH, video_info, self.thumbnail_interval, self.thumbnail_format)
+            thumbnails.prepare()
+
+        checkpoint = None
+        if self.abr:
+            m3u8_path = master_path
+            ffmpeg_cmd = self.build_abr_ffmpeg_command(movie_path, HLS_PATH, safe_title, video_info,
+                                                       segment_format=segment_format, thumbnails=thumbnails)
+        else:
+            m3u8_path = os.path.join(HLS_PATH, f"{safe_title}.m3u8")
+            segment_pattern = os.path.join(HLS_PATH, f"{safe_title}_%d.{extension}")
+            checkpoint = self.load_checkpoint(HLS_PATH, safe_title, movie_path, segment_format)
+            if checkpoint.segments:
+                self.logger.info(
+                    f"Resuming {movie.title} ({movie.tmdb_id}) at segment {checkpoint.start_number} ({checkpoint.offset:.1f}s)"
+                )
+                # A resumed encode doesn't decode the start of the movie, the sprites get their own pass
+                if thumbnails:
+                    thumbnail_cmd = thumbnails.command(movie_path)
+            ffmpeg_cmd = self.build_ffmpeg_command(
+                movie_path,
+                checkpoint.attempt_playlist_path(),
+                segment_pattern,
+                video_info,
+                start_number=checkpoint.start_number,
+                offset=checkpoint.offset,
+                segment_format=segment_format,
+                init_filename=checkpoint.attempt_init_filename(),
+                thumbnails=None if thumbnail_cmd else thumbnails,
+            )
+            # A master playlist left from an earlier ABR run would shadow the new output
+            if os.path.isfile(master_path):
+                os.remove(master_path)
+
+        return {
+            "movie": movie,
+            "movie_path": movie_path,
+            "m3u8_path": m3u8_path,
+            "video_info": video_info,
+            "cmd": ffmpeg_cmd,
+            "kind": "encode" if "libx264" in ffmpeg_cmd else "remux",
+            "segment_format": segment_format,
+            "checkpoint": checkpoint,
+            "thumbnails": thumbnails,
+            "thumbnail_cmd": thumbnail_cmd,
+        }
+
+    def prepare_thumbnails(self, movie):
+        """
+        Job generating only the seek preview thumbnails of a movie whose HLS
+        output already exists.
+        """
+        movie_path = mediaIndex.get_source_file(movie)
+        video_info = self.get_video_info(movie_path) if movie_path else None
+        if not video_info:
+            self.logger.warning(f"Couldn't locate or probe movie file for thumbnails of {movie.title} ({movie.tmdb_id})")
+            return None
+
+        thumbnails = ThumbnailSprites(os.path.join(movie.download_path, "hls"), video_info,
+                                      self.thumbnail_interval, self.thumbnail_format)
+        thumbnails.prepare()
+        return {
+            "movie": movie,
+            "movie_path": movie_path,
+            "m3u8_path": get_playlist_path(movie),
+            "video_info": video_info,
+            "cmd": thumbnails.command(movie_path),
+            "kind": "thumbnails",
+            "thumbnails": thumbnails,
+        }
+
+    def load_checkpoint(self, hls_path, safe_title, movie_path, segment_format="ts"):
+        """
+        Load the checkpoint of an earlier interrupted conversion, recovering the
+        complete segments of the last attempt. The checkpoint is dropped when
+        forced or when the source file changed since it was written.
+        """
+        checkpoint = HLSCheckpoint(hls_path, safe_title)
+        stat = os.stat(movie_path)
+        source = f"{movie_path}:{stat.st_size}:{stat.st_mtime}:{segment_format}"
+
+        if self.force or (checkpoint.source and not checkpoint.matches(source)):
+            checkpoint.reset(source)
+            return checkpoint
+
+        checkpoint.source = source
+        checkpoint.absorb_interrupted_attempt()
+        return checkpoint
+
+    def run_job(self, job):
+        """
+        Run the ffmpeg command of a job prepared by self.prepare.
+
+        Returns:
+            dict: tmdb_id, title, kind, ok, elapsed, media_seconds and bytes_in of the job.
+        """
+        movie = job["movie"]
+        duration = job["video_info"]["duration"]
+        if job["kind"] == "thumbnails":
+            return self.run_thumbnail_job(job)
 
         def run_ffmpeg(cmd):
+            # stderr is merged into stdout so a chatty ffmpeg can't fill an unread pipe and stall
             process = subprocess.Popen(
                 cmd,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 text=True,
                 bufsize=1,
             )
 
             for line in process.stdout:
                 line = line.strip()
-                if duration and line.startswith("out_time_ms="):
-                    t_ms = line.split("=")[1]
-                    try:
-                        current_seconds = int(t_ms)/1_000 # TODO: validate the seconds calculation is correct!
-                        percent = (current_seconds / duration) * 100
-                        # Overwrite the same line
-                        #print(f"\rProgress: {percent:.1f}% ({current_seconds:.1f}s)   ", end="", flush=True)
-                        sys.stdout.write(f"\rProgress: {percent:.1f}% ({current_seconds:.1f}s)")
-                        sys.stdout.flush()
-                    except Exception:
-                        pass
-                elif line.startswith("progress=end"):
-                    sys.stdout.write("\rProgress: 100.0% - Conversion complete!\n")
-                    sys.stdout.flush()
+                log_tail.append(line)
+                if progress.feed(line) and self.on_progress:
+                    self.on_progress(progress.progress)
 
             process.wait()
+            if process.returncode != 0:
+                self.logger.warning(f"ffmpeg exited with {process.returncode} for {movie.title}:\n" + "\n".join(log_tail))
             return process.returncode == 0
 
-        if run_ffmpeg(ffmpeg_cmd):
+        checkpoint = job.get("checkpoint")
+        progress = ConversionProgress(
+            movie,
+            job["kind"],
+            duration,
+            os.path.dirname(job["m3u8_path"]),
+            offset=checkpoint.offset if checkpoint else 0,
+        )
+        log_tail = deque(maxlen=20)
+        started = time.monotonic()
+        try:
+            ok = run_ffmpeg(job["cmd"])
+        except Exception as e:
+            self.logger.warning(f"ffmpeg failed to run for {movie.title} ({movie.tmdb_id}): {e}")
+            ok = False
+        elapsed = time.monotonic() - started
+
+        if checkpoint:
+            try:
+                if ok and checkpoint.segments:
+                    checkpoint.stitch()
+                elif ok:
+                    checkpoint.discard()
+                else:
+                    recovered = checkpoint.absorb_interrupted_attempt()
+                    self.logger.info(f"Checkpointed {recovered} new segments of {movie.title}, {len(checkpoint.segments)} in total")
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Failed to update checkpoint for {movie.title} ({movie.tmdb_id}): {e}")
+                ok = False
+
+        if ok:
             movie.hls_available = True
             movie.save(update_fields=["hls_available"])
             self.logger.info(f"Finished converting")
@@ -96,115 +383,138 @@ class ConvertToHLS:
             movie.hls_available = False
             movie.save(update_fields=["hls_available"])
             self.logger.warning(f"Conversion failed for {movie.title}")
+        if ok and job.get("thumbnails"):
+            self.finish_thumbnails(job)
+        progress.finish(ok)
+        if self.on_progress:
+            self.on_progress(progress.progress)
+        mediaIndex.refresh(mediaIndex.index_path(movie))
+
+        result = {
+            "tmdb_id": movie.tmdb_id,
+            "title": movie.title,
+            "kind": job["kind"],
+            "ok": ok,
+            "elapsed": elapsed,
+            "media_seconds": duration or 0,
+            "bytes_in": os.path.getsize(job["movie_path"]) if os.path.isfile(job["movie_path"]) else 0,
+        }
+        if ok:
+            speed = result["media_seconds"] / max(elapsed, 1e-6)
+            rate = result["bytes_in"] / max(elapsed, 1e-6) / 1_000_000
+            self.logger.info(f"{movie.title} ({movie.tmdb_id}): {job['kind']} in {elapsed:.1f}s, {speed:.2f}x realtime, {rate:.1f} MB/s")
+        return result
+
+    def run_thumbnail_job(self, job):
+        """ Run a job prepared by self.prepare_thumbnails, returns the same result dict as self.run_job """
+        movie = job["movie"]
+        started = time.monotonic()
+        ok = self.finish_thumbnails(job, cmd=job["cmd"])
+        mediaIndex.refresh(mediaIndex.index_path(movie))
+        return {
+            "tmdb_id": movie.tmdb_id,
+            "title": movie.title,
+            "kind": job["kind"],
+            "ok": ok,
+            "elapsed": time.monotonic() - started,
+            # Nothing was converted, keep the batch throughput report honest
+            "media_seconds": 0,
+            "bytes_in": 0,
+        }
+
+    def finish_thumbnails(self, job, cmd=None):
+        """
+        Write the WebVTT track of a job's sprite sheets, after running their
+        standalone ffmpeg pass if they didn't come out of the HLS encode.
+        Missing thumbnails never fail a conversion.
 
-    def validate_hls_exists(self, movie):
-        safe_title = "".join(c if c.isalnum() or c in "-_" else "_" for c in movie.title)
-        m3u8_path = os.path.join(movie.download_path, "hls", f"{safe_title}.m3u8")
-
-        if not os.path.isfile(m3u8_path):
-            return False
+        Returns:
+            bool: Whether the track was written.
+        """
+        movie = job["movie"]
+        thumbnails = job["thumbnails"]
+        cmd = cmd or job.get("thumbnail_cmd")
+        if cmd:
+            try:
+                process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            except OSError as e:
+                self.logger.warning(f"Thumbnail generation failed to run for {movie.title} ({movie.tmdb_id}): {e}")
+                return False
+            if process.returncode != 0:
+                self.logger.warning(f"Thumbnail generation failed for {movie.title} ({movie.tmdb_id}):\n{process.stderr[-2000:]}")
+                return False
 
         try:
-            result = subprocess.run(
-                ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", m3u8_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
-            )
-            duration = float(result.stdout.strip())
-            return duration > 0
-        except Exception as e:
-            self.logger.warning(f"Invalid HLS file for {movie.title} ({movie.tmdb_id}): {e}")
+            cues = thumbnails.write_track(job["video_info"]["duration"])
+        except OSError as e:
+            self.logger.warning(f"Failed to write thumbnail track for {movie.title} ({movie.tmdb_id}): {e}")
+            return False
+        if not cues:
+            self.logger.warning(f"No thumbnails generated for {movie.title} ({movie.tmdb_id})")
             return False
+        self.logger.info(f"Wrote {cues} thumbnails for {movie.title}")
+        return True
 
-    def get_movie_file(self, torrent_path):
-        video_extensions = ['.mp4', '.mkv', '.avi', '.mov']
-        selected_file = None
-        largest_size = 0
+    def validate_hls_exists(self, movie):
+        m3u8_path = get_playlist_path(movie)
 
-        for root, dirs, files in os.walk(torrent_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if any(file_path.lower().endswith(ext) for ext in video_extensions):
-                    file_size = os.path.getsize(file_path)
-                    if file_size > largest_size:
-                        largest_size = file_size
-                        selected_file = file_path
+        if not os.path.isfile(m3u8_path):
+            return False
 
-        return selected_file
+        # Movie.duration defaults to 1 when it was never probed
+        expected_duration = movie.duration if movie.duration > 1 else None
+        result = validate_playlist(m3u8_path, expected_duration=expected_duration, deep=self.deep)
+        if not result["valid"]:
+            self.logger.warning(f"Invalid HLS file for {movie.title} ({movie.tmdb_id}): {result['reason']}")
+            return False
+        return True
 
     def get_video_info(self, path):
-        cmd = [
-            "ffprobe",
-            "-v", "error",
-            "-show_entries",
-            "format=format_name,duration:stream=codec_type,codec_name,bit_rate",
-            "-of", "json",
-            path
-        ]
-
-        try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            data = json.loads(result.stdout)
-
-            # Format (container type)
-            container_format = data.get("format", {}).get("format_name", "Unknown")
-            duration = float(data.get("format", {}).get("duration", 0))
-
-            # Codecs and bitrates
-            video_codec = None
-            audio_codec = None
-            video_bitrate = None
-            audio_bitrate = None
-
-            for stream in data.get("streams", []):
-                if stream.get("codec_type") == "video" and not video_codec:
-                    video_codec = stream.get("codec_name")
-                    video_bitrate = int(stream.get("bit_rate", 0)) if stream.get("bit_rate") else None
-                elif stream.get("codec_type") == "audio" and not audio_codec:
-                    audio_codec = stream.get("codec_name")
-                    audio_bitrate = int(stream.get("bit_rate", 0)) if stream.get("bit_rate") else None
-
-            return {
-                "container": container_format,
-                "duration": duration,
-                "video_codec": video_codec or "None",
-                "video_bitrate": video_bitrate,
-                "audio_codec": audio_codec or "None",
-                "audio_bitrate": audio_bitrate
-            }
-
-        except subprocess.CalledProcessError as e:
-            print("Error running ffprobe:", e.stderr)
-            return None
+        return probe_media(path)
 
-    def build_ffmpeg_command(self, input_path, output_path, segment_pattern, video_info):
+    def build_ffmpeg_command(self, input_path, output_path, segment_pattern, video_info, start_number=0, offset=0,
+                             segment_format="ts", init_filename=FMP4_INIT_FILENAME, thumbnails=None):
         """
         Build FFmpeg command based on input file info.
 
         Args:
             input_path (str): Path to the source video.
             output_path (str): Path to the output video.
-            segment_pattern (str): Pattern to specify how the output .ts segments should be named.
+            segment_pattern (str): Pattern to specify how the output .ts/.m4s segments should be named.
             video_info (dict): Must contain 'container', 'video_codec', 'audio_codec'.
+            start_number (int): Index of the first segment, used when resuming.
+            offset (float): Source position (seconds) to start from, used when resuming.
+                Segments are cut on keyframes so this is a keyframe boundary.
+            segment_format (str): "ts" or "fmp4".
+            init_filename (str): Name of the fMP4 initialization segment (#EXT-X-MAP).
+            thumbnails (ThumbnailSprites): Also write seek preview sprite sheets as a second output.
 
         Returns:
             list: FFmpeg command ready to be run.
         """
-        cmd = ["ffmpeg", "-i", input_path]
+        copy_video = video_info["video_codec"].lower() == "h264"
+        cmd = ["ffmpeg"]
+        if offset:
+            cmd += ["-ss", f"{offset:.6f}"]
+        if thumbnails and copy_video:
+            # Stream copy doesn't decode, so the thumbnails only need the keyframes
+            cmd += ["-skip_frame", "nokey"]
+        cmd += ["-i", input_path]
 
         # Video
-        if video_info["video_codec"].lower() != "h264":
-            cmd += ["-c:v", "libx264", "-preset", "fast", "-crf", "23"]
+        if not copy_video:
+            cmd += ["-c:v", "libx264", "-preset", self.preset, "-crf", "23"]
+            if self.encoder_threads:
+                cmd += ["-threads", str(self.encoder_threads)]
         else:
             cmd += ["-c:v", "copy"]
 
         # Audio
-        if video_info["audio_codec"].lower() != "aac":
-            cmd += ["-c:a", "aac", "-b:a", "128k"]
-        else:
-            cmd += ["-c:a", "copy"]
+        if has_audio(video_info):
+            if video_info["audio_codec"].lower() != "aac":
+                cmd += ["-c:a", "aac", "-b:a", "128k"]
+            else:
+                cmd += ["-c:a", "copy"]
 
         # ffmpeg -i /media/downloads/<id>/torrent/<title>.mp4 -c:v libx264 -preset fast -crf 23 -c:a aac -b:a 128k -map 0 -f hls -hls_time 10 -hls_playlist_type vod /media/downloads/<id>/hls/<title>.m3u8
         # Container
@@ -220,13 +530,112 @@ class ConvertToHLS:
             "-loglevel", "info",
             "-progress", "pipe:1",
         ]
+        # temp_file: segments are renamed into place once complete, so an
+        # interrupted run leaves only whole segments behind (see HLSCheckpoint)
         hls_cmd = [
             "-f", "hls",
             "-hls_time", "10",
-            "-hls_playlist_type", "vod",
+            "-hls_playlist_type", self.playlist_type,
+            "-hls_flags", "temp_file",
             "-hls_segment_filename", segment_pattern
         ]
+        if segment_format == "fmp4":
+            hls_cmd += ["-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", init_filename]
+        if start_number:
+            hls_cmd += ["-start_number", str(start_number)]
+        if offset:
+            # Keep timestamps continuous with the segments of the earlier runs
+            stream_cmd += ["-output_ts_offset", f"{offset:.6f}"]
         cmd = cmd + stream_cmd + log_cmd + hls_cmd
 
         cmd.append(output_path)
+        if thumbnails:
+            cmd += thumbnails.output_args()
+        return cmd
+
+    def build_abr_ffmpeg_command(self, input_path, hls_path, safe_title, video_info, segment_format="ts", thumbnails=None):
+        """
+        Build a single FFmpeg command producing every rendition of self.ladder
+        plus an audio only rendition, and a master playlist referencing them.
+        The source is decoded once and split into one scaler per rendition.
+        A source without audio gets video only renditions and no audio rendition.
+
+        Renditions taller than the source are skipped (the smallest one is always kept).
+
+        Output layout in hls_path:
+            master.m3u8
+            <title>_<height>p.m3u8, <title>_<height>p_<n>.ts
+            <title>_audio.m3u8, <title>_audio_<n>.ts
+        With segment_format "fmp4" segments are .m4s with one init_<variant>.mp4 per variant.
+
+        Args:
+            input_path (str): Path to the source video.
+            hls_path (str): Directory the playlists and segments are written to.
+            safe_title (str): Filesystem safe title used to name the outputs.
+            video_info (dict): Must contain 'height' and 'audio_codec'.
+            segment_format (str): "ts" or "fmp4".
+            thumbnails (ThumbnailSprites): Also write seek preview sprite sheets from an extra split branch.
+
+        Returns:
+            list: FFmpeg command ready to be run.
+        """
+        source_height = video_info.get("height")
+        ladder = [height for height in self.ladder if not source_height or height <= source_height]
+        if not ladder:
+            ladder = [self.ladder[-1]]
+
+        branches = len(ladder) + (1 if thumbnails else 0)
+        split = f"[0:v:0]split={branches}" + "".join(f"[v{i}]" for i in range(branches))
+        scales = [f"[v{i}]scale=-2:{height}[v{i}out]" for i, height in enumerate(ladder)]
+        if thumbnails:
+            scales.append(f"[v{len(ladder)}]{thumbnails.filter}[thumbs]")
+        cmd = ["ffmpeg", "-i", input_path, "-filter_complex", ";".join([split] + scales)]
+
+        audio = has_audio(video_info)
+        var_stream_map = []
+        for i, height in enumerate(ladder):
+            rendition = ABR_RENDITIONS[height]
+            cmd += [
+                "-map", f"[v{i}out]",
+                f"-c:v:{i}", "libx264", "-preset", self.preset,
+                f"-b:v:{i}", rendition["video_bitrate"],
+                f"-maxrate:v:{i}", rendition["maxrate"],
+                f"-bufsize:v:{i}", rendition["bufsize"],
+            ]
+            if audio:
+                cmd += ["-map", "0:a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", rendition["audio_bitrate"]]
+                var_stream_map.append(f"v:{i},a:{i},name:{height}p")
+            else:
+                var_stream_map.append(f"v:{i},name:{height}p")
+
+        if audio:
+            audio_index = len(ladder)
+            cmd += ["-map", "0:a:0", f"-c:a:{audio_index}", "aac", f"-b:a:{audio_index}", AUDIO_ONLY_BITRATE]
+            var_stream_map.append(f"a:{audio_index},name:audio")
+
+        if self.encoder_threads:
+            cmd += ["-threads", str(self.encoder_threads)]
+
+        # Keyframes at fixed times so segment boundaries line up across renditions
+        cmd += ["-force_key_frames", "expr:gte(t,n_forced*2)", "-sc_threshold", "0"]
+
+        log_cmd = [
+            "-loglevel", "info",
+            "-progress", "pipe:1",
+        ]
+        hls_cmd = [
+            "-f", "hls",
+            "-hls_time", "10",
+            "-hls_playlist_type", self.playlist_type,
+            "-master_pl_name", MASTER_PLAYLIST,
+            "-var_stream_map", " ".join(var_stream_map),
+            "-hls_segment_filename", os.path.join(hls_path, f"{safe_title}_%v_%d.{SEGMENT_EXTENSIONS[segment_format]}"),
+        ]
+        if segment_format == "fmp4":
+            hls_cmd += ["-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", "init_%v.mp4"]
+        cmd = cmd + log_cmd + hls_cmd
+
+        cmd.append(os.path.join(hls_path, f"{safe_title}_%v.m3u8"))
+        if thumbnails:
+            cmd += thumbnails.output_args("[thumbs]")
         return cmd
@@ -15,3 +15,4 @@ def is_server_error(code):
 
 WS_4001_UNAUTHORISED = 4001
 WS_4003_FORBIDDEN = 4003
+WS_4008_TOO_SLOW = 4008
@@ -0,0 +1,170 @@
+import os
+import json
+import math
+import logging
+
+from utils.hlsValidator import parse_playlist
+
+logger = logging.getLogger("movies")
+
+class HLSCheckpoint:
+    """
+    Tracks the segments of an interrupted single rendition conversion so the
+    next run can resume after the last complete segment instead of frame zero.
+
+    ffmpeg runs with -hls_flags temp_file, so a segment only gets its final
+    name once it is complete and every segment listed in a playlist written by
+    an interrupted run is safe to keep. Each run (attempt) writes its own
+    playlist; the first one writes <title>.m3u8, resumed ones <title>.part<n>.m3u8.
+    Once a resumed run finishes the parts are stitched into <title>.m3u8.
+    """
+
+    def __init__(self, hls_path, safe_title):
+        self.hls_path = hls_path
+        self.safe_title = safe_title
+        self.path = os.path.join(hls_path, f"{safe_title}.checkpoint.json")
+        self.playlist_path = os.path.join(hls_path, f"{safe_title}.m3u8")
+        self.source = None
+        self.segments = []
+        self.parts = 0
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                self.source = data.get("source")
+                self.segments = data.get("segments", [])
+                self.parts = data.get("parts", 0)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable checkpoint %s: %s", self.path, e)
+
+    @property
+    def offset(self):
+        """ Media time (seconds) covered by the completed segments """
+        return sum(segment["duration"] for segment in self.segments)
+
+    @property
+    def start_number(self):
+        return len(self.segments)
+
+    def attempt_playlist_path(self, attempt=None):
+        """ Playlist written by the given attempt, defaults to the next one """
+        attempt = self.parts if attempt is None else attempt
+        if attempt == 0:
+            return self.playlist_path
+        return os.path.join(self.hls_path, f"{self.safe_title}.part{attempt}.m3u8")
+
+    def attempt_init_filename(self, attempt=None):
+        """ fMP4 init segment written by the given attempt, defaults to the next one """
+        attempt = self.parts if attempt is None else attempt
+        if attempt == 0:
+            return "init.mp4"
+        return f"init_part{attempt}.mp4"
+
+    def matches(self, source):
+        return self.source == source
+
+    def reset(self, source):
+        self.discard()
+        self.source = source
+
+    def absorb_interrupted_attempt(self):
+        """
+        Add the segments of the last attempt's playlist to the checkpoint if that
+        attempt didn't finish. This also covers runs that were killed before
+        they could record anything themselves.
+
+        Returns:
+            int: Number of segments recovered.
+        """
+        playlist_path = self.attempt_playlist_path()
+        if not os.path.isfile(playlist_path):
+            return 0
+
+        try:
+            playlist = parse_playlist(playlist_path)
+        except (OSError, ValueError) as e:
+            logger.warning("Can't recover segments from %s: %s", playlist_path, e)
+            return 0
+
+        if playlist["endlist"] or playlist["master"]:
+            return 0
+
+        init_uri = os.path.basename(playlist["maps"][-1]) if playlist["maps"] else None
+        recovered = 0
+        for segment_path, duration in playlist["segments"]:
+            if not os.path.isfile(segment_path) or os.path.getsize(segment_path) == 0:
+                break
+            self.segments.append({
+                "uri": os.path.basename(segment_path),
+                "duration": duration,
+                "part": self.parts,
+                "map": init_uri,
+            })
+            recovered += 1
+
+        self.parts += 1
+        os.remove(playlist_path)
+        self.save()
+        return recovered
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"source": self.source, "segments": self.segments, "parts": self.parts}, f)
+        os.replace(tmp_path, self.path)
+
+    def discard(self):
+        for attempt in range(1, self.parts + 1):
+            part_path = self.attempt_playlist_path(attempt)
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.source = None
+        self.segments = []
+        self.parts = 0
+
+    def stitch(self):
+        """
+        Combine the checkpointed segments and the playlist of the finished
+        attempt into the final VOD playlist, then drop the checkpoint.
+        Parts are separated by #EXT-X-DISCONTINUITY, and for fMP4 output each
+        part references its own init segment with #EXT-X-MAP.
+        """
+        final_attempt_path = self.attempt_playlist_path()
+        playlist = parse_playlist(final_attempt_path)
+        init_uri = os.path.basename(playlist["maps"][-1]) if playlist["maps"] else None
+        segments = self.segments + [
+            {"uri": os.path.basename(segment_path), "duration": duration, "part": self.parts, "map": init_uri}
+            for segment_path, duration in playlist["segments"]
+        ]
+
+        fmp4 = any(segment.get("map") for segment in segments)
+        target_duration = math.ceil(max(segment["duration"] for segment in segments))
+        lines = [
+            "#EXTM3U",
+            # EXT-X-MAP for fMP4 segments needs protocol version 7
+            f"#EXT-X-VERSION:{7 if fmp4 else 3}",
+            f"#EXT-X-TARGETDURATION:{target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        previous_part = segments[0]["part"]
+        previous_map = None
+        for segment in segments:
+            if segment["part"] != previous_part:
+                lines.append("#EXT-X-DISCONTINUITY")
+                previous_part = segment["part"]
+            if segment.get("map") and segment["map"] != previous_map:
+                lines.append(f'#EXT-X-MAP:URI="{segment["map"]}"')
+                previous_map = segment["map"]
+            lines.append(f"#EXTINF:{segment['duration']:.6f},")
+            lines.append(segment["uri"])
+        lines.append("#EXT-X-ENDLIST")
+
+        tmp_path = f"{self.playlist_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.playlist_path)
+        self.discard()
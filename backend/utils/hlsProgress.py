@@ -0,0 +1,182 @@
+import os
+import time
+import json
+import logging
+
+from redis.exceptions import RedisError
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from utils.redisClient import redis_client
+
+logger = logging.getLogger("movies")
+
+PROGRESS_KEY_PREFIX = "hls_progress:"
+# tmdb_ids of conversions with a progress hash, so they can be listed without SCAN
+ACTIVE_KEY = "hls_progress_active"
+# Channel layer group the ConversionProgressConsumer sockets join
+PROGRESS_GROUP = "hls_progress"
+# Finished conversions stay listed for a while so a batch can be reviewed afterwards
+PROGRESS_TTL = 60 * 60
+PUBLISH_INTERVAL = 1.0
+
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+def progress_key(tmdb_id):
+    return f"{PROGRESS_KEY_PREFIX}{tmdb_id}"
+
+def get_progress(tmdb_id=None):
+    """
+    Returns the last published progress of a conversion, or of every
+    conversion that published progress within PROGRESS_TTL.
+
+    Returns:
+        dict | list[dict]: A single progress dict (None if unknown) when
+        tmdb_id is given, else a list ordered by tmdb_id.
+    """
+    if tmdb_id is not None:
+        raw = redis_client.get(progress_key(tmdb_id))
+        return json.loads(raw) if raw else None
+
+    tmdb_ids = sorted(redis_client.smembers(ACTIVE_KEY), key=int)
+    if not tmdb_ids:
+        return []
+    progress = []
+    for tmdb_id, raw in zip(tmdb_ids, redis_client.mget([progress_key(i) for i in tmdb_ids])):
+        if raw:
+            progress.append(json.loads(raw))
+        else:
+            # expired
+            redis_client.srem(ACTIVE_KEY, tmdb_id)
+    return progress
+
+class ConversionProgress:
+    """
+    Turns the key=value blocks ffmpeg writes with -progress into structured
+    progress and publishes it to Redis and the PROGRESS_GROUP channel layer
+    group, at most once per PUBLISH_INTERVAL.
+
+    A published progress dict holds tmdb_id, title, kind, state, percent,
+    position and duration (seconds), fps, speed (multiple of realtime),
+    eta (seconds), bytes_written and updated_at.
+    """
+
+    def __init__(self, movie, kind, duration, output_dir, offset=0):
+        self.output_dir = output_dir
+        # Resumed conversions only encode what comes after the checkpoint
+        self.offset = offset
+        self.block = {}
+        self.last_published = 0
+        self.publish_failed = False
+        self.progress = {
+            "tmdb_id": movie.tmdb_id,
+            "title": movie.title,
+            "kind": kind,
+            "state": RUNNING,
+            "percent": 0.0,
+            "position": float(offset),
+            "duration": duration or 0,
+            "fps": 0.0,
+            "speed": 0.0,
+            "eta": None,
+            "bytes_written": 0,
+            "updated_at": time.time(),
+        }
+
+    @property
+    def percent(self):
+        return self.progress["percent"]
+
+    @property
+    def position(self):
+        return self.progress["position"]
+
+    def feed(self, line):
+        """
+        Feed one line of ffmpeg's -progress output. Returns True when the line
+        completed a progress block.
+        """
+        key, sep, value = line.partition("=")
+        if not sep:
+            return False
+        if key != "progress":
+            self.block[key.strip()] = value.strip()
+            return False
+
+        block, self.block = self.block, {}
+        self.update(block)
+        if value.strip() != "end":
+            self.publish()
+        return True
+
+    def update(self, block):
+        # out_time_us and (despite the name) out_time_ms are both in microseconds
+        out_time = _to_number(block.get("out_time_us", block.get("out_time_ms")))
+        if out_time is not None and out_time >= 0:
+            duration = self.progress["duration"]
+            position = self.offset + out_time / 1_000_000
+            self.progress["position"] = min(position, duration) if duration else position
+            if duration:
+                self.progress["percent"] = round(min(self.progress["position"] / duration * 100, 100.0), 2)
+
+        fps = _to_number(block.get("fps"))
+        if fps is not None:
+            self.progress["fps"] = fps
+
+        speed = _to_number(block.get("speed", "").rstrip("x"))
+        if speed is not None:
+            self.progress["speed"] = speed
+            remaining = self.progress["duration"] - self.progress["position"]
+            self.progress["eta"] = round(remaining / speed, 1) if speed > 0 and self.progress["duration"] else None
+
+        # The HLS muxer reports N/A for total_size, count the segments written so far instead
+        total_size = _to_number(block.get("total_size"))
+        self.progress["bytes_written"] = int(total_size) if total_size else self.output_size()
+
+    def output_size(self):
+        try:
+            return sum(entry.stat().st_size for entry in os.scandir(self.output_dir) if entry.is_file())
+        except OSError:
+            return self.progress["bytes_written"]
+
+    def finish(self, ok):
+        self.progress["state"] = FINISHED if ok else FAILED
+        if ok:
+            self.progress["percent"] = 100.0
+            self.progress["position"] = self.progress["duration"]
+            self.progress["eta"] = 0
+        self.progress["bytes_written"] = self.output_size()
+        self.publish(force=True)
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self.last_published < PUBLISH_INTERVAL:
+            return
+        self.last_published = now
+        self.progress["updated_at"] = now
+
+        try:
+            pipe = redis_client.pipeline()
+            pipe.set(progress_key(self.progress["tmdb_id"]), json.dumps(self.progress), ex=PROGRESS_TTL)
+            pipe.sadd(ACTIVE_KEY, self.progress["tmdb_id"])
+            pipe.execute()
+
+            channel_layer = get_channel_layer()
+            if channel_layer is not None:
+                async_to_sync(channel_layer.group_send)(PROGRESS_GROUP, {
+                    "type": "conversion_progress",
+                    "progress": self.progress,
+                })
+        except (RedisError, OSError) as e:
+            # Progress is best effort, a conversion must not fail because Redis is unreachable
+            if not self.publish_failed:
+                logger.warning("Can't publish conversion progress for %s: %s", self.progress["title"], e)
+                self.publish_failed = True
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
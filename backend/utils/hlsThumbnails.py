@@ -0,0 +1,127 @@
+import os
+import math
+import logging
+
+logger = logging.getLogger("movies")
+
+THUMBNAIL_DIR = "thumbnails"
+THUMBNAIL_TRACK = "thumbnails.vtt"
+THUMBNAIL_FORMATS = ["jpg", "webp"]
+DEFAULT_THUMBNAIL_INTERVAL = 10
+THUMBNAIL_WIDTH = 160
+TILE_COLUMNS = 5
+TILE_ROWS = 5
+
+def thumbnail_track_path(hls_path):
+    return os.path.join(hls_path, THUMBNAIL_DIR, THUMBNAIL_TRACK)
+
+class ThumbnailSprites:
+    """
+    Seek preview thumbnails of a movie: one frame every `interval` seconds,
+    scaled to THUMBNAIL_WIDTH and tiled TILE_COLUMNS x TILE_ROWS per sprite
+    sheet, plus a WebVTT track mapping each interval to its tile
+    (sprite_<n>.jpg#xywh=x,y,w,h) so a player can show a preview while
+    scrubbing without fetching the segments.
+
+    Output layout in <hls_path>/thumbnails:
+        sprite_001.jpg, sprite_002.jpg, ...
+        thumbnails.vtt
+    """
+
+    def __init__(self, hls_path, video_info, interval=DEFAULT_THUMBNAIL_INTERVAL, image_format="jpg"):
+        if image_format not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unsupported thumbnail format: {image_format}. Choose from {THUMBNAIL_FORMATS}")
+        self.path = os.path.join(hls_path, THUMBNAIL_DIR)
+        self.track_path = os.path.join(self.path, THUMBNAIL_TRACK)
+        self.interval = interval
+        self.image_format = image_format
+        self.width = THUMBNAIL_WIDTH
+        # The tile size must be known to write the track, so the height is fixed
+        # from the source aspect ratio instead of letting the scaler pick it
+        width, height = video_info.get("width"), video_info.get("height")
+        aspect = height / width if width and height else 9 / 16
+        self.height = max(2, int(round(self.width * aspect / 2)) * 2)
+
+    @property
+    def pattern(self):
+        return os.path.join(self.path, f"sprite_%03d.{self.image_format}")
+
+    @property
+    def filter(self):
+        return f"fps=1/{self.interval},scale={self.width}:{self.height},tile={TILE_COLUMNS}x{TILE_ROWS}"
+
+    def output_args(self, video_map="0:v:0"):
+        """
+        Arguments of an extra ffmpeg output writing the sprite sheets. Added to
+        the HLS command the frames come from the decode the encode already does.
+
+        Args:
+            video_map (str): Stream to take the frames from, 0:v:0 or a filter graph label.
+                The thumbnail filter is only applied for an input stream; a label must
+                already carry it (see self.filter).
+        """
+        args = ["-map", video_map]
+        if not video_map.startswith("["):
+            args += ["-vf", self.filter]
+        args += ["-an", "-sn", "-fps_mode", "passthrough"]
+        if self.image_format == "webp":
+            args += ["-c:v", "libwebp", "-quality", "60"]
+        else:
+            args += ["-q:v", "5"]
+        return args + ["-f", "image2", self.pattern]
+
+    def command(self, input_path):
+        """
+        Standalone ffmpeg command for when the thumbnails can't ride along with
+        the HLS encode (a resumed conversion, or HLS output that already exists).
+        Only keyframes are decoded, which is enough for previews and far cheaper.
+        """
+        return ["ffmpeg", "-skip_frame", "nokey", "-i", input_path, "-loglevel", "error", "-y"] + self.output_args()
+
+    def prepare(self):
+        """ Create the output directory, dropping sprites and track of an earlier run """
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name.startswith("sprite_") or name == THUMBNAIL_TRACK:
+                os.remove(os.path.join(self.path, name))
+
+    def exists(self):
+        return os.path.isfile(self.track_path)
+
+    def write_track(self, duration):
+        """
+        Write the WebVTT track for the sprite sheets of a movie of `duration` seconds.
+
+        Returns:
+            int: Number of cues written, 0 if there are no sprite sheets.
+        """
+        sheets = sorted(name for name in os.listdir(self.path) if name.startswith("sprite_")) if os.path.isdir(self.path) else []
+        if not sheets or not duration:
+            return 0
+
+        per_sheet = TILE_COLUMNS * TILE_ROWS
+        cues = min(math.ceil(duration / self.interval), len(sheets) * per_sheet)
+        lines = ["WEBVTT", ""]
+        for i in range(cues):
+            start = i * self.interval
+            end = min((i + 1) * self.interval, duration)
+            tile = i % per_sheet
+            x = (tile % TILE_COLUMNS) * self.width
+            y = (tile // TILE_COLUMNS) * self.height
+            sheet = f"sprite_{i // per_sheet + 1:03d}.{self.image_format}"
+            lines.append(f"{_vtt_time(start)} --> {_vtt_time(end)}")
+            lines.append(f"{sheet}#xywh={x},{y},{self.width},{self.height}")
+            lines.append("")
+
+        tmp_path = f"{self.track_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines))
+        os.replace(tmp_path, self.track_path)
+        return cues
+
+def _vtt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
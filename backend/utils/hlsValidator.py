@@ -0,0 +1,187 @@
+import os
+import logging
+
+from utils.mediaProbe import run_ffprobe
+
+logger = logging.getLogger("movies")
+
+# Allowed difference between the playlist duration and the expected duration
+DURATION_TOLERANCE_SECONDS = 5
+DURATION_TOLERANCE_RATIO = 0.01
+
+def parse_playlist(path):
+    """
+    Parse an .m3u8 playlist.
+
+    Returns:
+        dict: master (bool), variants (list of playlist paths, master only),
+        segments (list of (path, duration) tuples), maps (list of fMP4
+        initialization segment paths from #EXT-X-MAP), endlist (bool).
+
+    Raises:
+        OSError: If the playlist can't be read.
+        ValueError: If the file isn't an m3u8 playlist.
+    """
+    base_dir = os.path.dirname(path)
+    playlist = {
+        "master": False,
+        "variants": [],
+        "segments": [],
+        "maps": [],
+        "endlist": False,
+    }
+
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    if not lines or lines[0] != "#EXTM3U":
+        raise ValueError("missing #EXTM3U header")
+
+    pending_duration = None
+    pending_variant = False
+    for line in lines[1:]:
+        if line.startswith("#EXTINF:"):
+            try:
+                pending_duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+            except ValueError:
+                raise ValueError(f"invalid #EXTINF line: {line}")
+        elif line.startswith("#EXT-X-STREAM-INF:"):
+            playlist["master"] = True
+            pending_variant = True
+        elif line.startswith("#EXT-X-MAP:"):
+            uri = _parse_attribute(line, "URI")
+            if not uri:
+                raise ValueError(f"invalid #EXT-X-MAP line: {line}")
+            playlist["maps"].append(os.path.join(base_dir, uri))
+        elif line == "#EXT-X-ENDLIST":
+            playlist["endlist"] = True
+        elif line.startswith("#"):
+            continue
+        elif pending_variant:
+            playlist["variants"].append(os.path.join(base_dir, line))
+            pending_variant = False
+        elif pending_duration is not None:
+            playlist["segments"].append((os.path.join(base_dir, line), pending_duration))
+            pending_duration = None
+
+    return playlist
+
+def _parse_attribute(line, name):
+    """ Value of an attribute of a tag line, e.g. URI from #EXT-X-MAP:URI="init.mp4" """
+    for attribute in line.split(":", 1)[1].split(","):
+        key, _, value = attribute.partition("=")
+        if key.strip() == name:
+            return value.strip().strip('"')
+    return None
+
+def _duration_matches(duration, expected_duration):
+    tolerance = max(DURATION_TOLERANCE_SECONDS, expected_duration * DURATION_TOLERANCE_RATIO)
+    return abs(duration - expected_duration) <= tolerance
+
+def validate_media_playlist(path, expected_duration=None):
+    """
+    Check a media playlist without decoding anything: every segment (and fMP4
+    init segment) must exist with a non-zero size, the playlist must be complete
+    and the summed #EXTINF durations must match expected_duration.
+
+    Returns:
+        dict: valid (bool), suspicious (bool), duration (float), segments (int), reason (str | None).
+        suspicious is set when the structure is fine but the duration can't be trusted.
+    """
+    result = {"valid": False, "suspicious": False, "duration": 0.0, "segments": 0, "reason": None}
+
+    try:
+        playlist = parse_playlist(path)
+    except (OSError, ValueError) as e:
+        result["reason"] = f"unreadable playlist: {e}"
+        return result
+
+    if playlist["master"]:
+        result["reason"] = "expected a media playlist, got a master playlist"
+        return result
+
+    if not playlist["segments"]:
+        result["reason"] = "no segments"
+        return result
+
+    if not playlist["endlist"]:
+        result["reason"] = "missing #EXT-X-ENDLIST, conversion didn't finish"
+        return result
+
+    for map_path in playlist["maps"]:
+        if not os.path.isfile(map_path) or os.path.getsize(map_path) == 0:
+            result["reason"] = f"missing or empty init segment {os.path.basename(map_path)}"
+            return result
+
+    for segment_path, _ in playlist["segments"]:
+        try:
+            size = os.stat(segment_path).st_size
+        except OSError:
+            result["reason"] = f"missing segment {os.path.basename(segment_path)}"
+            return result
+        if size == 0:
+            result["reason"] = f"empty segment {os.path.basename(segment_path)}"
+            return result
+
+    result["duration"] = sum(duration for _, duration in playlist["segments"])
+    result["segments"] = len(playlist["segments"])
+
+    if expected_duration and not _duration_matches(result["duration"], expected_duration):
+        result["suspicious"] = True
+        result["reason"] = f"duration {result['duration']:.1f}s doesn't match expected {expected_duration:.1f}s"
+        return result
+
+    result["valid"] = True
+    return result
+
+def validate_playlist(path, expected_duration=None, deep=False):
+    """
+    Validate an HLS playlist (master or media) by parsing the manifests.
+
+    Args:
+        path (str): Path to the .m3u8 file.
+        expected_duration (float | None): Duration the output should have, None/0 if unknown.
+        deep (bool): Run ffprobe on playlists whose duration looks wrong instead
+            of rejecting them outright.
+
+    Returns:
+        dict: valid (bool), duration (float), segments (int), reason (str | None).
+    """
+    try:
+        playlist = parse_playlist(path)
+    except (OSError, ValueError) as e:
+        return {"valid": False, "duration": 0.0, "segments": 0, "reason": f"unreadable playlist: {e}"}
+
+    media_playlists = playlist["variants"] if playlist["master"] else [path]
+    if not media_playlists:
+        return {"valid": False, "duration": 0.0, "segments": 0, "reason": "master playlist without variants"}
+
+    total_segments = 0
+    durations = []
+    for media_playlist in media_playlists:
+        result = validate_media_playlist(media_playlist, expected_duration)
+        if result["suspicious"] and deep:
+            result = deep_validate(media_playlist, expected_duration)
+        if not result["valid"]:
+            name = os.path.basename(media_playlist)
+            return {"valid": False, "duration": result["duration"], "segments": result["segments"], "reason": f"{name}: {result['reason']}"}
+        total_segments += result["segments"]
+        durations.append(result["duration"])
+
+    return {"valid": True, "duration": min(durations), "segments": total_segments, "reason": None}
+
+def deep_validate(path, expected_duration=None):
+    """ Fall back to ffprobe for a media playlist the manifest check flagged as suspicious """
+    result = {"valid": False, "suspicious": False, "duration": 0.0, "segments": 0, "reason": None}
+    info = run_ffprobe(path)
+    if not info or info["duration"] <= 0:
+        result["reason"] = "ffprobe couldn't read the playlist"
+        return result
+
+    result["duration"] = info["duration"]
+    if expected_duration and not _duration_matches(info["duration"], expected_duration):
+        result["reason"] = f"ffprobe duration {info['duration']:.1f}s doesn't match expected {expected_duration:.1f}s"
+        return result
+
+    result["valid"] = True
+    return result
@@ -0,0 +1,137 @@
+import os
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from utils.redisClient import redis_client
+from utils.convertToHLS import ConvertToHLS, get_playlist_path
+
+logger = logging.getLogger("movies")
+
+JOBS_KEY = "hls_jit_jobs"
+# A job's slot expires unless the packager renews it, so a crashed process can't hold it forever
+LEASE_SECONDS = 60
+
+# KEYS[1] = jobs zset (member: tmdb_id, score: lease expiry)
+# ARGV = tmdb_id, now, lease expiry, max jobs
+# Returns 1 if the slot was acquired, 2 if the movie is already being packaged, 0 if all slots are taken
+ACQUIRE_SCRIPT = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 2
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+""")
+
+STARTED = "started"
+RUNNING = "running"
+BUSY = "busy"
+
+def is_packaging(movie):
+    """ Whether a just-in-time packager is currently writing this movie's playlist """
+    score = redis_client.zscore(JOBS_KEY, movie.tmdb_id)
+    return score is not None and score > time.time()
+
+def request_packaging(movie):
+    """
+    Start packaging an unconverted movie in the background, unless it is
+    already running or settings.HLS_JIT_MAX_JOBS packagers are busy.
+
+    The packager writes an EVENT playlist at the movie's normal playlist path,
+    segments are added as fast as ffmpeg produces them (ahead of the playhead).
+    When it finishes the playlist is switched to VOD and the movie is marked
+    hls_available.
+
+    Returns:
+        str: STARTED, RUNNING or BUSY.
+    """
+    now = time.time()
+    acquired = ACQUIRE_SCRIPT(
+        keys=[JOBS_KEY],
+        args=[movie.tmdb_id, now, now + LEASE_SECONDS, settings.HLS_JIT_MAX_JOBS],
+    )
+    if acquired == 2:
+        return RUNNING
+    if acquired == 0:
+        return BUSY
+
+    thread = threading.Thread(
+        target=_package,
+        args=(movie,),
+        name=f"hls-jit-{movie.tmdb_id}",
+        daemon=True,
+    )
+    thread.start()
+    return STARTED
+
+def _renew_lease(movie, stop):
+    while not stop.wait(LEASE_SECONDS / 3):
+        redis_client.zadd(JOBS_KEY, {movie.tmdb_id: time.time() + LEASE_SECONDS}, xx=True)
+
+def _package(movie):
+    stop = threading.Event()
+    renewer = threading.Thread(target=_renew_lease, args=(movie, stop), daemon=True)
+    renewer.start()
+    m3u8_path = get_playlist_path(movie)
+    finished = False
+    try:
+        # force: start from segment zero so the playlist the client got covers the whole movie
+        converter = ConvertToHLS(force=True, playlist_type="event", preset="veryfast")
+        job = converter.prepare(movie)
+        if not job:
+            logger.warning("JIT packaging: nothing to package for %s (%s)", movie.title, movie.tmdb_id)
+            return
+        m3u8_path = job["m3u8_path"]
+        result = converter.run_job(job)
+        if result["ok"]:
+            finalize_playlist(m3u8_path)
+            finished = True
+            logger.info("JIT packaging finished for %s (%s)", movie.title, movie.tmdb_id)
+        else:
+            logger.warning("JIT packaging failed for %s (%s)", movie.title, movie.tmdb_id)
+    except Exception as e:
+        logger.warning("JIT packaging failed for %s (%s): %s", movie.title, movie.tmdb_id, e)
+    finally:
+        if not finished:
+            discard_partial_playlist(m3u8_path)
+        stop.set()
+        redis_client.zrem(JOBS_KEY, movie.tmdb_id)
+        connection.close()
+
+def is_event_playlist(m3u8_path):
+    """ Whether a playlist is still being written (or was left unfinished) by a packager """
+    try:
+        with open(m3u8_path, "r") as f:
+            return "#EXT-X-PLAYLIST-TYPE:EVENT" in f.read()
+    except OSError:
+        return False
+
+def discard_partial_playlist(m3u8_path):
+    """
+    Remove the EVENT playlist of a packager that didn't finish, so clients
+    aren't served a movie that stops partway. A packager killed before it
+    could clean up leaves one behind, StreamToClient packages those again.
+    """
+    if not is_event_playlist(m3u8_path):
+        return
+    try:
+        os.remove(m3u8_path)
+    except OSError as e:
+        logger.warning("Couldn't remove unfinished playlist %s: %s", m3u8_path, e)
+
+def finalize_playlist(m3u8_path):
+    """ Turn a finished EVENT playlist into a VOD one """
+    with open(m3u8_path, "r") as f:
+        content = f.read()
+    content = content.replace("#EXT-X-PLAYLIST-TYPE:EVENT", "#EXT-X-PLAYLIST-TYPE:VOD")
+    tmp_path = f"{m3u8_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, m3u8_path)
@@ -0,0 +1,261 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+
+from api.models import MediaFile
+from utils.hlsThumbnails import THUMBNAIL_DIR, THUMBNAIL_TRACK
+
+logger = logging.getLogger("movies")
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov")
+HLS_SEGMENT_EXTENSIONS = (".ts", ".m4s")
+MASTER_PLAYLIST = "master.m3u8"
+
+TORRENT_DIR = "torrent"
+HLS_DIR = "hls"
+IMAGES_DIR = "images"
+
+INDEXED_FIELDS = [
+    "tmdb_id", "source_path", "source_size", "source_mtime", "hls_path",
+    "playlists", "hls_segments", "thumbnail_track", "images", "dir_mtimes", "scanned_at",
+]
+
+def index_path(movie):
+    return os.path.abspath(movie.download_path)
+
+def scan_directory(path, previous=None):
+    """
+    Read the index fields of one title directory from the filesystem.
+
+    With a previous MediaFile only the sections (torrent, hls, images) whose
+    directory mtimes changed are read again. A changed title directory mtime
+    (a section was created or removed) rescans every section.
+
+    Returns:
+        dict | None: MediaFile fields, None if nothing changed since previous.
+
+    Raises:
+        FileNotFoundError: The directory no longer exists.
+    """
+    title_mtime = os.stat(path).st_mtime
+    old_mtimes = previous.dir_mtimes if previous else {}
+    full = previous is None or old_mtimes.get(".") != title_mtime
+
+    fields = {}
+    mtimes = {".": title_mtime}
+    rescanned = set()
+    for section, scan_section in ((TORRENT_DIR, _scan_torrent), (HLS_DIR, _scan_hls), (IMAGES_DIR, _scan_images)):
+        if full or _section_changed(path, old_mtimes, section):
+            fields.update(scan_section(path, mtimes))
+            rescanned.add(section)
+        else:
+            mtimes.update((rel, mtime) for rel, mtime in old_mtimes.items() if _in_section(rel, section))
+
+    # A file still being downloaded grows without touching its directory's mtime
+    if TORRENT_DIR not in rescanned and previous.source_path:
+        try:
+            stat = os.stat(previous.source_path)
+            if stat.st_size != previous.source_size or stat.st_mtime != previous.source_mtime:
+                fields.update({"source_size": stat.st_size, "source_mtime": stat.st_mtime})
+        except OSError:
+            fields.update(_scan_torrent(path, mtimes))
+
+    if previous and not fields and mtimes == old_mtimes:
+        return None
+
+    dir_name = os.path.basename(os.path.normpath(path))
+    fields["tmdb_id"] = int(dir_name) if dir_name.isdigit() else None
+    fields["dir_mtimes"] = mtimes
+    return fields
+
+def scan(download_path, workers=8, force=False):
+    """
+    Build or refresh the index of every title directory in download_path with
+    one parallel scan. Entries of directories that disappeared are removed.
+
+    Returns:
+        dict: Number of directories scanned, created, updated, unchanged and removed.
+    """
+    previous = {entry.path: entry for entry in MediaFile.objects.all()}
+    with os.scandir(download_path) as entries:
+        paths = [os.path.abspath(entry.path) for entry in entries if entry.is_dir()]
+
+    def scan_one(path):
+        try:
+            return path, scan_directory(path, None if force else previous.get(path))
+        except FileNotFoundError:
+            return path, None
+        except OSError as e:
+            logger.warning("Failed to index %s: %s", path, e)
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(scan_one, paths))
+
+    now = timezone.now()
+    created, updated = [], []
+    for path, fields in results:
+        if fields is None:
+            continue
+        fields["scanned_at"] = now
+        entry = previous.get(path)
+        if entry is None:
+            created.append(MediaFile(path=path, **fields))
+        else:
+            for name, value in fields.items():
+                setattr(entry, name, value)
+            updated.append(entry)
+
+    MediaFile.objects.bulk_create(created, batch_size=500)
+    MediaFile.objects.bulk_update(updated, INDEXED_FIELDS, batch_size=500)
+
+    root = os.path.join(os.path.abspath(download_path), "")
+    scanned = set(paths)
+    removed = [path for path in previous if path.startswith(root) and path not in scanned]
+    MediaFile.objects.filter(path__in=removed).delete()
+
+    return {
+        "scanned": len(paths),
+        "created": len(created),
+        "updated": len(updated),
+        "unchanged": len(paths) - len(created) - len(updated),
+        "removed": len(removed),
+    }
+
+def refresh(path):
+    """
+    Bring the index entry of one title directory up to date, creating it if
+    needed. Only a few directory stats unless something changed.
+
+    Returns:
+        MediaFile | None: None if the directory doesn't exist.
+    """
+    path = os.path.abspath(path)
+    entry = MediaFile.objects.filter(path=path).first()
+    try:
+        fields = scan_directory(path, entry)
+    except FileNotFoundError:
+        if entry:
+            entry.delete()
+        return None
+
+    if fields is None:
+        entry.scanned_at = timezone.now()
+        MediaFile.objects.filter(pk=entry.pk).update(scanned_at=entry.scanned_at)
+        return entry
+    if entry is None:
+        return MediaFile.objects.create(path=path, **fields)
+    for name, value in fields.items():
+        setattr(entry, name, value)
+    entry.save()
+    return entry
+
+def lookup(movie, max_age=None):
+    """
+    Index entry of a movie's download directory, as indexMedia and the
+    conversions left it. The directory is only scanned again (see refresh) when
+    the movie has no entry, its entry is older than max_age seconds
+    (settings.MEDIA_INDEX_MAX_AGE by default) or a file it points to is gone.
+    """
+    path = index_path(movie)
+    entry = MediaFile.objects.filter(path=path).first()
+    if entry is None or _stale(entry, settings.MEDIA_INDEX_MAX_AGE if max_age is None else max_age):
+        return refresh(path)
+    return entry
+
+def get_source_file(movie):
+    """ Path of the movie's source video (the largest video file in torrent/), None if there is none """
+    entry = lookup(movie)
+    return entry.source_path if entry and entry.source_path else None
+
+def get_playlist(entry, safe_title):
+    """
+    Path of the playlist a client should load according to the index: the
+    ABR master playlist if there is one, else the single rendition playlist.
+
+    Returns:
+        str | None: None if the movie has no playlist.
+    """
+    if not entry or not entry.hls_path:
+        return None
+    if MASTER_PLAYLIST in entry.playlists:
+        return os.path.join(entry.hls_path, MASTER_PLAYLIST)
+    if f"{safe_title}.m3u8" in entry.playlists:
+        return os.path.join(entry.hls_path, f"{safe_title}.m3u8")
+    return None
+
+def _stale(entry, max_age):
+    if (timezone.now() - entry.scanned_at).total_seconds() >= max_age:
+        return True
+    if entry.source_path and not os.path.isfile(entry.source_path):
+        return True
+    return any(not os.path.isfile(os.path.join(entry.hls_path, name)) for name in entry.playlists)
+
+def _section(rel):
+    return rel.split(os.sep, 1)[0]
+
+def _in_section(rel, section):
+    return rel != "." and _section(rel) == section
+
+def _section_changed(path, old_mtimes, section):
+    for rel, mtime in old_mtimes.items():
+        if not _in_section(rel, section):
+            continue
+        try:
+            if os.stat(os.path.join(path, rel)).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+def _scan_torrent(path, mtimes):
+    torrent_path = os.path.join(path, TORRENT_DIR)
+    source = {"source_path": "", "source_size": None, "source_mtime": None}
+    for root, dirs, files in os.walk(torrent_path):
+        mtimes[os.path.relpath(root, path)] = os.stat(root).st_mtime
+        for file in files:
+            if not file.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            file_path = os.path.join(root, file)
+            stat = os.stat(file_path)
+            if stat.st_size > (source["source_size"] or 0):
+                source = {"source_path": file_path, "source_size": stat.st_size, "source_mtime": stat.st_mtime}
+    return source
+
+def _scan_hls(path, mtimes):
+    hls_path = os.path.join(path, HLS_DIR)
+    try:
+        mtimes[HLS_DIR] = os.stat(hls_path).st_mtime
+        names = os.listdir(hls_path)
+    except FileNotFoundError:
+        mtimes.pop(HLS_DIR, None)
+        return {"hls_path": "", "playlists": [], "hls_segments": 0, "thumbnail_track": ""}
+
+    thumbnail_track = ""
+    if THUMBNAIL_DIR in names:
+        thumbnails_path = os.path.join(hls_path, THUMBNAIL_DIR)
+        try:
+            mtimes[os.path.join(HLS_DIR, THUMBNAIL_DIR)] = os.stat(thumbnails_path).st_mtime
+            if os.path.isfile(os.path.join(thumbnails_path, THUMBNAIL_TRACK)):
+                thumbnail_track = os.path.join(thumbnails_path, THUMBNAIL_TRACK)
+        except FileNotFoundError:
+            pass
+    return {
+        "hls_path": hls_path,
+        "playlists": sorted(name for name in names if name.endswith(".m3u8")),
+        "hls_segments": sum(1 for name in names if name.endswith(HLS_SEGMENT_EXTENSIONS)),
+        "thumbnail_track": thumbnail_track,
+    }
+
+def _scan_images(path, mtimes):
+    images_path = os.path.join(path, IMAGES_DIR)
+    try:
+        mtimes[IMAGES_DIR] = os.stat(images_path).st_mtime
+        names = os.listdir(images_path)
+    except FileNotFoundError:
+        mtimes.pop(IMAGES_DIR, None)
+        return {"images": []}
+    return {"images": sorted(names)}
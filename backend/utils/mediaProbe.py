@@ -0,0 +1,116 @@
+import os
+import json
+import logging
+import subprocess
+
+from api.models import MediaProbe
+
+logger = logging.getLogger("movies")
+
+PROBE_ENTRIES = (
+    "format=format_name,duration,bit_rate"
+    ":stream=index,codec_type,codec_name,bit_rate,width,height,channels,sample_rate,r_frame_rate"
+    ":stream_tags=language"
+)
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def run_ffprobe(path):
+    """
+    Run ffprobe on a file and return its parsed metadata.
+
+    Returns:
+        dict | None: Fields of MediaProbe (without path/size/mtime), None if ffprobe failed.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", PROBE_ENTRIES,
+        "-of", "json",
+        path,
+    ]
+
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        data = json.loads(result.stdout)
+    except subprocess.CalledProcessError as e:
+        logger.warning("ffprobe failed for %s: %s", path, e.stderr.strip())
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("ffprobe failed for %s: %s", path, e)
+        return None
+
+    fmt = data.get("format", {})
+    info = {
+        "container": fmt.get("format_name", "Unknown"),
+        "duration": float(fmt.get("duration", 0) or 0),
+        "bit_rate": _int_or_none(fmt.get("bit_rate")),
+        "video_codec": "None",
+        "video_bitrate": None,
+        "audio_codec": "None",
+        "audio_bitrate": None,
+        "width": None,
+        "height": None,
+        "streams": [],
+    }
+
+    video_found = audio_found = False
+    for stream in data.get("streams", []):
+        codec_type = stream.get("codec_type")
+        info["streams"].append({
+            "index": stream.get("index"),
+            "codec_type": codec_type,
+            "codec_name": stream.get("codec_name"),
+            "bit_rate": _int_or_none(stream.get("bit_rate")),
+            "width": stream.get("width"),
+            "height": stream.get("height"),
+            "channels": stream.get("channels"),
+            "sample_rate": _int_or_none(stream.get("sample_rate")),
+            "frame_rate": stream.get("r_frame_rate"),
+            "language": stream.get("tags", {}).get("language"),
+        })
+        if codec_type == "video" and not video_found:
+            video_found = True
+            info["video_codec"] = stream.get("codec_name") or "None"
+            info["video_bitrate"] = _int_or_none(stream.get("bit_rate"))
+            info["width"] = stream.get("width")
+            info["height"] = stream.get("height")
+        elif codec_type == "audio" and not audio_found:
+            audio_found = True
+            info["audio_codec"] = stream.get("codec_name") or "None"
+            info["audio_bitrate"] = _int_or_none(stream.get("bit_rate"))
+
+    return info
+
+def probe_media(path):
+    """
+    Return the ffprobe metadata of a file, reading through the MediaProbe store.
+    ffprobe only runs when the file is new or its size/mtime changed.
+
+    Returns:
+        dict | None: container, duration, video_codec, video_bitrate, audio_codec,
+        audio_bitrate, width, height and streams. None if the file is missing or
+        can't be probed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    cached = MediaProbe.objects.filter(path=path, size=stat.st_size, mtime=stat.st_mtime).first()
+    if cached:
+        return cached.to_video_info()
+
+    info = run_ffprobe(path)
+    if info is None:
+        return None
+
+    probe, _ = MediaProbe.objects.update_or_create(
+        path=path,
+        defaults={"size": stat.st_size, "mtime": stat.st_mtime, **info},
+    )
+    return probe.to_video_info()
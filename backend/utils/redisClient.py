@@ -1,9 +1,91 @@
+import asyncio
+import hashlib
+import weakref
+
 import redis
+import redis.asyncio
 from django.conf import settings
 
-redis_client = redis.Redis(
-    host='localhost',  # use 'localhost' if not in Docker
-    port=6379,
-    db=0,
-    decode_responses=True  # store strings not bytes
-)
+# Rooms are spread over settings.REDIS_NODES (see node_for), everything else lives
+# on the first node, the primary. With a single node that's all one Redis.
+PRIMARY_NODE = settings.REDIS_NODES[0]
+
+# Synchronous clients of every node, shared by every synchronous caller in the
+# process (views, management commands, converter threads)
+_clients = {}
+
+def node_client(node):
+    """ Synchronous client of a node, a (host, port) pair """
+    client = _clients.get(node)
+    if client is None:
+        host, port = node
+        pool = redis.ConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            decode_responses=True  # store strings not bytes
+        )
+        client = _clients[node] = redis.Redis(connection_pool=pool)
+    return client
+
+redis_client = node_client(PRIMARY_NODE)
+redis_pool = redis_client.connection_pool
+
+# asyncio connections belong to the event loop that opened them, so every loop
+# gets its own pool per node. Daphne runs one loop per process, so in practice
+# that's one shared pool per node for all consumers of the process.
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_redis(node=None):
+    """
+    Async Redis client of a node (the primary by default) for the running
+    event loop. Use this from consumers and other async code, the synchronous
+    redis_client blocks the event loop on every round trip.
+    """
+    node = node or PRIMARY_NODE
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(node)
+    if client is None:
+        host, port = node
+        # Blocking: a burst of consumers waits for a free connection instead of failing
+        pool = redis.asyncio.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            max_connections=settings.REDIS_ASYNC_MAX_CONNECTIONS,
+            decode_responses=True,
+        )
+        client = clients[node] = redis.asyncio.Redis(connection_pool=pool)
+    return client
+
+def node_for(room_hash, nodes=None):
+    """
+    Node holding the room's state, out of `nodes` (settings.REDIS_NODES by
+    default). Rendezvous hashing: every node scores the room and the highest
+    score wins, so adding a node only moves the rooms it now wins and
+    removing one only moves the rooms it held.
+    """
+    nodes = nodes if nodes is not None else settings.REDIS_NODES
+    return max(nodes, key=lambda node: hashlib.sha1(f"{node[0]}:{node[1]}/{room_hash}".encode()).digest())
+
+def previous_node_for(room_hash):
+    """
+    Node that held the room before the nodes last changed (settings.REDIS_PREVIOUS_NODES),
+    None if it's the same as now or nothing changed.
+    """
+    if not settings.REDIS_PREVIOUS_NODES:
+        return None
+    node = node_for(room_hash, settings.REDIS_PREVIOUS_NODES)
+    return node if node != node_for(room_hash) else None
+
+def room_redis_client(room_hash):
+    """ Synchronous client of the node holding the room """
+    return node_client(node_for(room_hash))
+
+def get_async_room_redis(room_hash):
+    """ Async client of the node holding the room, for the running event loop """
+    return get_async_redis(node_for(room_hash))
+
+def node_clients():
+    """ Synchronous clients of all nodes, for jobs that go over every room """
+    return [node_client(node) for node in settings.REDIS_NODES]
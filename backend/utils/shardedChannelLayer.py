@@ -0,0 +1,62 @@
+import re
+import contextvars
+
+from channels_redis.core import RedisChannelLayer
+from utils.redisClient import node_for
+
+# Groups of a room: room_<hash> and room_<hash>_user_<id> (see rooms.consumers)
+ROOM_GROUP = re.compile(r"^room_([0-9a-f]+)(?:_user_\d+)?$")
+
+# Set while a group_send goes to the rooms' previous nodes
+_previous = contextvars.ContextVar("previous", default=False)
+
+class RoomShardedChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that keeps the groups of a room on the node holding
+    the room's state (utils.redisClient.node_for) instead of channels_redis'
+    own CRC ring, whose modulo moves most groups whenever a node is added.
+    Other groups and channels are placed as channels_redis does.
+
+    While rooms move after the nodes changed (previous_nodes), broadcasts go
+    to the room's old node too, so sockets that joined there before keep
+    getting them until they reconnect.
+    """
+
+    def __init__(self, nodes, previous_nodes=(), **kwargs):
+        self.nodes = [tuple(node) for node in nodes]
+        self.previous_nodes = [tuple(node) for node in previous_nodes]
+        hosts = self.nodes + [node for node in self.previous_nodes if node not in self.nodes]
+        self.node_index = {node: index for index, node in enumerate(hosts)}
+        super().__init__(hosts=hosts, **kwargs)
+
+    def room_node_index(self, group, previous=False):
+        """ Host index of a room group's node, None for other names """
+        match = ROOM_GROUP.match(group)
+        if match is None:
+            return None
+        nodes = self.previous_nodes if previous and self.previous_nodes else self.nodes
+        return self.node_index[node_for(match.group(1), nodes)]
+
+    def consistent_hash(self, value):
+        index = self.room_node_index(value, previous=_previous.get())
+        return index if index is not None else super().consistent_hash(value)
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        previous = self.room_node_index(group, previous=True)
+        if previous is not None and previous != self.room_node_index(group):
+            token = _previous.set(True)
+            try:
+                await super().group_send(group, message)
+            finally:
+                _previous.reset(token)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        previous = self.room_node_index(group, previous=True)
+        if previous is not None and previous != self.room_node_index(group):
+            token = _previous.set(True)
+            try:
+                await super().group_discard(group, channel)
+            finally:
+                _previous.reset(token)
@@ -10,6 +10,38 @@ if (import.meta.env.DEV) {
     wsBase = `${wsProtocol}//${window.location.host}`;
 }
 
+// Latest resume token the server sent on each socket path. Reconnecting with it
+// skips authentication and the full re-init, the server falls back to the
+// cookie once it has expired. It's sent as a subprotocol rather than in the URL,
+// which proxies log.
+const resumeTokens = new Map();
+
+export const RESUME_PROTOCOL = "movies.resume";
+
+const normalise = (path) => (path.startsWith("/") ? path : `/${path}`);
+
+/**
+ * Keeps the resume token of a socket, from its "session" messages.
+ */
+export const setResumeToken = (path, token) => {
+    resumeTokens.set(normalise(path), token);
+};
+
+/**
+ * Returns the WebSocket subprotocols offering the path's resume token,
+ * undefined if there is none. A token lets a single socket in, so it's
+ * forgotten here, the socket it opens gets a new one.
+ * Example:
+ *   new WebSocket(socketUrl(path), resumeProtocols(path))
+ */
+export const resumeProtocols = (path) => {
+    path = normalise(path);
+    const token = resumeTokens.get(path);
+    if (!token) return undefined;
+    resumeTokens.delete(path);
+    return [RESUME_PROTOCOL, token];
+};
+
 /**
  * Returns the full WebSocket URL based on environment.
  * Example:
@@ -17,8 +49,7 @@ if (import.meta.env.DEV) {
  */
 const socketUrl = (path) => {
     // Ensure no accidental double slashes
-    if (!path.startsWith("/")) path = `/${path}`;
-    return `${wsBase}${path}`;
+    return `${wsBase}${normalise(path)}`;
 };
 
 export default socketUrl;
@@ -25,6 +25,7 @@ function Player() {
     const updateInterval = useRef(null);
     const hasSeeked = useRef(false);
     const [videoPath, setVideoPath] = useState("");
+    const [thumbnailsPath, setThumbnailsPath] = useState("");
     const [isLoading, setIsLoading] = useState(false);
     const [isPlaying, setIsPlaying] = useState(false);
 
@@ -59,8 +60,15 @@ function Player() {
             setIsLoading(true);
             const res = await api.get(`/movie/stream-to-client/?tmdb_id=${tmdb_id}`);
             const data = res.data;
+            if (res.status === 202) {
+                // Server is packaging the movie on demand, playlist isn't written yet
+                setTimeout(getMoviePath, 2000);
+                return;
+            }
             if (data.file_path) {
                 setVideoPath(data.file_path);
+                // WebVTT seek preview track (sprite sheet tiles), only if the movie has one
+                setThumbnailsPath(data.thumbnails || "");
                 //setVideoPath("http://localhost:5173/media/downloads/22/hls/Pirates_of_the_Caribbean__The_Curse_of_the_Black_Pearl.m3u8");
             } else {
                 toast.error("No file_path returned for movie:", tmdb_id);
@@ -183,7 +191,11 @@ function Player() {
                             controls
                             crossOrigin="anonymous"
                             autoPlay
-                        />
+                        >
+                            {thumbnailsPath && (
+                                <track kind="metadata" label="thumbnails" src={thumbnailsPath} default />
+                            )}
+                        </video>
                         <button className={backButtonStyle.backButton} onClick={() => navigate(-1)}>
                             <FaArrowLeft />
                         </button>
@@ -18,7 +18,7 @@ import styles from "./Room.module.css";
 import playerStyles from "./Player.module.css";
 import backButtonStyle from "./components/BackButton.module.css";
 import Hls from "hls.js";
-import socketUrl from "../main/webSocketBase";
+import socketUrl, { setResumeToken, resumeProtocols } from "../main/webSocketBase";
 
 function Room() {
     const navigate = useNavigate();
@@ -32,6 +32,7 @@ function Room() {
     const volumeBarRef = useRef();
     const playerContainerRef = useRef();
     const timeoutRef = useRef(null);
+    const roomVersionRef = useRef(null);
 
     const [showControls, setShowControls] = useState(true);
     const [mouseVisible, setMouseVisible] = useState(true);
@@ -45,6 +46,10 @@ function Room() {
     const [isPlaying, setIsPlaying] = useState(false);
     const [room, setRoom] = useState(location.state?.room || null);
 
+    useEffect(() => {
+        roomVersionRef.current = room?.version ?? null;
+    }, [room]);
+
     useEffect(() => {
         if (!room) return;
         getMoviePath();
@@ -52,6 +57,20 @@ function Room() {
         setUpWebSocket();
     }, [room]);
 
+    useEffect(() => {
+        // Position for the server's presence heartbeat, which sends it on every ROOM_PRESENCE_INTERVAL
+        const interval = setInterval(() => {
+            if (!videoRef.current) return;
+            if (socketRef.current?.readyState === WebSocket.OPEN) {
+                socketRef.current.send(JSON.stringify({
+                    "action_type": "position",
+                    "action_state": videoRef.current.currentTime,
+                }));
+            }
+        }, 10000);
+        return () => clearInterval(interval);
+    }, []);
+
     useEffect(() => {
         if (!room && roomHash) {
             api
@@ -156,6 +175,11 @@ function Room() {
 
         try {
             const res = await api.get(`/movie/stream-to-client/?tmdb_id=${room.movie_id}`);
+            if (res.status === 202) {
+                // Server is packaging the movie on demand, playlist isn't written yet
+                setTimeout(getMoviePath, 2000);
+                return;
+            }
             if (!res.data.file_path) {
                 throw new Error("No file path returned from server");
             }
@@ -180,18 +204,42 @@ function Room() {
 
     const setUpWebSocket = () => {
         if (!room) return;
-        const socket = new WebSocket(socketUrl(`/ws/room/${room.room_hash}/`));
+        const path = `/ws/room/${room.room_hash}/`;
+        const socket = new WebSocket(socketUrl(path), resumeProtocols(path));
         socketRef.current = socket;
 
+        socket.onclose = (e) => {
+            // Dropped connection, or closed for falling behind (4008): reconnect, resuming the session.
+            // Not for replaced sockets or refusals.
+            if (socketRef.current !== socket || e.code === 4001 || e.code === 4003) return;
+            setTimeout(() => {
+                if (socketRef.current === socket) setUpWebSocket();
+            }, 1000);
+        };
+
         socket.onmessage = (e) => {
             let data = JSON.parse(e.data);
             switch (data.type) {
                 case "room_update":
-                    setRoomState(data);
+                    applyRoomUpdate(data);
                     break;
                 case "control_state":
                     setControlState(data);
                     break;
+                case "privileges_update":
+                    setRoomUser((prev) => prev && { ...prev, privileges: data.privileges });
+                    break;
+                case "session":
+                    setResumeToken(path, data.resume_token);
+                    break;
+                case "clock_ping":
+                    // Server estimates our clock offset from these, answer right away
+                    socket.send(JSON.stringify({
+                        "action_type": "clock_pong",
+                        "id": data.id,
+                        "client_time": Date.now() / 1000,
+                    }));
+                    break;
             }
         }
 
@@ -238,8 +286,25 @@ function Room() {
         }
     };
 
-    const setRoomState = (data) => {
-        setRoom(data.room);
+    const fetchRoomSnapshot = async () => {
+        try {
+            const res = await api.get(`/room/${room.room_hash}/snapshot/`);
+            setRoom(res.data.room);
+        } catch (err) {
+            toast.error("Failed to fetch room");
+        }
+    };
+
+    const applyRoomUpdate = (data) => {
+        const version = roomVersionRef.current ?? 0;
+        if (data.version <= version) return;
+        if (data.version > version + 1) {
+            // Missed an update, catch up from a full snapshot
+            fetchRoomSnapshot();
+            return;
+        }
+        roomVersionRef.current = data.version;
+        setRoom((prev) => prev && { ...prev, ...data.changes, version: data.version });
     };
 
     const updatePlayState = (state) => {